@@ -0,0 +1,257 @@
+"""
+benchmarks for the physics of solarsystem.py
+usage: python3 benchmark.py barneshut --bodies 100000 --thetas 0.3 0.5 0.7 1.0
+       python3 benchmark.py scaling --output scaling.json
+       python3 benchmark.py accuracy --years 10 --output accuracy.json
+       python3 benchmark.py compare old.json new.json
+needs numpy
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import solarsystem
+
+
+def make_belt(n, seed=0, inner=2.1, outer=3.3, mass=1e-10):
+    """returns positions (AU) and masses (earth masses) of the sun and
+       n-1 asteroids in a thin belt between inner and outer AU"""
+    rng = np.random.default_rng(seed)
+    r = rng.uniform(inner, outer, n - 1)
+    phi = rng.uniform(0, 2 * np.pi, n - 1)
+    z = rng.normal(0, 0.05, n - 1)
+    positions = np.zeros((n, 3))
+    positions[1:] = np.column_stack((r * np.cos(phi), r * np.sin(phi), z))
+    masses = np.full(n, mass)
+    masses[0] = 332937
+    return positions, masses
+
+
+def make_cluster(n, seed=0):
+    """returns positions and masses of n equal bodies in a gaussian blob.
+       Without a dominating sun this is the hard case for Barnes-Hut"""
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, 1, (n, 3)), np.ones(n)
+
+
+def barneshut(bodies=100000, thetas=(0.3, 0.5, 0.7, 1.0), samples=1000, distribution="belt", seed=0):
+    """force error of the octree against direct summation for each theta.
+       The direct sum is only evaluated for a random sample of target bodies,
+       the full direct sum would take too long for large body counts"""
+    make = make_belt if distribution == "belt" else make_cluster
+    positions, masses = make(bodies, seed)
+    targets = np.random.default_rng(seed + 1).choice(bodies, min(samples, bodies), replace=False)
+    start = time.perf_counter()
+    reference = solarsystem.direct_accelerations(positions, masses, targets=targets)
+    direct_time = (time.perf_counter() - start) / len(targets) * bodies
+    start = time.perf_counter()
+    tree = solarsystem.Octree(positions, masses)
+    build_time = time.perf_counter() - start
+    print("{} bodies ({}), octree with {} nodes built in {:.3f} s".format(bodies, distribution, len(tree.mass), build_time))
+    print("direct summation: {:.3f} s per step (extrapolated from {} targets)".format(direct_time, len(targets)))
+    print("{:>6} {:>12} {:>12} {:>12} {:>12}".format("theta", "median err", "99% err", "max err", "s / step"))
+    rows = []
+    for theta in thetas:
+        # the tree walks neighbouring targets together, so it is timed for all bodies
+        start = time.perf_counter()
+        acc = tree.accelerations(theta)[targets]
+        step_time = time.perf_counter() - start + build_time
+        error = np.linalg.norm(acc - reference, axis=1) / np.linalg.norm(reference, axis=1)
+        row = (theta, float(np.median(error)), float(np.percentile(error, 99)), float(error.max()), step_time)
+        print("{:6.2f} {:12.3e} {:12.3e} {:12.3e} {:12.3f}".format(*row))
+        rows.append(row)
+    return rows
+
+
+def make_game(bodies, backend, integrator="leapfrog", seed=0):
+    """the solar system of Game.__init__ plus bodies-5 small asteroids on
+       circular orbits around the sun, so every body count starts from the
+       same 5 real bodies"""
+    with contextlib.redirect_stdout(io.StringIO()):  # Game prints every body
+        game = solarsystem.Game(backend=backend, integrator=integrator)
+    extra = bodies - len(game.objects)
+    if extra > 0:
+        positions, masses = make_belt(extra + 1, seed)
+        sun = game.objects[0]
+        r = np.linalg.norm(positions[1:, :2], axis=1)
+        speed = np.sqrt(solarsystem.GRAVCONST * sun.mass / r)
+        velocities = np.column_stack((-speed * positions[1:, 1] / r, speed * positions[1:, 0] / r, np.zeros(extra)))
+        game.add_bodies(positions[1:], velocities, masses[1:], radii=[1e-6] * extra)
+    game.backend.load()
+    return game
+
+
+def peak_memory(function, *args):
+    """peak memory in bytes that python and numpy allocate while function runs.
+       tracemalloc slows python code down, so this is measured apart from the timing"""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def steps_per_second(game, step, min_time=1.0):
+    """doubles the number of steps until a run takes at least min_time seconds"""
+    steps = 1
+    while True:
+        start = time.perf_counter()
+        game.advance(steps * step, step)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return steps / elapsed
+        steps *= 2
+
+
+# the direct backends need N² work per step, beyond these counts one step takes minutes
+max_bodies = {"python": 2000, "numpy": 20000, "barneshut": None}
+
+
+def scaling(counts=(5, 10, 100, 1000, 10000, 100000), backends=None, integrator="leapfrog",
+            step=1 / 365.25, min_time=1.0):
+    """physics steps per second and peak memory against the number of bodies"""
+    backends = backends or list(solarsystem.Game.backends)
+    print("{:>10} {:>8} {:>12} {:>14}".format("backend", "bodies", "steps / s", "peak memory"))
+    rows = []
+    for backend in backends:
+        for bodies in counts:
+            if max_bodies.get(backend) is not None and bodies > max_bodies[backend]:
+                continue
+            game = make_game(bodies, backend, integrator)
+            memory = peak_memory(game.advance, step, step)
+            rate = steps_per_second(game, step, min_time)
+            row = {"backend": backend, "integrator": integrator, "bodies": bodies,
+                   "steps_per_second": rate, "peak_memory": memory}
+            print("{:>10} {:8} {:12.2f} {:11.0f} kB".format(backend, bodies, rate, memory / 1024))
+            rows.append(row)
+    return rows
+
+
+def conserved(game):
+    """energy and angular momentum of the massive bodies"""
+    positions, velocities = solarsystem.state_arrays(game.backend)
+    masses = np.array([b.mass for b in game.objects.values()], dtype=float)
+    positions, velocities = positions[:len(masses)], velocities[:len(masses)]
+    return (solarsystem.total_energy(positions, velocities, masses),
+            solarsystem.angular_momentum(positions, velocities, masses))
+
+
+def accuracy(years=10, steps=(1, 4), backends=None, integrators=None):
+    """wall time against energy and angular momentum drift over years of
+       the solar system, for each backend, integrator and step (days)"""
+    backends = backends or list(solarsystem.Game.backends)
+    integrators = integrators or list(solarsystem.Game.integrators)
+    print("{:>10} {:>10} {:>5} {:>10} {:>13} {:>13} {:>14}".format(
+        "backend", "integrator", "step", "wall s", "energy drift", "L drift", "peak memory"))
+    rows = []
+    for backend in backends:
+        for integrator in integrators:
+            for days in steps:
+                step = days / 365.25
+                game = make_game(5, backend, integrator)
+                energy0, momentum0 = conserved(game)
+                memory = peak_memory(make_game(5, backend, integrator).advance, 30 * step, step)
+                start = time.perf_counter()
+                game.advance(years, step)
+                wall = time.perf_counter() - start
+                energy, momentum = conserved(game)
+                row = {"backend": backend, "integrator": integrator, "step_days": days, "years": years,
+                       "wall_time": wall, "energy_drift": abs((energy - energy0) / energy0),
+                       "angular_momentum_drift": float(np.linalg.norm(momentum - momentum0) / np.linalg.norm(momentum0)),
+                       "peak_memory": memory}
+                print("{:>10} {:>10} {:5g} {:10.3f} {:13.3e} {:13.3e} {:11.0f} kB".format(
+                    backend, integrator, days, wall, row["energy_drift"], row["angular_momentum_drift"],
+                    memory / 1024))
+                rows.append(row)
+    return rows
+
+
+def machine():
+    """where and on which commit the benchmark ran, stored with the results"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+            "numpy": np.__version__, "platform": platform.platform(), "processor": platform.processor()}
+
+
+def save(output, command, options, rows):
+    with open(output, "w") as f:
+        json.dump({"command": command, "options": options, "machine": machine(), "results": rows}, f, indent=1)
+
+
+def compare(old, new):
+    """prints the ratio new / old for every result both files have in common"""
+    with open(old) as f:
+        old = json.load(f)
+    with open(new) as f:
+        new = json.load(f)
+    keys = ("backend", "integrator", "bodies", "step_days", "theta")
+    values = ("steps_per_second", "wall_time", "energy_drift", "angular_momentum_drift", "peak_memory")
+    before = {tuple(row.get(k) for k in keys): row for row in old["results"]}
+    print("{} -> {}".format(old["machine"]["commit"], new["machine"]["commit"]))
+    for row in new["results"]:
+        previous = before.get(tuple(row.get(k) for k in keys))
+        if previous is None:
+            continue
+        label = " ".join(str(row[k]) for k in keys if k in row)
+        ratios = ["{} x{:.3g}".format(v, row[v] / previous[v]) for v in values
+                  if v in row and previous.get(v)]
+        print("{:<30} {}".format(label, ", ".join(ratios)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    bh = commands.add_parser("barneshut", help="octree force error against direct summation")
+    bh.add_argument("--bodies", type=int, default=100000)
+    bh.add_argument("--thetas", type=float, nargs="+", default=[0.3, 0.5, 0.7, 1.0])
+    bh.add_argument("--samples", type=int, default=1000, help="target bodies checked against the direct sum")
+    bh.add_argument("--distribution", choices=["belt", "cluster"], default="belt")
+    bh.add_argument("--seed", type=int, default=0)
+    bh.add_argument("--output", default=None, help="json file for the results")
+    sc = commands.add_parser("scaling", help="steps per second and memory against body count")
+    sc.add_argument("--counts", type=int, nargs="+", default=[5, 10, 100, 1000, 10000, 100000])
+    sc.add_argument("--backends", nargs="+", choices=list(solarsystem.Game.backends), default=None)
+    sc.add_argument("--integrator", choices=list(solarsystem.Game.integrators), default="leapfrog")
+    sc.add_argument("--min-time", type=float, default=1.0, help="seconds per measurement")
+    sc.add_argument("--output", default=None, help="json file for the results")
+    ac = commands.add_parser("accuracy", help="wall time against energy and angular momentum drift")
+    ac.add_argument("--years", type=float, default=10)
+    ac.add_argument("--steps", type=float, nargs="+", default=[1, 4], help="days")
+    ac.add_argument("--backends", nargs="+", choices=list(solarsystem.Game.backends), default=None)
+    ac.add_argument("--integrators", nargs="+", choices=list(solarsystem.Game.integrators), default=None)
+    ac.add_argument("--output", default=None, help="json file for the results")
+    cp = commands.add_parser("compare", help="ratios between two json result files")
+    cp.add_argument("old")
+    cp.add_argument("new")
+    args = parser.parse_args(argv)
+    if args.command == "compare":
+        compare(args.old, args.new)
+        return
+    if args.command == "barneshut":
+        rows = [dict(zip(("theta", "median_error", "p99_error", "max_error", "step_time"), row))
+                for row in barneshut(args.bodies, args.thetas, args.samples, args.distribution, args.seed)]
+    elif args.command == "scaling":
+        rows = scaling(args.counts, args.backends, args.integrator, min_time=args.min_time)
+    else:
+        rows = accuracy(args.years, args.steps, args.backends, args.integrators)
+    if args.output is not None:
+        options = {k: v for k, v in vars(args).items() if k not in ("command", "output")}
+        save(args.output, args.command, options, rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Monte Carlo ensembles for orbital stability studies:
+many copies of a Game with slightly perturbed initial conditions run in
+parallel on all cpu cores, each with its own deterministic random seed.
+usage: python3 ensemble.py --members 100 --years 1000 --output ensemble.csv
+needs numpy
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import multiprocessing
+import time
+
+import numpy as np
+
+import solarsystem
+
+
+FIELDS = ["member", "seed", "ejections", "min_separation", "min_pair", "energy_drift",
+          "max_energy_drift", "steps", "wall_time"]
+
+
+def perturb(game, rng, position_sigma=1e-3, velocity_sigma=1e-3):
+    """moves every body except the first (the sun) by a gaussian offset of
+       position_sigma AU and scales its velocity by a gaussian factor with
+       relative width velocity_sigma"""
+    sun = game.objects.at(0)
+    for body in game.objects.values():
+        if body is sun:
+            continue
+        body.position = body.position + solarsystem.pygame.math.Vector3(*rng.normal(0, position_sigma, 3))
+        body.velocity = body.velocity * (1 + rng.normal(0, velocity_sigma))
+    game.backend.load()
+
+
+def run_member(member, seed=0, years=100, step=1, check_every=10, position_sigma=1e-3,
+               velocity_sigma=1e-3, eject_distance=100, backend=None, integrator="leapfrog"):
+    """runs one perturbed copy of the default solar system and returns a row
+       for the result table. step and check_every are in days, every
+       check_every days the separations, ejections and energy are measured.
+       A body counts as ejected when it is farther than eject_distance AU from
+       the sun or unbound to it"""
+    start = time.perf_counter()
+    rng = np.random.default_rng([seed, member])  # independent of the other members and of the order
+    with contextlib.redirect_stdout(io.StringIO()):  # Game prints every body
+        game = solarsystem.Game(backend=backend, integrator=integrator)
+    perturb(game, rng, position_sigma, velocity_sigma)
+    names = [b.name for b in game.objects.values()]
+    masses = np.array([b.mass for b in game.objects.values()], dtype=float)
+    ejected = set()
+    min_separation, min_pair = np.inf, ""
+    energy0 = None
+    max_drift = 0.0
+    steps = 0
+    checks = max(1, int(round(years * 365.25 / check_every)))
+    for check in range(checks + 1):
+        if check:
+            steps += game.advance(years / checks, step / 365.25)
+        positions, velocities = solarsystem.state_arrays(game.backend)
+        positions, velocities = positions[:len(masses)], velocities[:len(masses)]
+        energy = solarsystem.total_energy(positions, velocities, masses)
+        if energy0 is None:
+            energy0 = energy
+        drift = abs((energy - energy0) / energy0)
+        max_drift = max(max_drift, drift)
+        # ---- closest pair of bodies ----
+        d = positions[np.newaxis, :, :] - positions[:, np.newaxis, :]
+        r = np.sqrt(np.einsum("ijk,ijk->ij", d, d))
+        r[np.tril_indices(len(r))] = np.inf
+        i, j = np.unravel_index(np.argmin(r), r.shape)
+        if r[i, j] < min_separation:
+            min_separation, min_pair = float(r[i, j]), "{}-{}".format(names[i], names[j])
+        # ---- ejections: far away or unbound to the sun ----
+        offset = positions[1:] - positions[0]
+        relative_speed = velocities[1:] - velocities[0]
+        distance = np.linalg.norm(offset, axis=1)
+        specific_energy = 0.5 * np.einsum("ij,ij->i", relative_speed, relative_speed) \
+            - solarsystem.GRAVCONST * (masses[0] + masses[1:]) / distance
+        for k in np.flatnonzero((distance > eject_distance) | (specific_energy > 0)):
+            ejected.add(names[k + 1])
+    return {"member": member, "seed": seed, "ejections": len(ejected), "min_separation": min_separation,
+            "min_pair": min_pair, "energy_drift": drift, "max_energy_drift": max_drift, "steps": steps,
+            "wall_time": time.perf_counter() - start}
+
+
+def _run_member(args):
+    member, options = args
+    return run_member(member, **options)
+
+
+def run_ensemble(members=100, processes=None, output=None, **options):
+    """runs members perturbed copies on a pool of processes (default: one per
+       cpu core), reports the progress and returns the rows sorted by member.
+       The result of a member depends only on its number and the seed, not on
+       the number of processes"""
+    processes = processes or multiprocessing.cpu_count()
+    start = time.perf_counter()
+    rows = []
+    with multiprocessing.Pool(processes) as pool:
+        for row in pool.imap_unordered(_run_member, [(m, options) for m in range(members)]):
+            rows.append(row)
+            elapsed = time.perf_counter() - start
+            print("member {:>5} done ({}/{}), {:.1f} s elapsed, about {:.1f} s left".format(
+                row["member"], len(rows), members, elapsed, elapsed / len(rows) * (members - len(rows))))
+    rows.sort(key=lambda row: row["member"])
+    if output is not None:
+        with open(output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    summary(rows, time.perf_counter() - start, processes)
+    return rows
+
+
+def summary(rows, wall, processes):
+    """prints mean, median, min and max of the result columns"""
+    print("{} members on {} processes in {:.1f} s".format(len(rows), processes, wall))
+    print("{:>18} {:>12} {:>12} {:>12} {:>12}".format("", "mean", "median", "min", "max"))
+    for field in ("ejections", "min_separation", "energy_drift", "max_energy_drift", "wall_time"):
+        values = np.array([row[field] for row in rows], dtype=float)
+        print("{:>18} {:12.4g} {:12.4g} {:12.4g} {:12.4g}".format(
+            field, values.mean(), np.median(values), values.min(), values.max()))
+    print("members with ejections: {}".format(sum(1 for row in rows if row["ejections"])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=None, help="default: number of cpu cores")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--years", type=float, default=100)
+    parser.add_argument("--step", type=float, default=1, help="days")
+    parser.add_argument("--check-every", type=float, default=10, help="days between measurements")
+    parser.add_argument("--position-sigma", type=float, default=1e-3, help="AU")
+    parser.add_argument("--velocity-sigma", type=float, default=1e-3, help="relative")
+    parser.add_argument("--eject-distance", type=float, default=100, help="AU")
+    parser.add_argument("--backend", choices=list(solarsystem.Game.backends), default=None)
+    parser.add_argument("--integrator", choices=list(solarsystem.Game.integrators), default="leapfrog")
+    parser.add_argument("--output", default=None, help="csv file for the result table")
+    args = parser.parse_args()
+    run_ensemble(args.members, args.processes, args.output, seed=args.seed, years=args.years, step=args.step,
+                 check_every=args.check_every, position_sigma=args.position_sigma,
+                 velocity_sigma=args.velocity_sigma, eject_distance=args.eject_distance,
+                 backend=args.backend, integrator=args.integrator)
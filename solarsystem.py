@@ -16,6 +16,29 @@ import math
 # import inspect
 
 import os
+import sys
+import csv
+import time
+import argparse
+import json
+import struct
+import collections
+import heapq
+import queue
+import threading
+import multiprocessing
+import asyncio
+import ipaddress
+import mmap
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # numpy is optional, only the "numpy" backend needs it
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None  # python < 3.8, no physics worker
 
 AU_TO_KM =149597870.7  # astronomical units to km
 ME_TO_KG = 5.97237e24  # mass of earth in kg
@@ -23,6 +46,11 @@ GRAVCONST = 1.1857e-4  # gravitational constant in AU³ / M_E * a²    .. is the
 GRAD_TO_RAD = math.pi / 180
 RAD_TO_GRAD = 1 / GRAD_TO_RAD
 
+def require_numpy(feature):
+    """raises ImportError if numpy is missing, feature says what needs it"""
+    if np is None:
+        raise ImportError("{} needs numpy, try: pip install numpy".format(feature))
+
 def initialspeed(distance_to_sun, boss_mass):
     """calculates and returns the initialspeed of a planet """
     return (2*GRAVCONST * boss_mass / distance_to_sun )**0.5 * 2 * math.pi /8.885532070731612 # correction-factor
@@ -75,17 +103,82 @@ def minmax(value, lower_limit=-1, upper_limit=1):
     return value
 
 
-def make_text(text="@", font_color=(255, 0, 255), font_size=48, font_name="mono", bold=True, grid_size=None):
+class TextCache:
+    """pygame.font.SysFont scans the system fonts on every call, so fonts are
+       kept in a dict keyed by (name, size, bold). Rendered text surfaces are
+       kept in a least recently used cache that holds at most max_bytes of
+       pixels. hits and misses count both caches, see stats()"""
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.fonts = {}
+        self.surfaces = collections.OrderedDict()  # key -> surface, oldest first
+        self.bytes = 0
+        self.font_hits = self.font_misses = 0
+        self.hits = self.misses = 0
+
+    def font(self, name, size, bold):
+        key = (name, size, bold)
+        font = self.fonts.get(key)
+        if font is None:
+            self.font_misses += 1
+            font = self.fonts[key] = pygame.font.SysFont(name, size, bold)
+        else:
+            self.font_hits += 1
+        return font
+
+    def render(self, text, color, size, name, bold, cache=True):
+        """returns the rendered (alpha converted) text surface.
+           The surface is shared: blit it, but never draw on it.
+           With cache=False the surface is rendered and not stored"""
+        if not cache:
+            surface = self.font(name, size, bold).render(text, True, color)
+            return surface.convert_alpha() if pygame.display.get_surface() is not None else surface
+        key = (text, tuple(color), name, size, bold)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+        self.misses += 1
+        surface = self.font(name, size, bold).render(text, True, color)
+        if pygame.display.get_surface() is not None:
+            surface = surface.convert_alpha()  # pygame surface, use for blitting
+        self.surfaces[key] = surface
+        self.bytes += surface.get_width() * surface.get_height() * surface.get_bytesize()
+        while self.bytes > self.max_bytes and len(self.surfaces) > 1:
+            old_key, old = self.surfaces.popitem(last=False)
+            self.bytes -= old.get_width() * old.get_height() * old.get_bytesize()
+        return surface
+
+    def clear(self):
+        """forget every font and surface. Needed before pygame.quit(): a font
+           used after pygame was initialized again crashes the interpreter"""
+        self.fonts.clear()
+        self.surfaces.clear()
+        self.bytes = 0
+
+    def stats(self):
+        """hit and miss counts of the font and surface caches"""
+        return {"hits": self.hits, "misses": self.misses, "font_hits": self.font_hits,
+                "font_misses": self.font_misses, "surfaces": len(self.surfaces), "bytes": self.bytes}
+
+
+text_cache = TextCache()
+
+
+def make_text(text="@", font_color=(255, 0, 255), font_size=48, font_name="mono", bold=True, grid_size=None, cache=True):
     """returns pygame surface with text and x, y dimensions in pixel
        grid_size must be None or a tuple with positive integers.
        Use grid_size to scale the text to your desired dimension or None to just render it
-       You still need to blit the surface.
+       You still need to blit the surface. Without grid_size the surface comes
+       from text_cache and must not be drawn on.
+       Use cache=False for text that changes every frame, it would only push
+       reusable surfaces out of the cache.
        Example: text with one char for font_size 48 returns the dimensions 29,49
     """
-    myfont = pygame.font.SysFont(font_name, font_size, bold)
-    size_x, size_y = myfont.size(text)
-    mytext = myfont.render(text, True, font_color)
-    mytext = mytext.convert_alpha()  # pygame surface, use for blitting
+    mytext = text_cache.render(text, font_color, font_size, font_name, bold, cache)
+    size_x, size_y = mytext.get_size()
     if grid_size is not None:
         # TODO error handler if grid_size is not a tuple of positive integers
         mytext = pygame.transform.scale(mytext, grid_size)
@@ -102,9 +195,8 @@ def write(background, text, x=50, y=150, color=(0, 0, 0),
     """
     if font_size is None:
         font_size = 24
-    font = pygame.font.SysFont(font_name, font_size, bold)
-    width, height = font.size(text)
-    surface = font.render(text, True, color)
+    surface = text_cache.render(text, color, font_size, font_name, bold)
+    width, height = surface.get_size()
 
     if origin == "center" or origin == "centercenter":
         background.blit(surface, (x - width // 2, y - height // 2))
@@ -128,82 +220,418 @@ def write(background, text, x=50, y=150, color=(0, 0, 0),
 
 # declare constants
 class Game:
-    """solar system"""
+    """solar system. Every Game has its own bodies, timescale and pause state,
+       so several independent systems can live in one process"""
     #sun_mass = 332937
-    objects = {}
     deltas = [(1/365.25/24/60/60, "1 second"),(1/365.25/24/60, "1 minute"), (1/365.25/24, "1 hour"),
               (1/365.25, "1 day"), (2/365.25, "2 days"), (3/365.25, "3 days"),
               (4/365.25, "4 days"),(5/365.25, "5 days"), (6/365.25, "6 days"),
               (7/365.25, "1 week"),(14/365.25, "2 weeks"), (21/365.25, "3 weeks"),
               (28/365.25, "4 weeks"), (1/4, "1/4 year"), (1/2, "1/2 year"), (1, "1 year"),
               ]
-    i = 3
-    delta_t = deltas[i][0] #1 / 365.25  # = 1 day
-    paused = False
+    physics_rate = 120  # physics steps per second of real time
+    # never step more than max_step years, big timescales take more steps instead. 1 day keeps
+    # the energy error of leapfrog on mercury's 88 day orbit small; yoshida4, rk45 and block
+    # stay accurate with larger steps, choose it with Game(max_step=...) or --max-step
+    max_step = 1 / 365.25
+    max_steps_per_frame = 2000  # if the cpu can not keep up, the simulation slows down
+    max_frame_time = 1 / 60  # seconds of real time the physics may use per frame
 
-    def __init__(self):
+    def __init__(self, backend=None, integrator="leapfrog", solar_system=True, max_step=None):
+        """solar_system=False starts without any bodies.
+           max_step in years, default Game.max_step (1 day)"""
+        if max_step is not None:
+            self.max_step = max_step
+        self.objects = BodyStore()  # {number: CelestialBody}, also by name
+        self.removed = []  # numbers of removed bodies, not yet seen by the Viewer
+        self.i = 3
+        self.delta_t = Game.deltas[self.i][0] #1 / 365.25  # = 1 day
+        self.paused = False
+        if solar_system:
+            self.create_solar_system()
+        #self.timestep()
+        self.time = 0.0  # simulated years since start
+        self.accumulator = 0.0  # simulated years not yet integrated
+        self.particles = TestParticles()  # massless bodies, see add_particles
+        self.observers = []  # called with the game after every physics step, e.g. recorders
+        self.timer = None  # FrameTimer, books the phases of timestep when a Viewer runs
+        self.set_backend(backend)
+        self.set_integrator(integrator)
+
+    def create_solar_system(self):
         print("Planet system intitalized...")
         # sun , should be first object and NEEDS a velocity, even if 0
-        CelestialBody(name="sun" ,position=pygame.math.Vector3(0,0,0),
+        self.add_body(name="sun" ,position=pygame.math.Vector3(0,0,0),
                       velocity=pygame.math.Vector3(0,0,0),
                       mass=332937, radius= 695700/ AU_TO_KM,)
         # mercury
-        CelestialBody(name="mercury", position=pygame.math.Vector3(0.387098, 0, 0  ),
+        self.add_body(name="mercury", position=pygame.math.Vector3(0.387098, 0, 0  ),
                       mass=3.3011e23 / ME_TO_KG,
                       radius = 2439.7 / AU_TO_KM)
         # venus
-        CelestialBody(name="venus", position=pygame.math.Vector3(0.723332, 0, 0),
+        self.add_body(name="venus", position=pygame.math.Vector3(0.723332, 0, 0),
                       mass=4.8675e24 / ME_TO_KG,
                       radius=6051.8 / AU_TO_KM)
 
         # earth
-        CelestialBody(name="earth", position=pygame.math.Vector3(1,0,0),
+        self.add_body(name="earth", position=pygame.math.Vector3(1,0,0),
 
                       mass=1 ,radius = 6378.1 / AU_TO_KM)
                       #velocity=pygame.math.Vector3(0, -6.28,0),
         # mars
-        CelestialBody(name="mars", position=pygame.math.Vector3(1.523679,0,0),
+        self.add_body(name="mars", position=pygame.math.Vector3(1.523679,0,0),
                       mass=6.4171e23 / ME_TO_KG, radius=3389.5 / AU_TO_KM )
 
-        #self.timestep()
+    def add_body(self, **kwargs):
+        """create a CelestialBody in this game, see CelestialBody for the arguments"""
+        return CelestialBody(self, **kwargs)
+
+    def add_bodies(self, positions, velocities, masses, radii=None, names=None, bosses=None):
+        """create many CelestialBody objects at once from (N, 3) arrays
+           (AU, AU / year), without initialspeed and without printing.
+           radii (default 0), names and bosses (CelestialBody or None) are optional sequences.
+           Returns the list of new bodies"""
+        require_numpy("add_bodies")
+        n = len(masses)
+        bodies = []
+        for pos, vel, mass, radius, name, boss in zip(
+                map(pygame.math.Vector3, np.asarray(positions, dtype=float).reshape(-1, 3).tolist()),
+                map(pygame.math.Vector3, np.asarray(velocities, dtype=float).reshape(-1, 3).tolist()),
+                np.asarray(masses, dtype=float).tolist(), [0.0] * n if radii is None else radii,
+                [None] * n if names is None else names, [None] * n if bosses is None else bosses):
+            body = CelestialBody.__new__(CelestialBody)  # __init__ would compute and print the speed
+            body.game, body.mass, body.position, body.velocity = self, mass, pos, vel
+            body.radius, body.name, body.boss = radius, name, boss
+            self.objects.add(body)
+            bodies.append(body)
+        return bodies
+
+    def load_catalog(self, filename):
+        """add every body of a catalog file (see read_catalog). Rows with a
+           mass become CelestialBody objects, rows without test particles.
+           Orbits given as Keplerian elements are placed around their boss,
+           which may be a body of the same catalog.
+           Returns (number of new bodies, number of new test particles)"""
+        columns = read_catalog(filename)
+        n = len(next(iter(columns.values()), []))
+        if all(c in columns for c in STATE_COLUMNS):
+            use_elements = ~np.isfinite(columns["x"])  # rows without state vector
+        else:
+            use_elements = np.ones(n, dtype=bool)
+        if use_elements.any() and "a" not in columns:
+            raise ValueError("{}: every row needs the columns {} or at least 'a' of {}".format(
+                filename, ", ".join(STATE_COLUMNS), ", ".join(ELEMENT_COLUMNS)))
+        names = columns.get("name")
+        # incomplete orbits would put a body on its boss with a nan velocity, that spreads to every body
+        incomplete = use_elements & ~(columns["a"] > 0) if "a" in columns else np.zeros(n, dtype=bool)
+        if not use_elements.all():
+            incomplete |= ~use_elements & ~np.all([np.isfinite(columns[c]) for c in STATE_COLUMNS], axis=0)
+        if incomplete.any():
+            row = int(np.flatnonzero(incomplete)[0])
+            raise ValueError("{}: row {}{} needs either all of {} or a > 0".format(
+                filename, row + 1, " ({})".format(names[row]) if names is not None and names[row] else "",
+                ", ".join(STATE_COLUMNS)))
+        masses = np.nan_to_num(columns.get("mass", np.zeros(n)))
+        radii = columns.get("radius")
+        first = self.objects.at(0).name if len(self.objects) else None
+        bosses = columns.get("boss", np.full(n, "", dtype=object))
+        bosses = np.array([b or first for b in bosses], dtype=object)
+        todo = np.arange(n)
+        added = [0, 0]
+        while len(todo):
+            # a row can be placed as soon as its boss exists, bosses of the same catalog come first
+            known = np.array([b in self.objects if b is not None else not elements
+                              for b, elements in zip(bosses[todo], use_elements[todo])], dtype=bool)
+            if not known.any():
+                if bosses[todo[0]] is None:
+                    raise ValueError("{}: Keplerian elements need a boss, but there is no body yet".format(filename))
+                raise ValueError("{}: unknown boss {!r}".format(filename, bosses[todo[0]]))
+            ready, todo = todo[known], todo[~known]
+            positions, velocities = np.zeros((len(ready), 3)), np.zeros((len(ready), 3))
+            state = ~use_elements[ready]
+            if state.any():
+                positions[state] = np.column_stack([columns[c][ready[state]] for c in STATE_COLUMNS[:3]])
+                velocities[state] = np.column_stack([columns[c][ready[state]] for c in STATE_COLUMNS[3:]])
+            for name in set(bosses[ready[~state]].tolist()):
+                group = ~state & (bosses[ready] == name)
+                rows = ready[group]
+                boss = self.objects[name]
+                values = [np.nan_to_num(columns[c][rows]) if c in columns else np.zeros(len(rows))
+                          for c in ELEMENT_COLUMNS]
+                positions[group], velocities[group] = kepler_to_state(*values, GRAVCONST * (boss.mass + masses[rows]))
+                positions[group] += tuple(boss.position)
+                velocities[group] += tuple(boss.velocity)
+            massive = masses[ready] > 0
+            rows = ready[massive]
+            if len(rows):
+                self.add_bodies(positions[massive], velocities[massive], masses[rows],
+                                None if radii is None else np.nan_to_num(radii[rows]).tolist(),
+                                None if names is None else [name or None for name in names[rows].tolist()],
+                                [self.objects[b] if b is not None else None for b in bosses[rows].tolist()])
+                added[0] += len(rows)
+            rows = ready[~massive]
+            if len(rows):
+                self.particles.add(positions[~massive], velocities[~massive],
+                                   None if names is None else names[rows].tolist())
+                added[1] += len(rows)
+        return tuple(added)
+
+    @classmethod
+    def from_checkpoint(cls, filename):
+        """a new Game in the state of a checkpoint file (see Checkpointer).
+           Stepping on with the same integrator and step continues bit for bit
+           like the original run"""
+        return cls.from_state(*read_checkpoint(filename))
+
+    @classmethod
+    def from_state(cls, meta, arrays):
+        """a new Game from the (metadata, arrays) of checkpoint_state"""
+        game = cls(backend=None if np is None else "numpy", integrator=meta["integrator"], solar_system=False,
+                   max_step=meta.get("max_step"))
+        n = len(arrays["numbers"])
+        bodies = game.add_bodies(arrays["positions"][:n], arrays["velocities"][:n], arrays["masses"],
+                                 [None if r != r else r for r in arrays["radii"].tolist()], meta["names"])
+        game.objects = BodyStore()  # again, with the numbers of the checkpoint
+        for body, number in zip(bodies, arrays["numbers"].tolist()):
+            game.objects.next_number = number
+            game.objects.add(body)
+        game.objects.next_number = meta["next_number"]
+        for body, boss in zip(bodies, arrays["bosses"].tolist()):
+            body.boss = game.objects[boss] if boss >= 0 and boss in game.objects else None
+        if meta["particle_names"]:
+            game.particles.add(arrays["positions"][n:], arrays["velocities"][n:], meta["particle_names"])
+        game.time = meta["time"]
+        game.accumulator = meta["accumulator"]
+        game.i, game.delta_t, game.paused = meta["i"], meta["delta_t"], meta["paused"]
+        game.backend.sync()  # set_backend stores the old backend into the bodies first
+        game.set_backend(meta["backend"], **meta["backend_options"])
+        if meta["rk45_substep"] is not None:
+            game.backend.rk45_substep = meta["rk45_substep"]
+        if "cached_acc" in arrays:
+            acc = np.array(arrays["cached_acc"])
+            game.backend.cached_acc = [pygame.math.Vector3(a) for a in acc.tolist()] \
+                if isinstance(game.backend.positions, list) else acc
+        if meta.get("kepler_epoch") is not None:
+            game.backend.kepler = KeplerPropagator(game.backend, meta["kepler_epoch"],
+                                                   (arrays["kepler_positions"], arrays["kepler_velocities"]))
+            game.backend.kepler_last = (game.backend.version, game.time)
+        game.checkpoint_extra = meta["extra"]
+        return game
+
+    def seek(self, year):
+        """jump to year on the two-body orbits (see KeplerPropagator), without
+           integrating: year 3000 costs as much as tomorrow. Interactions
+           between the planets are left out, moons stay with their boss"""
+        self.backend.sync()
+        if not self.backend.numbers and not self.backend.n_particles:
+            self.time = year  # nothing to move
+            self.accumulator = 0.0
+            return
+        positions, velocities = KeplerPropagator(self.backend, self.time).state(year)
+        n = len(self.backend.numbers)
+        for number, pos, vel in zip(self.backend.numbers, positions.tolist(), velocities.tolist()):
+            body = self.objects[number]
+            body.position = pygame.math.Vector3(pos)
+            body.velocity = pygame.math.Vector3(vel)
+        self.particles.positions[:] = positions[n:]
+        self.particles.velocities[:] = velocities[n:]
+        self.time = year
+        self.accumulator = 0.0
+        self.backend.load()
+
+    def remove_body(self, body):
+        """take body out of the game. The backend reloads on the next sync
+           (unless its remove_bodies was called), a Viewer kills the sprite"""
+        self.objects.remove(body.number)
+        self.removed.append(body.number)
+
+    def set_timescale(self, i):
+        """select entry i of Game.deltas as simulated time per real second"""
+        self.i = minmax(i, 0, len(Game.deltas) - 1)
+        self.delta_t = Game.deltas[self.i][0]
+
+    def set_backend(self, backend=None, **options):
+        """select the gravity backend by name ("python", "numpy" or "barneshut").
+           None takes numpy if it is installed, otherwise the python reference loop.
+           options are passed to the backend, e.g. set_backend("barneshut", theta=0.7)"""
+        if backend is None:
+            backend = "numpy" if np is not None else "python"
+        if backend not in Game.backends:
+            raise ValueError("unknown backend {!r}, choose one of {}".format(backend, list(Game.backends)))
+        if hasattr(self, "backend"):
+            self.backend.store()  # bodies must be up to date before switching
+        self.backend = Game.backends[backend](self, **options)
+
+    def add_particles(self, positions, velocities=None, names=None, boss=None):
+        """add massless test particles (asteroids, comets, spacecraft) in one batch,
+           see TestParticles.add. boss defaults to the first object, the sun"""
+        if velocities is None and boss is None:
+            if 0 not in self.objects:
+                raise ValueError("test particles without velocities circle the sun (body 0), the game has none")
+            boss = self.objects[0]  # first object should be the sun
+        self.particles.add(positions, velocities, names, boss)
+
+    def set_integrator(self, integrator="leapfrog"):
+        """select the integrator by name: "trapezoid" (the original update rule),
+           "leapfrog", "yoshida4", "rk45", "block" (block time steps) or
+           "kepler" (two-body orbits around the boss, no integration)"""
+        if integrator not in Game.integrators:
+            raise ValueError("unknown integrator {!r}, choose one of {}".format(integrator, list(Game.integrators)))
+        self.integrator = integrator
+
+    def step_size(self):
+        """fixed physics step in years. It depends only on the timescale
+           (delta_t), never on the frame rate"""
+        return min(self.delta_t / self.physics_rate, self.max_step)
 
     def timestep(self, seconds):
+        """advance the simulation by seconds of real time (delta_t years per second).
+           The time is collected in an accumulator and integrated in fixed
+           steps of step_size(), the remainder waits for the next frame.
+           Stepping stops after max_frame_time seconds of real time (at least
+           one step is made), the backlog is then dropped and the simulation
+           runs slower than delta_t instead of spiralling"""
         if self.paused:
             return
-        for a in Game.objects.values():
-            acc = pygame.Vector3(0,0,0)
-            for b in Game.objects.values():
-                if a == b:
-                    continue
-                #distance_vector = a.position - b.position # vec3
-                distance_vector = b.position - a.position
-                acc +=  b.mass / distance_vector.length()**3 * distance_vector # vec3
-            acc *= GRAVCONST
-            #a.position += self.delta_t * seconds *  (a.velocity + acc * self.delta_t * seconds /2)
-            a.velocity_new = a.velocity  + acc * self.delta_t * seconds
-            a.position_new = a.position + self.delta_t * seconds *  (a.velocity + a.velocity_new) /2
-        for a in Game.objects.values():
-            a.velocity = a.velocity_new
-            a.position = a.position_new
+        timer = self.timer
+        self.backend.sync()
+        if timer is not None:
+            timer.mark("sync")
+        self.accumulator += self.delta_t * seconds
+        h = self.step_size()
+        wanted = int(self.accumulator / h + 1e-9)
+        deadline = time.perf_counter() + self.max_frame_time
+        steps = 0
+        while steps < min(wanted, self.max_steps_per_frame):
+            self.integrate(h, 1)
+            steps += 1
+            if time.perf_counter() >= deadline:
+                break
+        if steps < wanted:
+            self.accumulator = 0.0  # drop the backlog instead of spiralling
+        else:
+            self.accumulator = max(0.0, self.accumulator - steps * h)
+        if timer is not None:
+            timer.mark("integrate")
+        if steps:
+            self.backend.store()
+        if timer is not None:
+            timer.mark("store")
+
+    def advance(self, years, step=None):
+        """integrate years of simulated time as fast as the cpu allows, no frame
+           rate involved. step is the fixed step in years (default max_step),
+           a shorter last step hits years exactly. Returns the number of steps"""
+        if step is None:
+            step = self.max_step
+        self.backend.sync()
+        end = self.time + years
+        steps = int(years / step + 1e-9)
+        self.integrate(step, steps)
+        rest = years - steps * step
+        if rest > 1e-9 * step:
+            self.integrate(rest, 1)
+            steps += 1
+        self.time = end  # no rounding drift from summing the steps
+        self.backend.store()
+        return steps
+
+    def integrate(self, h, steps):
+        """make steps integrator steps of h years, calling the observers after each"""
+        integrate = Game.integrators[self.integrator]
+        for _ in range(steps):
+            integrate(self.backend, h)
+            self.time += h
+            for observer in self.observers:
+                observer(self)
+
+
+
+class BodyStore:
+    """the bodies of one Game in insertion order.
+       store[number] gives a body by its number, store["earth"] by its name,
+       store.at(index) by its position in the order the backends use.
+       Behaves like the dict {number: body} otherwise"""
+
+    def __init__(self):
+        self.bodies = {}  # {number: body}
+        self.names = {}  # {name: number}
+        self.order = []  # the bodies in insertion order, for at(). None: removed
+        self.rows = {}  # {number: index in order}
+        self.holes = 0  # removed bodies still in order
+        self.next_number = 0
+
+    def add(self, body):
+        """give body the next free number and insert it"""
+        body.number = self.next_number
+        self.next_number += 1
+        if body.name is None:
+            body.name = "planet_{}".format(body.number)
+        self.bodies[body.number] = body
+        self.names[body.name] = body.number
+        self.rows[body.number] = len(self.order)
+        self.order.append(body)
 
+    def remove(self, number):
+        """O(1): the gap in order is closed by the next at()"""
+        body = self.bodies.pop(number)
+        if self.names.get(body.name) == number:
+            del self.names[body.name]
+        self.order[self.rows.pop(number)] = None
+        self.holes += 1
+        return body
+
+    def at(self, index):
+        if self.holes:
+            self.order = list(self.bodies.values())
+            self.rows = {body.number: i for i, body in enumerate(self.order)}
+            self.holes = 0
+        return self.order[index]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.bodies[self.names[key]]
+        return self.bodies[key]
+
+    def __contains__(self, key):
+        if isinstance(key, str):
+            return key in self.names
+        return key in self.bodies
+
+    def __len__(self):
+        return len(self.bodies)
+
+    def __iter__(self):
+        return iter(self.bodies)
+
+    def keys(self):
+        return self.bodies.keys()
+
+    def values(self):
+        return self.bodies.values()
+
+    def items(self):
+        return self.bodies.items()
 
 
 class CelestialBody:
+    """a massive body. It registers itself in game.objects"""
 
-    number = 0
+    __slots__ = ("game", "number", "name", "mass", "radius", "boss", "position", "velocity")
 
-    def __init__(self, mass=1,
+    def __init__(self, game, mass=1,
                  position=pygame.math.Vector3(1,0,0),
                  velocity=None, boss=None, radius=None, name=None):
+        self.game = game
         self.mass = mass # earth units
-        self.position = position # astronomical units (sol->earth distance)
+        self.position = pygame.math.Vector3(position) # astronomical units (sol->earth distance)
         self.velocity = velocity # astronomical units per year
         self.boss = boss
         self.name = name
 
         if self.velocity is None:
             if boss is None:
-                self.boss = Game.objects[0]  # first object should be the sun
+                self.boss = game.objects[0]  # first object should be the sun
             boss_to_me = self.position - self.boss.position
             distance = boss_to_me.length()
             angle = boss_to_me.angle_to(pygame.math.Vector3(1,0,0))
@@ -212,32 +640,2417 @@ class CelestialBody:
             # real planets circle counterclockwise
             # because pygames coordinate-system is flipped (y goes down positive),
             # math.cos is here with negative sign
+            # moons move along with their boss
             self.velocity = pygame.math.Vector3(-speed * math.sin(angle * GRAD_TO_RAD),
-                                                -speed * math.cos(angle * GRAD_TO_RAD),0)
+                                                -speed * math.cos(angle * GRAD_TO_RAD),0) + self.boss.velocity
             print(self.name, speed)
-        self.position_new = None
-        self.velocity_new = None
+        else:
+            self.velocity = pygame.math.Vector3(velocity)
+
+        self.radius = radius
+
+        # automatically assign a number and insert into game.objects
+        game.objects.add(self)
+
+
+def direct_accelerations(positions, masses, targets=None, chunk_size=128, points=None):
+    """all-pairs gravity with numpy.
+       returns an (len(targets), 3) array with the acceleration in AU / a² that
+       all bodies exert on each target (default: on every body).
+       With points (an (M, 3) array), the accelerations at those points are
+       returned instead, e.g. for massless test particles.
+       targets are processed in blocks of about chunk_size² pairs, small
+       enough to stay in the cpu cache whatever the number of sources.
+       The x, y and z distances are separate contiguous (targets, sources)
+       arrays, which is about three times faster than (targets, sources, 3)"""
+    rows = max(1, chunk_size * chunk_size // max(len(positions), 1))
+    if points is None:
+        points = positions
+        if targets is None:
+            targets = np.arange(len(positions))
+    elif targets is None:
+        targets = np.arange(len(points))
+    x, y, z = np.ascontiguousarray(np.asarray(positions, dtype=float).T)
+    acc = np.zeros((len(targets), 3))
+    for start in range(0, len(targets), rows):
+        block = points[targets[start:start + rows]]
+        # distances from each target in this block to every body
+        dx = x[np.newaxis, :] - block[:, 0:1]
+        dy = y[np.newaxis, :] - block[:, 1:2]
+        dz = z[np.newaxis, :] - block[:, 2:3]
+        r2 = dx * dx
+        r2 += dy * dy
+        r2 += dz * dz
+        r2[r2 == 0] = np.inf  # no self force
+        w = np.sqrt(r2)
+        w *= r2
+        np.divide(masses, w, out=w)  # m / r³, faster than r2 ** -1.5
+        stop = start + len(block)
+        acc[start:stop, 0] = np.einsum("ij,ij->i", w, dx)
+        acc[start:stop, 1] = np.einsum("ij,ij->i", w, dy)
+        acc[start:stop, 2] = np.einsum("ij,ij->i", w, dz)
+    return acc * GRAVCONST
+
+
+def total_energy(positions, velocities, masses, chunk_size=512):
+    """kinetic plus potential energy of a system in earth masses * AU² / a².
+       The potential is summed over pairs of massive bodies in blocks of
+       about chunk_size² pairs, bodies with mass 0 (test particles) add nothing"""
+    kinetic = 0.5 * float(np.sum(masses * np.einsum("ij,ij->i", velocities, velocities)))
+    massive = masses > 0
+    positions, masses = positions[massive], masses[massive]
+    n = len(masses)
+    rows = max(1, chunk_size * chunk_size // max(n, 1))
+    potential = 0.0
+    for start in range(0, n, rows):
+        stop = min(start + rows, n)
+        d = positions[np.newaxis, :, :] - positions[start:stop, np.newaxis, :]
+        r = np.sqrt(np.einsum("ijk,ijk->ij", d, d))
+        upper = np.arange(n)[np.newaxis, :] > np.arange(start, stop)[:, np.newaxis]  # each pair once
+        potential -= float(np.sum(np.where(upper, masses[start:stop, np.newaxis] * masses[np.newaxis, :]
+                                           / np.where(upper, r, 1.0), 0.0)))
+    return kinetic + GRAVCONST * potential
+
+
+def angular_momentum(positions, velocities, masses):
+    """total angular momentum vector (3,) in earth masses * AU² / a"""
+    return np.sum(masses[:, np.newaxis] * np.cross(positions, velocities), axis=0)
+
+
+def _spread_bits(x):
+    """inserts two zero bits between each of the lower 21 bits of x (uint64 array)"""
+    x = x & np.uint64(0x1fffff)
+    x = (x | x << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    x = (x | x << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    x = (x | x << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    x = (x | x << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return x
+
+
+def _ranges(starts, counts):
+    """concatenation of range(start, start+count) for every pair, as one array"""
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets
+
+
+class Octree:
+    """Barnes-Hut octree over point masses, built without python recursion:
+       the bodies are sorted along a morton (z-order) curve, so every cell is
+       a contiguous slice of the sorted bodies and one tree level is built
+       with a handful of numpy operations.
+       Cells with at most leaf_size bodies (or at the deepest level) are leaves.
+       All nodes of all levels live in flat arrays, the root is node 0."""
+
+    depth = 21  # 3 * 21 bits fit into one uint64 morton code
+
+    def __init__(self, positions, masses, leaf_size=8):
+        self.positions = positions
+        n = len(positions)
+        self.lo = lo = positions.min(axis=0)
+        self.size = max(float((positions.max(axis=0) - lo).max()), 1e-12) * (1 + 1e-9) # edge of root cube
+        cells = 2 ** Octree.depth
+        q = np.clip(((positions - lo) / self.size * cells).astype(np.int64), 0, cells - 1)
+        qu = q.astype(np.uint64)
+        codes = _spread_bits(qu[:, 0]) | _spread_bits(qu[:, 1]) << np.uint64(1) | _spread_bits(qu[:, 2]) << np.uint64(2)
+        self.order = np.argsort(codes, kind="stable")
+        codes = codes[self.order]
+        q = q[self.order]
+        self.sorted_positions = positions[self.order]
+        self.sorted_masses = masses[self.order]
+        weighted = self.sorted_positions * self.sorted_masses[:, np.newaxis]
+
+        # ---- root ----
+        total = self.sorted_masses.sum()
+        starts, counts, masses_, coms, edges, centers = [np.array([0])], [np.array([n])], [np.array([total])], [], [], []
+        coms.append((weighted.sum(axis=0) / total if total > 0 else positions.mean(axis=0))[np.newaxis, :])
+        edges.append(np.array([self.size]))
+        centers.append((lo + self.size / 2)[np.newaxis, :])
+        first_child = [np.array([-1])]
+        child_count = [np.array([0])]
+        level_offset = 0  # node id of the first node of the current level
+        level_nodes = 1
+        for level in range(1, Octree.depth + 1):
+            split = np.flatnonzero(counts[-1] > leaf_size)
+            if len(split) == 0:
+                break
+            parent_start, parent_count = starts[-1][split], counts[-1][split]
+            idx = _ranges(parent_start, parent_count)
+            keys = codes[idx] >> np.uint64(3 * (Octree.depth - level))
+            new_run = np.ones(len(idx), dtype=bool)
+            new_run[1:] = keys[1:] != keys[:-1]
+            run = np.flatnonzero(new_run)
+            c_start = idx[run]
+            c_count = np.diff(np.append(run, len(idx)))
+            parent = np.repeat(np.arange(len(split)), parent_count)[run]
+            n_children = np.bincount(parent, minlength=len(split))
+            child_offset = level_offset + level_nodes
+            first_child[-1][split] = child_offset + np.cumsum(n_children) - n_children
+            child_count[-1][split] = n_children
+            # ---- mass and center of mass of the new cells ----
+            c_mass = np.add.reduceat(self.sorted_masses[idx], run)
+            c_weighted = np.add.reduceat(weighted[idx], run, axis=0)
+            edge = self.size / 2 ** level
+            c_center = lo + ((q[c_start] >> (Octree.depth - level)) + 0.5) * edge
+            with np.errstate(invalid="ignore", divide="ignore"):
+                c_com = np.where(c_mass[:, np.newaxis] > 0, c_weighted / c_mass[:, np.newaxis], c_center)
+            starts.append(c_start)
+            counts.append(c_count)
+            masses_.append(c_mass)
+            coms.append(c_com)
+            edges.append(np.full(len(run), edge))
+            centers.append(c_center)
+            first_child.append(np.full(len(run), -1))
+            child_count.append(np.zeros(len(run), dtype=np.int64))
+            level_offset = child_offset
+            level_nodes = len(run)
+        self.start = np.concatenate(starts)
+        self.count = np.concatenate(counts)
+        self.mass = np.concatenate(masses_)
+        self.com = np.concatenate(coms)
+        self.edge = np.concatenate(edges)
+        self.center = np.concatenate(centers)
+        self.first_child = np.concatenate(first_child)
+        self.child_count = np.concatenate(child_count)
+        self.is_leaf = self.first_child < 0
+
+    def accelerations(self, theta=0.5, targets=None, chunk_size=16384, points=None, group_size=32,
+                      block_pairs=1 << 16):
+        """returns an (len(targets), 3) array with the acceleration in AU / a²
+           on each target body (indices into the original positions, default all).
+           With points (an (M, 3) array), targets index into points instead,
+           e.g. for massless test particles that are not part of the tree.
+           The targets are sorted along the morton curve and walk the tree in
+           groups of group_size neighbours: a cell is used as one point mass
+           for the whole group when edge / distance < theta, with the distance
+           from its center of mass to the bounding box of the group, and the
+           box lies outside of it. The bodies of the other leaves are summed
+           one by one. chunk_size targets walk the tree together, the forces
+           are summed in blocks of about block_pairs (target, source) pairs."""
+        if points is None:
+            points = self.positions
+        if targets is None:
+            targets = np.arange(len(points))
+        acc = np.zeros((len(targets), 3))
+        if len(targets) == 0:
+            return acc
+        # ---- groups of neighbouring targets ----
+        cells = 2 ** Octree.depth
+        q = np.clip(((points[targets] - self.lo) / self.size * cells).astype(np.int64), 0, cells - 1).astype(np.uint64)
+        order = np.argsort(_spread_bits(q[:, 0]) | _spread_bits(q[:, 1]) << np.uint64(1)
+                           | _spread_bits(q[:, 2]) << np.uint64(2), kind="stable")
+        order = np.append(order, np.repeat(order[-1], -len(order) % group_size))  # fill the last group
+        # every source is a node (its center of mass) or, after the nodes, a body
+        n_nodes = len(self.mass)
+        source_mass = np.concatenate((self.mass, self.sorted_masses))
+        source_pos = np.concatenate((self.com, self.sorted_positions)).T.copy()  # x, y, z rows
+        for start in range(0, len(order), chunk_size):
+            rows = order[start:start + chunk_size]  # rows of acc, group by group
+            pos = points[targets[rows]].reshape(-1, group_size, 3)
+            box_lo, box_hi = pos.min(axis=1), pos.max(axis=1)
+            sources = self._interactions(theta, box_lo, box_hi)
+            group_acc = np.zeros(pos.shape)
+            self._sum_blocks(group_acc, pos, sources, source_mass, source_pos, n_nodes, block_pairs)
+            acc[rows] = group_acc.reshape(-1, 3)  # the filled rows get the same value twice
+        return acc * GRAVCONST
+
+    def _interactions(self, theta, box_lo, box_hi):
+        """walks the tree for every group (bounding box) at once, level by level.
+           Returns (groups, source ids) sorted by group: far nodes by their
+           node id, the bodies of near leaves by len(self.mass) + body index"""
+        groups = np.arange(len(box_lo))
+        nodes = np.zeros(len(box_lo), dtype=np.int64)
+        found_groups, found_sources = [], []
+        while len(groups):
+            com, half, center = self.com[nodes], self.edge[nodes] / 2, self.center[nodes]
+            lo, hi = box_lo[groups], box_hi[groups]
+            gap = np.maximum(lo - com, 0) + np.maximum(com - hi, 0)  # center of mass to the box
+            r2 = np.einsum("ij,ij->i", gap, gap)
+            outside = np.any((lo > center + half[:, np.newaxis]) | (hi < center - half[:, np.newaxis]), axis=1)
+            far = outside & (self.edge[nodes] ** 2 < theta ** 2 * r2)
+            found_groups.append(groups[far])
+            found_sources.append(nodes[far])
+            # ---- near leaves: their bodies one by one ----
+            leaf = ~far & self.is_leaf[nodes]
+            n_members = self.count[nodes[leaf]]
+            found_groups.append(np.repeat(groups[leaf], n_members))
+            found_sources.append(len(self.mass) + _ranges(self.start[nodes[leaf]], n_members))
+            # ---- other near cells are opened ----
+            near = ~far & ~leaf
+            n_children = self.child_count[nodes[near]]
+            groups = np.repeat(groups[near], n_children)
+            nodes = _ranges(self.first_child[nodes[near]], n_children)
+        groups = np.concatenate(found_groups)
+        by_group = np.argsort(groups, kind="stable")
+        return groups[by_group], np.concatenate(found_sources)[by_group]
+
+    @staticmethod
+    def _sum_blocks(acc, pos, sources, source_mass, source_pos, n_nodes, block_pairs):
+        """acc[group, k] += sum over the sources of the group of m * d / r³.
+           Groups with about the same number of sources are summed together
+           as dense (groups, group_size, sources) blocks"""
+        groups, ids = sources
+        n_groups, group_size = pos.shape[:2]
+        counts = np.bincount(groups, minlength=n_groups)
+        first = np.cumsum(counts) - counts
+        by_count = np.argsort(counts, kind="stable")
+        i = 0
+        while i < n_groups:
+            width = max(int(counts[by_count[i]]), 1)
+            j = min(i + max(1, block_pairs // (group_size * width)), n_groups)
+            width = max(int(counts[by_count[j - 1]]), 1)  # the widest group of the block
+            j = min(i + max(1, block_pairs // (group_size * width)), j)
+            width = max(int(counts[by_count[j - 1]]), 1)
+            block = by_count[i:j]
+            column = np.arange(width)
+            index = np.minimum(first[block, np.newaxis] + column, len(ids) - 1)
+            source = ids[index]
+            mass = np.where(column < counts[block, np.newaxis], source_mass[source], 0.0)
+            tpos = pos[block]
+            dx = source_pos[0][source][:, np.newaxis, :] - tpos[:, :, 0, np.newaxis]
+            dy = source_pos[1][source][:, np.newaxis, :] - tpos[:, :, 1, np.newaxis]
+            dz = source_pos[2][source][:, np.newaxis, :] - tpos[:, :, 2, np.newaxis]
+            r3 = dx * dx
+            r3 += dy * dy
+            r3 += dz * dz
+            r3[r3 == 0] = np.inf  # no self force
+            r3 *= np.sqrt(r3)  # sqrt and divide are much faster than ** -1.5
+            w = mass[:, np.newaxis, :] / r3
+            acc[block, :, 0] += np.einsum("gts,gts->gt", w, dx)
+            acc[block, :, 1] += np.einsum("gts,gts->gt", w, dy)
+            acc[block, :, 2] += np.einsum("gts,gts->gt", w, dz)
+            i = j
+
+
+class TestParticles:
+    """massless bodies like asteroids, comets or spacecraft.
+       They feel the gravity of every CelestialBody but pull on nothing, so
+       they cost O(N_massive) each instead of O(N).
+       All particles of a Game are stored together in (N, 3) numpy arrays
+       (astronomical units and astronomical units per year)."""
+
+    def __init__(self):
+        self.names = []
+        if np is not None:
+            self.positions = np.zeros((0, 3))
+            self.velocities = np.zeros((0, 3))
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, positions, velocities=None, names=None, boss=None):
+        """add a batch of particles. positions is an (N, 3) array like.
+           Without velocities every particle gets the circular speed
+           around boss (a CelestialBody), counterclockwise on screen like the planets"""
+        require_numpy("test particles")
+        positions = np.array(positions, dtype=float).reshape(-1, 3)
+        if velocities is None:
+            offset = positions - np.array(tuple(boss.position))
+            distance = np.linalg.norm(offset, axis=1)
+            planar = np.maximum(np.hypot(offset[:, 0], offset[:, 1]), 1e-300)
+            speed = initialspeed(distance, boss.mass)
+            velocities = np.column_stack((speed * offset[:, 1] / planar, -speed * offset[:, 0] / planar,
+                                          np.zeros(len(positions)))) + np.array(tuple(boss.velocity))
+        velocities = np.array(velocities, dtype=float).reshape(-1, 3)
+        if names is None:
+            names = ["particle_{}".format(i) for i in range(len(self), len(self) + len(positions))]
+        self.positions = np.concatenate((self.positions, positions))
+        self.velocities = np.concatenate((self.velocities, velocities))
+        self.names.extend(names)
+
+
+# ------------------------- catalog files ------------------------------------
+# A catalog holds one body per row, as csv (with a header line), json (a list
+# of objects, {"bodies": [...]} or {column: [values]}), npz (one array per
+# column) or npy (structured array). Columns, all optional except the orbit:
+#   name, boss (name of the central body), mass (earth masses, 0 or missing:
+#   test particle), radius (AU) and either the state vector
+#   x, y, z (AU), vx, vy, vz (AU / year) or the Keplerian elements
+#   a (AU), e, i, node, periapsis, anomaly (mean anomaly, all angles in degrees)
+#   relative to the boss (default: the first body, the sun).
+# Other columns (comments, catalog numbers, ...) are ignored
+
+TEXT_COLUMNS = ("name", "boss")
+STATE_COLUMNS = ("x", "y", "z", "vx", "vy", "vz")
+ELEMENT_COLUMNS = ("a", "e", "i", "node", "periapsis", "anomaly")
+CATALOG_COLUMNS = TEXT_COLUMNS + ("mass", "radius") + STATE_COLUMNS + ELEMENT_COLUMNS
+
+
+def _catalog_column(values, name):
+    if name in TEXT_COLUMNS:
+        return np.array([v.strip() if isinstance(v, str) else ("" if v is None else str(v)) for v in values],
+                        dtype=object)
+    try:
+        return np.array(values, dtype=float)
+    except (TypeError, ValueError):  # empty cells
+        return np.array([v if v not in ("", None) else "nan" for v in values], dtype=float)
+
+
+def read_catalog(filename, chunk_rows=100000):
+    """reads a catalog file into {column: numpy array}, column names in lower
+       case, only the CATALOG_COLUMNS. csv files are parsed in chunks of chunk_rows rows"""
+    require_numpy("catalogs")
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".npz":
+        with np.load(filename, allow_pickle=False) as data:
+            return {key.lower(): _catalog_column(data[key], key.lower()) for key in data.files
+                    if key.lower() in CATALOG_COLUMNS}
+    if extension == ".npy":
+        data = np.load(filename, allow_pickle=False)
+        return {key.lower(): _catalog_column(data[key], key.lower()) for key in data.dtype.names
+                if key.lower() in CATALOG_COLUMNS}
+    if extension == ".json":
+        with open(filename) as f:
+            data = json.load(f)
+        if isinstance(data, dict) and "bodies" in data:
+            data = data["bodies"]
+        if isinstance(data, dict):  # {column: [values]}
+            return {key.lower(): _catalog_column(values, key.lower()) for key, values in data.items()
+                    if key.lower() in CATALOG_COLUMNS}
+        keys = [key for key in dict.fromkeys(key for row in data for key in row) if key.lower() in CATALOG_COLUMNS]
+        return {key.lower(): _catalog_column([row.get(key) for row in data], key.lower()) for key in keys}
+    with open(filename, newline="") as f:
+        reader = csv.reader(f)
+        header = [name.strip().lower() for name in next(reader)]
+        chunks = {name: [] for name in header if name in CATALOG_COLUMNS}
+
+        def convert(rows):
+            for name, values in zip(header, zip(*rows)):
+                if name in chunks:
+                    chunks[name].append(_catalog_column(values, name))
+
+        rows = []
+        for row in reader:
+            if not row:
+                continue  # empty line
+            if len(row) != len(header):
+                raise ValueError("{}: line {} has {} values, the header has {}".format(
+                    filename, reader.line_num, len(row), len(header)))
+            rows.append(row)
+            if len(rows) == chunk_rows:
+                convert(rows)
+                rows = []
+        if rows:
+            convert(rows)
+    return {name: np.concatenate(parts) if parts else _catalog_column([], name) for name, parts in chunks.items()}
+
+
+def kepler_to_state(a, e, inclination, node, periapsis, anomaly, mu):
+    """positions and velocities (N, 3) relative to the central body for
+       elliptic orbits. a in AU, angles in degrees, anomaly is the mean
+       anomaly, mu = G * (M + m) in AU³ / a². Like the planets of
+       create_solar_system, y points down the screen, so prograde orbits look
+       counterclockwise there"""
+    a, e, mu = np.asarray(a, dtype=float), np.asarray(e, dtype=float), np.asarray(mu, dtype=float)
+    if np.any((e < 0) | (e >= 1)):
+        raise ValueError("only elliptic orbits (0 <= e < 1) are supported")
+    i, node, periapsis, mean = (np.radians(np.asarray(angle, dtype=float))
+                                for angle in (inclination, node, periapsis, anomaly))
+    E = solve_kepler(mean, e)
+    cos_e, sin_e = np.cos(E), np.sin(E)
+    root = np.sqrt(1 - e * e)
+    r = a * (1 - e * cos_e)
+    speed = np.sqrt(mu * a) / r
+    x, y = a * (cos_e - e), a * root * sin_e  # in the orbital plane
+    vx, vy = -speed * sin_e, speed * root * cos_e
+    cos_o, sin_o, cos_w, sin_w, cos_i, sin_i = (np.cos(node), np.sin(node), np.cos(periapsis),
+                                                np.sin(periapsis), np.cos(i), np.sin(i))
+    p = np.column_stack((cos_o * cos_w - sin_o * sin_w * cos_i, sin_o * cos_w + cos_o * sin_w * cos_i, sin_w * sin_i))
+    q = np.column_stack((-cos_o * sin_w - sin_o * cos_w * cos_i, -sin_o * sin_w + cos_o * cos_w * cos_i, cos_w * sin_i))
+    positions = x[:, np.newaxis] * p + y[:, np.newaxis] * q
+    velocities = vx[:, np.newaxis] * p + vy[:, np.newaxis] * q
+    positions[:, 1] *= -1  # screen coordinates
+    velocities[:, 1] *= -1
+    return positions, velocities
+
+
+# ------------------------- analytic Kepler orbits ----------------------------
+
+def solve_kepler(mean, e):
+    """batched Newton solution of Kepler's equation: the eccentric anomaly E
+       with E - e sin E = mean where e < 1, the hyperbolic anomaly F with
+       e sinh F - F = mean where e > 1"""
+    hyperbolic = e > 1
+    mean = np.where(hyperbolic, mean, np.remainder(mean + np.pi, 2 * np.pi) - np.pi)
+    x = np.where(hyperbolic, np.arcsinh(mean / np.maximum(e, 1)), np.where(e < 0.8, mean, np.where(mean < 0, -np.pi, np.pi)))
+    for _ in range(60):
+        with np.errstate(over="ignore", invalid="ignore"):
+            delta = np.where(hyperbolic, (e * np.sinh(x) - x - mean) / (e * np.cosh(x) - 1),
+                             (x - e * np.sin(x) - mean) / (1 - e * np.cos(x)))
+        delta = np.nan_to_num(delta)
+        x = x - delta
+        if np.all(np.abs(delta) <= 1e-15 * np.maximum(1, np.abs(x))):
+            break
+    return x
+
+
+class KeplerOrbits:
+    """fixed two-body orbits of many bodies around their centres (ellipses
+       and hyperbolas). The state vectors (N, 3), relative to the centres, are
+       turned into orbital elements once, state(t) then solves Kepler's
+       equation for all of them at once: any time costs the same"""
+
+    def __init__(self, positions, velocities, mu, epoch=0.0):
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        velocities = np.asarray(velocities, dtype=float).reshape(-1, 3)
+        self.mu = np.broadcast_to(np.asarray(mu, dtype=float), (len(positions),))
+        self.epoch = epoch
+        r = np.linalg.norm(positions, axis=1)
+        h = np.cross(positions, velocities)
+        h_length = np.linalg.norm(h, axis=1)
+        self.a = 1 / (2 / r - np.einsum("ij,ij->i", velocities, velocities) / self.mu)  # < 0 for hyperbolas
+        eccentricity = np.cross(velocities, h) / self.mu[:, np.newaxis] - positions / r[:, np.newaxis]
+        self.e = np.linalg.norm(eccentricity, axis=1)
+        self.e = np.where(np.abs(self.e - 1) < 1e-12, np.where(self.a > 0, 1 - 1e-12, 1 + 1e-12), self.e)  # no parabolas
+        # p points to the periapsis (or to the body itself on a circle), q 90° ahead of it
+        circle = self.e < 1e-12
+        self.p = np.where(circle[:, np.newaxis], positions / r[:, np.newaxis],
+                          eccentricity / np.maximum(self.e, 1e-300)[:, np.newaxis])
+        # radial orbits (straight towards or away from the centre) have no plane, any normal will do
+        radial = h_length <= 1e-12 * r * np.linalg.norm(velocities, axis=1)
+        normal = h / np.where(radial, 1.0, h_length)[:, np.newaxis]
+        if radial.any():
+            normal[radial] = np.cross(self.p[radial], (0.0, 0.0, 1.0))
+            flat = radial & (np.linalg.norm(normal, axis=1) < 1e-6)  # p along the z axis
+            normal[flat] = np.cross(self.p[flat], (1.0, 0.0, 0.0))
+            normal[radial] /= np.linalg.norm(normal[radial], axis=1)[:, np.newaxis]
+        self.q = np.cross(normal, self.p)
+        x, y = np.einsum("ij,ij->i", positions, self.p), np.einsum("ij,ij->i", positions, self.q)
+        size = np.abs(self.a)
+        self.n = np.sqrt(self.mu / size ** 3)  # mean motion
+        self.root = np.where(radial, 0.0, np.sqrt(np.abs(1 - self.e ** 2)))  # a radial orbit has no width
+        hyperbolic = self.e > 1
+        with np.errstate(invalid="ignore", divide="ignore"):
+            anomaly = np.where(hyperbolic, np.arcsinh(y / (size * self.root)),
+                               np.arctan2(y / (size * self.root), x / size + self.e))
+        if radial.any():  # y is 0, the anomaly comes from r . v instead
+            k = radial
+            rv = np.einsum("ij,ij->i", positions[k], velocities[k]) / np.sqrt(self.mu[k] * size[k])
+            anomaly[k] = np.where(hyperbolic[k], np.arcsinh(rv / self.e[k]), np.arctan2(rv, 1 - r[k] / size[k]))
+        self.mean = np.where(hyperbolic, self.e * np.sinh(anomaly) - anomaly, anomaly - self.e * np.sin(anomaly))
+
+    def __len__(self):
+        return len(self.a)
+
+    def state(self, t):
+        """positions and velocities (N, 3) relative to the centres at time t"""
+        anomaly = solve_kepler(self.mean + self.n * (t - self.epoch), self.e)
+        hyperbolic = self.e > 1
+        size = np.abs(self.a)
+        with np.errstate(over="ignore"):
+            cos_x = np.where(hyperbolic, np.cosh(anomaly), np.cos(anomaly))
+            sin_x = np.where(hyperbolic, np.sinh(anomaly), np.sin(anomaly))
+        x = np.where(hyperbolic, size * (self.e - cos_x), size * (cos_x - self.e))
+        y = size * self.root * sin_x
+        r = np.where(hyperbolic, size * (self.e * cos_x - 1), size * (1 - self.e * cos_x))
+        speed = np.sqrt(self.mu * size) / r
+        vx, vy = -speed * sin_x, speed * self.root * cos_x
+        positions = x[:, np.newaxis] * self.p + y[:, np.newaxis] * self.q
+        velocities = vx[:, np.newaxis] * self.p + vy[:, np.newaxis] * self.q
+        return positions, velocities
+
+
+class KeplerPropagator:
+    """analytic two-body motion of everything in a backend: every body moves on
+       the fixed Kepler orbit around its boss (mu = G * (M + m)), moons around
+       the moving boss, bodies without boss and test particles around the
+       first body (the sun), which moves in a straight line. Built once from the state at
+       time, state(t) is then a jump to any year without integrating.
+       It is also the unperturbed baseline: deviations() shows how far the
+       integrated bodies are pulled away from their two-body orbits.
+       state is (positions, velocities) at time instead of the backend state,
+       e.g. the epoch_state of a checkpoint"""
+
+    def __init__(self, backend, time=0.0, state=None):
+        require_numpy("the Kepler propagator")
+        self.epoch = time
+        positions, velocities = state_arrays(backend) if state is None else state
+        self.epoch_state = positions.copy(), velocities.copy()
+        game = backend.game
+        numbers = backend.numbers
+        row = {number: i for i, number in enumerate(numbers)}
+        bodies = [game.objects[number] for number in numbers]
+        masses = np.zeros(len(positions))
+        masses[:len(bodies)] = [b.mass for b in bodies]
+        # bodies without boss (or whose boss is gone) and test particles circle the first body, like in block_rungs
+        boss = np.array([row.get(b.boss.number, 0) if b.boss is not None else 0 for b in bodies] +
+                        [0 if bodies else -1] * (len(positions) - len(bodies)), dtype=int)
+        boss[boss == np.arange(len(boss))] = -1  # the first body (and nothing else) is its own boss
+        # bosses come before their moons in self.levels
+        level = np.where(boss < 0, 0, -1)
+        for depth in range(1, len(bodies) + 1):
+            todo = (level < 0) & (level[np.maximum(boss, 0)] == depth - 1) & (boss >= 0)
+            if not todo.any():
+                break
+            level[todo] = depth
+        level[level < 0] = 0  # boss cycles: these move in a straight line
+        boss[level == 0] = -1
+        self.boss = boss
+        self.levels = [np.flatnonzero(level == depth) for depth in range(1, level.max(initial=0) + 1)]
+        self.free = np.flatnonzero(boss < 0)
+        self.start = positions[self.free].copy(), velocities[self.free].copy()
+        self.bound = np.flatnonzero(boss >= 0)
+        parents = boss[self.bound]
+        self.orbits = KeplerOrbits(positions[self.bound] - positions[parents],
+                                   velocities[self.bound] - velocities[parents],
+                                   GRAVCONST * (masses[parents] + masses[self.bound]), time)
+        self.size = len(positions)
+
+    def state(self, t):
+        """positions and velocities (N, 3) of every row of the backend at time t"""
+        positions, velocities = np.empty((self.size, 3)), np.empty((self.size, 3))
+        positions[self.free] = self.start[0] + self.start[1] * (t - self.epoch)
+        velocities[self.free] = self.start[1]
+        positions[self.bound], velocities[self.bound] = self.orbits.state(t)
+        for rows in self.levels:
+            positions[rows] += positions[self.boss[rows]]
+            velocities[rows] += velocities[self.boss[rows]]
+        return positions, velocities
+
+    def deviations(self, backend, t):
+        """distance in AU of every row of backend from its two-body orbit at time t"""
+        positions = state_arrays(backend)[0]
+        return np.linalg.norm(positions - self.state(t)[0], axis=1)
+
+
+class GravityBackend:
+    """common part of all backends.
+       A backend keeps its own copy of positions, velocities and masses in the
+       order of game.objects. load() copies them from the CelestialBody objects,
+       store() writes them back. Integrators only talk to a backend through
+       accelerations(), kick(), drift(), get_state(), set_state() and lincomb(),
+       so every integrator works with every backend. accelerations(), kick()
+       and drift() can be limited to some rows (sorted indices) for block time
+       steps, kick() and drift() then change the state in place"""
+
+    name = "base"
+    options = ()  # names of the keyword arguments of __init__, saved in checkpoints
+
+    def __init__(self, game):
+        self.game = game
+        self.numbers = []
+        self.cached_acc = None  # accelerations at the current positions, if known
+        self.version = 0  # counts every change of the state, see changed()
+        self.load()
+
+    def sync(self):
+        """reload if bodies or test particles were added or removed since the last load"""
+        if self.numbers != list(self.game.objects.keys()) or self.n_particles != len(self.game.particles):
+            self.load()
+
+    def current_accelerations(self):
+        """accelerations at the current positions, computed at most once"""
+        if self.cached_acc is None:
+            self.cached_acc = self.accelerations()
+        return self.cached_acc
+
+    def get_state(self):
+        return self.positions, self.velocities
+
+    def set_state(self, state):
+        self.positions, self.velocities = state
+        self.changed()
+
+    def changed(self):
+        """called by everything that changes the state, also in place. Caches
+           of derived state (like the kepler integrator) compare the version"""
+        self.version += 1
+        self.cached_acc = None
+
+    def rows_of(self, numbers):
+        """backend rows of the bodies with these numbers"""
+        if getattr(self, "row_numbers", None) is not self.numbers:  # bodies were (re)loaded
+            self.row = {number: i for i, number in enumerate(self.numbers)}
+            self.row_numbers = self.numbers
+        return [self.row[number] for number in numbers]
+
+    def store_bodies(self, numbers):
+        """like store(), but only for a few bodies"""
+        for number, r in zip(numbers, self.rows_of(numbers)):
+            body = self.game.objects[number]
+            body.position = pygame.math.Vector3(tuple(self.positions[r]))
+            body.velocity = pygame.math.Vector3(tuple(self.velocities[r]))
+
+
+class PythonBackend(GravityBackend):
+    """reference backend: pure python double loop over lists of pygame vectors.
+       every other backend is checked against this one"""
+
+    name = "python"
+
+    def load(self):
+        """copy positions, velocities and masses from game.objects,
+           followed by the test particles (with mass 0)"""
+        bodies = list(self.game.objects.values())
+        particles = self.game.particles
+        self.numbers = [b.number for b in bodies]
+        self.n_particles = len(particles)
+        self.masses = [b.mass for b in bodies]
+        self.positions = [pygame.math.Vector3(b.position) for b in bodies]
+        self.velocities = [pygame.math.Vector3(b.velocity) for b in bodies]
+        if self.n_particles:
+            self.masses += [0.0] * self.n_particles
+            self.positions += [pygame.math.Vector3(p) for p in particles.positions.tolist()]
+            self.velocities += [pygame.math.Vector3(v) for v in particles.velocities.tolist()]
+        self.changed()
+
+    def store(self):
+        """write positions and velocities back into the CelestialBody objects
+           and the test particle arrays"""
+        for number, pos, vel in zip(self.numbers, self.positions, self.velocities):
+            body = self.game.objects[number]
+            body.position = pygame.math.Vector3(pos)
+            body.velocity = pygame.math.Vector3(vel)
+        if self.n_particles:
+            n = len(self.numbers)
+            self.game.particles.positions[:] = [tuple(p) for p in self.positions[n:]]
+            self.game.particles.velocities[:] = [tuple(v) for v in self.velocities[n:]]
+
+    def load_bodies(self, numbers):
+        """like load(), but only the mass, position and velocity of a few bodies"""
+        for number, r in zip(numbers, self.rows_of(numbers)):
+            body = self.game.objects[number]
+            self.masses[r] = body.mass
+            self.positions[r] = pygame.math.Vector3(body.position)
+            self.velocities[r] = pygame.math.Vector3(body.velocity)
+        self.changed()
+
+    def remove_bodies(self, numbers):
+        """drop the rows of removed bodies without loading everything again"""
+        gone = set(self.rows_of(numbers))
+        self.numbers = [number for i, number in enumerate(self.numbers) if i not in gone]
+        self.masses = [m for i, m in enumerate(self.masses) if i not in gone]
+        self.positions = [p for i, p in enumerate(self.positions) if i not in gone]
+        self.velocities = [v for i, v in enumerate(self.velocities) if i not in gone]
+        self.changed()
+
+    def accelerations(self, positions=None, rows=None):
+        """returns a list with the acceleration of every body in AU / a²,
+           or only of the bodies with the index in rows.
+           Only the massive bodies (not the test particles) are summed over"""
+        if positions is None:
+            positions = self.positions
+        sources = positions[:len(self.numbers)]
+        result = []
+        for i in (range(len(positions)) if rows is None else rows):
+            a = positions[i]
+            acc = pygame.Vector3(0,0,0)
+            for j, b in enumerate(sources):
+                if i == j:
+                    continue
+                distance_vector = b - a
+                acc +=  self.masses[j] / distance_vector.length()**3 * distance_vector # vec3
+            result.append(acc * GRAVCONST)
+        return result
+
+    def kick(self, h, acc, rows=None):
+        if rows is None:
+            self.velocities = [v + a * h for v, a in zip(self.velocities, acc)]
+        else:
+            for i, a in zip(rows, acc):
+                self.velocities[i] = self.velocities[i] + a * h
+        self.version += 1  # the accelerations stay valid
+
+    def drift(self, h, rows=None):
+        if rows is None:
+            self.positions = [p + v * h for p, v in zip(self.positions, self.velocities)]
+        else:
+            for i in rows:
+                self.positions[i] = self.positions[i] + self.velocities[i] * h
+        self.changed()
+
+    @staticmethod
+    def lincomb(base, terms):
+        """base + sum(factor * vectors) for every (factor, vectors) in terms"""
+        result = [pygame.math.Vector3(b) for b in base]
+        for factor, vectors in terms:
+            for i, v in enumerate(vectors):
+                result[i] += factor * v
+        return result
+
+    @staticmethod
+    def error_ratio(error, value, tolerance):
+        """largest |error| / (tolerance * (1 + |value|)) over all components"""
+        return max((abs(e) / (tolerance * (1 + abs(x))) for ev, xv in zip(error, value)
+                    for e, x in zip(ev, xv)), default=0.0)
+
+
+class NumpyBackend(GravityBackend):
+    """vectorized backend: positions, velocities and masses live in contiguous
+       numpy arrays and all pairwise accelerations are computed as one batched
+       operation (in cache sized blocks of about chunk_size² pairs).
+       The trajectories agree with PythonBackend to better than 1e-9 AU after
+       10 simulated years of daily steps (see compare_backends).
+       The arrays are the master copy: they are loaded from game.objects when
+       bodies are added or removed, and written back into the CelestialBody
+       vectors by store(). Call load() after changing a body by hand."""
+
+    name = "numpy"
+    chunk_size = 128
+
+    def __init__(self, game):
+        require_numpy("the numpy backend")
+        super().__init__(game)
+
+    def load(self):
+        """copy positions, velocities and masses from game.objects into arrays.
+           The rows of the test particles follow the rows of the massive bodies"""
+        bodies = list(self.game.objects.values())
+        particles = self.game.particles
+        self.numbers = [b.number for b in bodies]
+        self.n_particles = len(particles)
+        self.masses = np.array([b.mass for b in bodies], dtype=float)
+        self.positions = np.array([tuple(b.position) for b in bodies], dtype=float).reshape(-1, 3)
+        self.velocities = np.array([tuple(b.velocity) for b in bodies], dtype=float).reshape(-1, 3)
+        if self.n_particles:
+            self.positions = np.concatenate((self.positions, particles.positions))
+            self.velocities = np.concatenate((self.velocities, particles.velocities))
+        self.changed()
+
+    def store(self):
+        """write the arrays back into the CelestialBody vectors and the test particles"""
+        n = len(self.numbers)
+        for number, pos, vel in zip(self.numbers, self.positions[:n].tolist(), self.velocities[:n].tolist()):
+            body = self.game.objects[number]
+            body.position = pygame.math.Vector3(pos)
+            body.velocity = pygame.math.Vector3(vel)
+        if self.n_particles:
+            self.game.particles.positions[:] = self.positions[n:]
+            self.game.particles.velocities[:] = self.velocities[n:]
+
+    def load_bodies(self, numbers):
+        """like load(), but only the mass, position and velocity of a few bodies"""
+        for number, r in zip(numbers, self.rows_of(numbers)):
+            body = self.game.objects[number]
+            self.masses[r] = body.mass
+            self.positions[r] = tuple(body.position)
+            self.velocities[r] = tuple(body.velocity)
+        self.changed()
+
+    def remove_bodies(self, numbers):
+        """drop the rows of removed bodies without loading everything again"""
+        keep = np.ones(len(self.positions), dtype=bool)
+        keep[self.rows_of(numbers)] = False
+        self.numbers = [number for number, k in zip(self.numbers, keep.tolist()) if k]
+        self.masses = self.masses[keep[:len(self.masses)]]
+        self.positions = self.positions[keep]
+        self.velocities = self.velocities[keep]
+        self.changed()
+
+    def accelerations(self, positions=None, rows=None):
+        """returns an (N, 3) array with the acceleration of every body in AU / a²,
+           or only of the bodies with the index in rows (sorted).
+           Massive bodies pull on each other, test particles are only pulled:
+           O(N_massive² + N_massive * N_particles)"""
+        if positions is None:
+            positions = self.positions
+        n = len(self.numbers)
+        if rows is None:
+            acc = np.zeros((len(positions), 3))
+            if n:
+                acc[:n] = self.massive_accelerations(positions[:n], self.masses)
+                if len(positions) > n:
+                    acc[n:] = self.particle_accelerations(positions[:n], self.masses, positions[n:])
+            return acc
+        acc = np.zeros((len(rows), 3))
+        split = np.searchsorted(rows, n)  # massive rows first, then test particles
+        if n:
+            acc[:split] = self.massive_accelerations(positions[:n], self.masses, rows[:split])
+            if split < len(rows):
+                acc[split:] = self.particle_accelerations(positions[:n], self.masses, positions[rows[split:]])
+        return acc
+
+    def massive_accelerations(self, positions, masses, targets=None):
+        return direct_accelerations(positions, masses, targets=targets, chunk_size=self.chunk_size)
+
+    def particle_accelerations(self, positions, masses, points):
+        return direct_accelerations(positions, masses, chunk_size=self.chunk_size, points=points)
+
+    def kick(self, h, acc, rows=None):
+        if rows is None:
+            self.velocities = self.velocities + acc * h
+        else:
+            self.velocities[rows] += acc * h  # in place
+        self.version += 1  # the accelerations stay valid
+
+    def drift(self, h, rows=None):
+        if rows is None:
+            self.positions = self.positions + self.velocities * h
+        else:
+            self.positions[rows] += self.velocities[rows] * h  # in place
+        self.changed()
+
+    @staticmethod
+    def lincomb(base, terms):
+        """base + sum(factor * array) for every (factor, array) in terms"""
+        result = base.copy()
+        for factor, array in terms:
+            result += factor * array
+        return result
+
+    @staticmethod
+    def error_ratio(error, value, tolerance):
+        """largest |error| / (tolerance * (1 + |value|)) over all components"""
+        if len(error) == 0:
+            return 0.0
+        return float(np.max(np.abs(error) / (tolerance * (1 + np.abs(value)))))
+
+
+class BarnesHutBackend(NumpyBackend):
+    """O(N log N) backend: same arrays as NumpyBackend, but the accelerations
+       come from an Octree that is rebuilt for every force evaluation.
+       theta is the opening angle: 0 gives the exact direct sum (slowly),
+       larger values are faster and less accurate, 0.5 is a common choice.
+       Run benchmark.py barneshut to see the force error for each theta."""
+
+    name = "barneshut"
+    options = ("theta", "leaf_size")
+
+    def __init__(self, game, theta=0.5, leaf_size=8):
+        self.theta = theta
+        self.leaf_size = leaf_size
+        super().__init__(game)
+
+    def massive_accelerations(self, positions, masses, targets=None):
+        self.tree = Octree(positions, masses, leaf_size=self.leaf_size)
+        return self.tree.accelerations(self.theta, targets=targets)
+
+    def particle_accelerations(self, positions, masses, points):
+        # the tree of the massive bodies at these positions was just built
+        return self.tree.accelerations(self.theta, points=points)
+
+
+Game.backends = {"python": PythonBackend, "numpy": NumpyBackend, "barneshut": BarnesHutBackend}
+
+
+# ----------------------------- integrators ---------------------------------
+# every integrator advances all bodies of a backend by h years
+
+def trapezoid_step(backend, h):
+    """the original update rule: new velocity from the acceleration at the old
+       positions, new position from the mean of old and new velocity.
+       first order, energy drifts, kept for comparison"""
+    acc = backend.current_accelerations()
+    positions, velocities = backend.get_state()
+    new_velocities = backend.lincomb(velocities, [(h, acc)])
+    positions = backend.lincomb(positions, [(h / 2, velocities), (h / 2, new_velocities)])
+    backend.set_state((positions, new_velocities))
+
+
+def leapfrog_step(backend, h):
+    """kick-drift-kick leapfrog (velocity verlet), symplectic, second order.
+       The acceleration of the last kick is reused by the next step,
+       so it costs one force evaluation per step"""
+    backend.kick(h / 2, backend.current_accelerations())
+    backend.drift(h)
+    backend.kick(h / 2, backend.current_accelerations())
+
+
+_CBRT2 = 2 ** (1 / 3)
+_YOSHIDA_W1 = 1 / (2 - _CBRT2)
+_YOSHIDA_W0 = -_CBRT2 / (2 - _CBRT2)
+YOSHIDA_DRIFTS = (_YOSHIDA_W1 / 2, (_YOSHIDA_W0 + _YOSHIDA_W1) / 2, (_YOSHIDA_W0 + _YOSHIDA_W1) / 2, _YOSHIDA_W1 / 2)
+YOSHIDA_KICKS = (_YOSHIDA_W1, _YOSHIDA_W0, _YOSHIDA_W1)
+
+
+def yoshida4_step(backend, h):
+    """Yoshida's 4th order symplectic integrator: three leapfrog steps with
+       the weights w1, w0, w1 (w0 is negative). Three force evaluations per step"""
+    for drift, kick in zip(YOSHIDA_DRIFTS, YOSHIDA_KICKS):
+        backend.drift(drift * h)
+        backend.kick(kick * h, backend.current_accelerations())
+    backend.drift(YOSHIDA_DRIFTS[-1] * h)
+
+
+BLOCK_ETA = 0.05  # block steps: largest step as fraction of the orbital time scale
+BLOCK_MAX_RUNG = 12  # block steps: the smallest step is h / 2**12
+
+
+def block_rungs(backend, h):
+    """rung of every backend row for a step of h years: a row on rung r takes
+       steps of h / 2**r, at most BLOCK_ETA times its orbital time scale
+       sqrt(r³ / (G (m + M))) around its boss. Bodies without boss and test
+       particles circle the first body (the sun). A boss is raised to the rung
+       of its fastest massive satellite, up the whole chain of bosses, so it
+       feels the pull of its moons as often as they feel its pull"""
+    if getattr(backend, "boss_numbers", None) is not backend.numbers:  # bodies were (re)loaded
+        row = {number: i for i, number in enumerate(backend.numbers)}
+        bodies = [backend.game.objects[number] for number in backend.numbers]
+        backend.boss_rows = np.array([row.get(b.boss.number, 0) if b.boss is not None else 0 for b in bodies]
+                                     + [0] * backend.n_particles, dtype=np.int64)
+        backend.boss_numbers = backend.numbers
+    positions = state_arrays(backend)[0]
+    masses = np.zeros(len(positions))  # test particles have mass 0
+    masses[:len(backend.numbers)] = backend.masses[:len(backend.numbers)]  # python: with the particles
+    boss = backend.boss_rows
+    distance = np.linalg.norm(positions - positions[boss], axis=1)
+    mu = GRAVCONST * (masses + masses[boss])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        timescale = np.where((boss != np.arange(len(boss))) & (mu > 0), np.sqrt(distance ** 3 / mu), np.inf)
+        rungs = np.ceil(np.log2(abs(h) / (BLOCK_ETA * timescale)))
+    rungs = np.clip(np.nan_to_num(rungs, nan=0.0, neginf=0.0), 0, BLOCK_MAX_RUNG).astype(int)
+    satellites = np.flatnonzero((boss != np.arange(len(boss))) & (masses > 0))
+    while len(satellites):
+        raised = rungs.copy()
+        np.maximum.at(raised, boss[satellites], rungs[satellites])
+        if np.array_equal(raised, rungs):
+            break
+        rungs = raised
+    return rungs
+
+
+def block_step(backend, h):
+    """leapfrog with hierarchical block time steps: moons and close binaries
+       substep in h / 2**rung (see block_rungs) while the planets take the
+       whole step h, everything is synchronized again at the end. A rung is
+       kicked at the start and the end of each of its steps with forces on
+       its own bodies only, so the forces are evaluated once per step of a rung
+       and empty rungs cost nothing. The massive bodies drift in the smallest
+       steps, they are the sources of all forces, test particles on rung 0
+       drift once at the end. Without fast bodies this is exactly leapfrog_step.
+       Needs numpy"""
+    rungs = block_rungs(backend, h)
+    deepest = int(rungs.max()) if len(rungs) else 0
+    if deepest == 0:
+        return leapfrog_step(backend, h)
+    rows = [np.flatnonzero(rungs == r) for r in range(deepest + 1)]
+    late = rungs == 0
+    late[:len(backend.numbers)] = False
+    moving = np.flatnonzero(~late)  # drift with every substep
+    late = np.flatnonzero(late)
+    start = backend.current_accelerations()
+    if isinstance(start, list):
+        acc = [[start[i] for i in r] for r in rows]
+    else:
+        acc = [start[r] for r in rows]
+    # acc[r]: accelerations of rung r at the current positions. Only the
+    # deepest rung drifts, and every rung computes its forces right after
+    # its last inner step, so they stay valid until the rung kicks again
+
+    def substep(r, hr):
+        """one step of hr for rung r"""
+        if len(rows[r]):
+            backend.kick(hr / 2, acc[r], rows[r])
+        if r == deepest:
+            backend.drift(hr, moving)
+        else:
+            substep(r + 1, hr / 2)
+            substep(r + 1, hr / 2)
+        if r == 0:
+            backend.drift(hr, late)  # test particles are no sources, they can go in one drift
+        if len(rows[r]):
+            acc[r] = backend.accelerations(rows=rows[r])
+            backend.kick(hr / 2, acc[r], rows[r])
+
+    substep(0, h)
+    if isinstance(start, list):
+        result = list(start)
+        for r, a in zip(rows, acc):
+            for i, v in zip(r, a):
+                result[i] = v
+    else:
+        result = np.empty_like(start)
+        for r, a in zip(rows, acc):
+            result[r] = a
+    backend.cached_acc = result  # the next step starts with it
+
+
+# Dormand-Prince 5(4) coefficients
+DOPRI_C = (0, 1/5, 3/10, 4/5, 8/9, 1, 1)
+DOPRI_A = ((),
+           (1/5,),
+           (3/40, 9/40),
+           (44/45, -56/15, 32/9),
+           (19372/6561, -25360/2187, 64448/6561, -212/729),
+           (9017/3168, -355/33, 46732/5247, 49/176, -5103/18656),
+           (35/384, 0, 500/1113, 125/192, -2187/6784, 11/84))
+DOPRI_B5 = (35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0)
+DOPRI_B4 = (5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40)
+
+
+def rk45_step(backend, h, tolerance=1e-10):
+    """adaptive Dormand-Prince Runge-Kutta 5(4). Covers h with as many
+       substeps as the error estimate needs, the last good substep size is
+       remembered in backend.rk45_substep. Not symplectic, but accurate
+       through close encounters"""
+    done = 0.0
+    substep = min(getattr(backend, "rk45_substep", h), h)
+    while done < h * (1 - 1e-12):
+        substep = min(substep, h - done)
+        positions, velocities = backend.get_state()
+        k = []  # (velocity, acceleration) derivatives of the stages
+        for stage in range(7):
+            if stage == 0:
+                x, v = positions, velocities
+            else:
+                x = backend.lincomb(positions, [(substep * a, k[j][0]) for j, a in enumerate(DOPRI_A[stage]) if a])
+                v = backend.lincomb(velocities, [(substep * a, k[j][1]) for j, a in enumerate(DOPRI_A[stage]) if a])
+            k.append((v, backend.current_accelerations() if stage == 0 else backend.accelerations(x)))
+        new_x = backend.lincomb(positions, [(substep * b, k[j][0]) for j, b in enumerate(DOPRI_B5) if b])
+        new_v = backend.lincomb(velocities, [(substep * b, k[j][1]) for j, b in enumerate(DOPRI_B5) if b])
+        x4 = backend.lincomb(positions, [(substep * b, k[j][0]) for j, b in enumerate(DOPRI_B4) if b])
+        v4 = backend.lincomb(velocities, [(substep * b, k[j][1]) for j, b in enumerate(DOPRI_B4) if b])
+        error_x = backend.lincomb(new_x, [(-1, x4)])
+        error_v = backend.lincomb(new_v, [(-1, v4)])
+        ratio = max(backend.error_ratio(error_x, new_x, tolerance), backend.error_ratio(error_v, new_v, tolerance))
+        if ratio <= 1:
+            backend.set_state((new_x, new_v))
+            backend.cached_acc = k[6][1]  # first same as last: stage 7 is at the new state
+            done += substep
+        # classic step size control with safety factor 0.9
+        substep *= min(5.0, max(0.2, 0.9 * (ratio if ratio > 0 else 1e-10) ** -0.2))
+    backend.rk45_substep = substep
+
+
+def kepler_step(backend, h):
+    """no integration at all: every body follows its two-body orbit around its
+       boss (see KeplerPropagator), exact for any h. The orbits are taken from
+       the state when the integrator starts or the backend was changed by
+       something else (reload, collision, another integrator)"""
+    time = backend.game.time
+    propagator = current_kepler(backend)
+    if propagator is None:
+        propagator = backend.kepler = KeplerPropagator(backend, time)
+    positions, velocities = propagator.state(time + h)
+    if isinstance(backend.positions, list):
+        positions = [pygame.math.Vector3(p) for p in positions.tolist()]
+        velocities = [pygame.math.Vector3(v) for v in velocities.tolist()]
+    backend.set_state((positions, velocities))
+    backend.kepler_last = (backend.version, time + h)  # Game.integrate adds h to the time after this
+
+
+def current_kepler(backend):
+    """the KeplerPropagator of the last kepler_step, None if the backend was
+       changed since. Game.advance rounds the time to its end, that is no change"""
+    propagator = getattr(backend, "kepler", None)
+    if propagator is None:
+        return None
+    version, time = backend.kepler_last
+    if version != backend.version or abs(time - backend.game.time) > 1e-9 * max(1.0, abs(time)):
+        return None
+    return propagator
+
+
+Game.integrators = {"trapezoid": trapezoid_step, "leapfrog": leapfrog_step,
+                    "yoshida4": yoshida4_step, "rk45": rk45_step, "block": block_step,
+                    "kepler": kepler_step}
+
+
+def compare_backends(game, reference="python", candidate="numpy", years=10, dt=1/365.25, integrator="trapezoid"):
+    """integrate the same start state with two backends and return the largest
+       position difference in AU. The bodies of game are not changed"""
+    step = Game.integrators[integrator]
+    tracks = []
+    for name in (reference, candidate):
+        backend = Game.backends[name](game)  # loads the current state of the bodies
+        for _ in range(int(round(years / dt))):
+            step(backend, dt)
+        tracks.append([pygame.math.Vector3(tuple(p)) for p in backend.positions])
+    return max((a - b).length() for a, b in zip(*tracks))
+
+
+class Diagnostics:
+    """tracks the conserved quantities of a game: total energy, linear
+       momentum and angular momentum, and their relative drift since the
+       start. The potential energy costs O(N²), so the values are measured
+       only every 'every' physics steps, in batched form (see total_energy).
+       every=0 turns the measurements during the steps off, only update() measures.
+       Usage: diagnostics = Diagnostics(game, every=100)
+       ... game.advance(10); print(diagnostics.values())"""
+
+    def __init__(self, game, every=100, history=10000):
+        require_numpy("diagnostics")
+        self.game = game
+        self.every = max(0, every)
+        self.history = collections.deque(maxlen=history)  # (time, energy, drifts) per measurement
+        self.steps = 0
+        self.measurements = 0
+        self.rows = None  # number of backend rows of the baseline
+        game.backend.sync()
+        self.update()
+        if self.every:
+            game.observers.append(self)
+
+    def __call__(self, game):
+        self.steps += 1
+        if self.every and self.steps % self.every == 0:
+            self.update()
+
+    def update(self):
+        """measure now. A new baseline is taken when bodies or test particles
+           were added or removed, the drift would be meaningless otherwise"""
+        backend = self.game.backend
+        positions, velocities = state_arrays(backend)
+        masses = np.zeros(len(positions))  # test particles have mass 0
+        masses[:len(backend.masses)] = backend.masses
+        self.energy = total_energy(positions, velocities, masses)
+        self.momentum = np.sum(masses[:, np.newaxis] * velocities, axis=0)
+        self.angular_momentum = angular_momentum(positions, velocities, masses)
+        if self.rows != len(masses):
+            self.rows = len(masses)
+            self.energy0 = self.energy
+            self.momentum0 = self.momentum
+            # the total momentum is often about 0, its drift is relative to the sum of |m v|
+            self.momentum_scale = float(np.sum(masses * np.linalg.norm(velocities, axis=1))) or 1.0
+            self.angular_momentum0 = self.angular_momentum
+        self.energy_drift = abs((self.energy - self.energy0) / self.energy0) if self.energy0 else 0.0
+        self.momentum_drift = float(np.linalg.norm(self.momentum - self.momentum0)) / self.momentum_scale
+        length = float(np.linalg.norm(self.angular_momentum0))
+        self.angular_momentum_drift = float(np.linalg.norm(self.angular_momentum - self.angular_momentum0)) / length \
+            if length else 0.0
+        self.time = self.game.time
+        self.measurements += 1
+        self.history.append((self.time, self.energy, self.energy_drift, self.momentum_drift,
+                             self.angular_momentum_drift))
+
+    def values(self):
+        """the last measurement as a dict"""
+        return {"time": self.time, "energy": self.energy, "momentum": self.momentum.tolist(),
+                "angular_momentum": self.angular_momentum.tolist(), "energy_drift": self.energy_drift,
+                "momentum_drift": self.momentum_drift, "angular_momentum_drift": self.angular_momentum_drift}
+
+    def text(self):
+        return "year {:.3f}: energy {:.6e} drift {:.2e} | momentum drift {:.2e} | angular momentum drift {:.2e}".format(
+            self.time, self.energy, self.energy_drift, self.momentum_drift, self.angular_momentum_drift)
+
+
+# the 13 neighbour cells "after" a cell, each pair of neighbouring cells is visited once
+HALF_SHELL = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1) if (dx, dy, dz) > (0, 0, 0)]
+
+
+def _cell_pairs(start, count, first, second, same):
+    """all pairs (a, b) of sorted body indices with a in the cells first and b
+       in the cells second. In the same cell only a < b"""
+    sizes = count[first] * count[second]
+    total = int(sizes.sum())
+    k = np.arange(total) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    width = np.repeat(count[second], sizes)
+    a = np.repeat(start[first], sizes) + k // width
+    b = np.repeat(start[second], sizes) + k % width
+    if same:
+        keep = a < b
+        a, b = a[keep], b[keep]
+    return a, b
+
+
+def close_pairs(positions, reach, small=64):
+    """broad phase with a uniform spatial hash: returns two index arrays i < j
+       of all pairs closer than reach[i] + reach[j]. The cells are as large as
+       the largest possible reach, so only neighbouring cells can hold a
+       partner, no all-pairs check is needed. Up to 'small' bodies are
+       checked all against all, that is faster than building the cells"""
+    n = len(positions)
+    if n < 2 or reach.max() <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if n <= small:
+        i, j = np.triu_indices(n, 1)
+        d = positions[j] - positions[i]
+        close = np.einsum("ij,ij->i", d, d) < (reach[i] + reach[j]) ** 2
+        return i[close], j[close]
+    low, high = positions.min(axis=0), positions.max(axis=0)
+    # at most 2**20 cells per axis, so the cell number fits into an int64
+    cell = max(2 * float(reach.max()), float((high - low).max()) / 2**20)
+    cells = np.floor((positions - low) / cell).astype(np.int64) + 1  # a free cell on every side
+    span = cells.max(axis=0) + 2
+    keys = (cells[:, 0] * span[1] + cells[:, 1]) * span[2] + cells[:, 2]
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    start = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    count = np.diff(np.r_[start, n])
+    occupied = sorted_keys[start]
+    cell_index = np.arange(len(occupied))
+    firsts, seconds = [], []
+    a, b = _cell_pairs(start, count, cell_index, cell_index, True)
+    firsts.append(a)
+    seconds.append(b)
+    for dx, dy, dz in HALF_SHELL:
+        # neighbour keys are the occupied keys plus a constant, so the queries are sorted
+        wanted = occupied + (dx * span[1] + dy) * span[2] + dz
+        found = np.minimum(np.searchsorted(occupied, wanted), len(occupied) - 1)
+        hit = occupied[found] == wanted
+        a, b = _cell_pairs(start, count, cell_index[hit], found[hit], False)
+        firsts.append(a)
+        seconds.append(b)
+    a, b = order[np.concatenate(firsts)], order[np.concatenate(seconds)]
+    i, j = np.minimum(a, b), np.maximum(a, b)
+    d = positions[j] - positions[i]
+    close = np.einsum("ij,ij->i", d, d) < (reach[i] + reach[j]) ** 2
+    return i[close], j[close]
+
+
+class Collisions:
+    """collision and close encounter detection for the massive bodies of a
+       game, checked after every physics step. mode decides what a collision does:
+       "merge": the bodies become one, mass and momentum are conserved
+       "bounce": the velocities are reflected along the line between the centers
+       "log": the bodies pass through each other as before, the event is only logged
+       A close encounter is a pass within encounter_distance AU of the surfaces,
+       it is logged when it begins. The bodies move in straight lines during a
+       step for the check, so fast bodies can not jump over each other.
+       Usage: collisions = Collisions(game, mode="merge", encounter_distance=0.01)"""
+
+    modes = ("merge", "bounce", "log")
+
+    def __init__(self, game, mode="merge", encounter_distance=0.0, restitution=1.0, events=10000):
+        require_numpy("collision detection")
+        if mode not in Collisions.modes:
+            raise ValueError("unknown collision mode {!r}, choose one of {}".format(mode, list(Collisions.modes)))
+        self.game = game
+        self.mode = mode
+        self.encounter_distance = encounter_distance
+        self.restitution = restitution  # bounce: 1 elastic, 0 the bodies stick together
+        self.events = collections.deque(maxlen=events)  # (time, "collision" / "encounter", name, name, distance)
+        self.close = set()  # pairs of body numbers in an encounter right now
+        self.numbers = None  # backend.numbers the radii belong to
+        self.last_time = game.time
+        game.observers.append(self)
+
+    def __call__(self, game):
+        dt = game.time - self.last_time
+        self.last_time = game.time
+        backend = game.backend
+        if backend.numbers is not self.numbers:  # bodies were (re)loaded
+            self.numbers = backend.numbers
+            self.radii = np.array([game.objects[number].radius or 0.0 for number in self.numbers], dtype=float)
+        n = len(self.numbers)
+        positions, velocities = state_arrays(backend)
+        positions, velocities = positions[:n], velocities[:n]
+        reach = self.radii + np.linalg.norm(velocities, axis=1) * abs(dt) + 0.5 * self.encounter_distance
+        i, j = close_pairs(positions, reach)
+        if not len(i):
+            self.close = set()
+            return
+        # ---- narrow phase: closest approach of the pair during the last step ----
+        d = positions[j] - positions[i]
+        w = velocities[j] - velocities[i]
+        ww = np.einsum("ij,ij->i", w, w)
+        s = np.clip(np.einsum("ij,ij->i", d, w) / np.where(ww > 0, ww, 1.0), min(0, dt), max(0, dt))
+        gap = np.linalg.norm(d - w * s[:, np.newaxis], axis=1)
+        contact = self.radii[i] + self.radii[j]
+        hit = gap < contact
+        near = ~hit & (gap < contact + self.encounter_distance)
+        close = {(self.numbers[a], self.numbers[b]) for a, b in zip(i[near].tolist(), j[near].tolist())}
+        for a, b in close - self.close:
+            self.log("encounter", a, b, positions)
+        self.close = close
+        if hit.any():
+            k = np.flatnonzero(hit)
+            # years back to the moment the surfaces touched first
+            back = np.minimum(s[k] + np.sqrt((contact[k] ** 2 - gap[k] ** 2) / np.where(ww[k] > 0, ww[k], np.inf)),
+                              abs(dt))
+            self.collide([(self.numbers[a], self.numbers[b], t) for a, b, t
+                          in zip(i[k].tolist(), j[k].tolist(), back.tolist())], positions)
+
+    def log(self, kind, a, b, positions):
+        index = {number: row for row, number in enumerate(self.numbers)}
+        distance = float(np.linalg.norm(positions[index[a]] - positions[index[b]]))
+        first, second = self.game.objects[a].name, self.game.objects[b].name
+        self.events.append((self.game.time, kind, first, second, distance))
+        print("year {:.5f}: {} of {} and {} ({:.3e} AU)".format(self.game.time, kind, first, second, distance))
+
+    def collide(self, pairs, positions):
+        """pairs are (number, number, years since the bodies touched)"""
+        for a, b, back in pairs:
+            self.log("collision", a, b, positions)
+        if self.mode == "log":
+            return
+        backend = self.game.backend
+        numbers = sorted({number for a, b, back in pairs for number in (a, b)})
+        backend.store_bodies(numbers)  # only these bodies change
+        if self.mode == "merge":
+            gone = self.merge(pairs)
+            backend.load_bodies([number for number in numbers if number not in gone])
+            backend.remove_bodies(sorted(gone))
+        else:
+            for a, b, back in pairs:
+                self.bounce(self.game.objects[a], self.game.objects[b], back)
+            backend.load_bodies(numbers)
+
+    def merge(self, pairs):
+        """every group of touching bodies (a hits b, b hits c) becomes its heaviest body.
+           Moons of the removed bodies circle the survivor from now on.
+           Returns the set of the numbers of the removed bodies"""
+        group = {}
+        def root(number):
+            while group.get(number, number) != number:
+                number = group[number]
+            return number
+        for a, b, back in pairs:
+            group[root(b)] = root(a)
+        members = collections.defaultdict(list)
+        heirs = {}  # {number of a removed body: survivor}
+        for number in set(group) | set(group.values()):
+            members[root(number)].append(self.game.objects[number])
+        for bodies in members.values():
+            survivor = max(bodies, key=lambda body: (body.mass, -body.number))
+            mass = sum(body.mass for body in bodies)
+            survivor.position = sum((body.position * body.mass for body in bodies), pygame.math.Vector3()) / mass
+            survivor.velocity = sum((body.velocity * body.mass for body in bodies), pygame.math.Vector3()) / mass
+            survivor.radius = sum((body.radius or 0.0) ** 3 for body in bodies) ** (1 / 3)
+            survivor.mass = mass
+            for body in bodies:
+                if body is not survivor:
+                    self.game.remove_body(body)
+                    heirs[body.number] = survivor
+        for body in self.game.objects.values():
+            while body.boss is not None and body.boss.number in heirs:
+                heir = heirs[body.boss.number]
+                body.boss = heir if heir is not body else body.boss.boss  # a moon swallowed its planet
+        return set(heirs)
+
+    def bounce(self, first, second, back):
+        """the bodies go back the 'back' years to the moment they touched,
+           bounce there and go forward again with the new velocities"""
+        first.position = first.position - first.velocity * back
+        second.position = second.position - second.velocity * back
+        normal = second.position - first.position
+        if normal.length_squared() > 0:
+            normal.normalize_ip()
+            approach = (second.velocity - first.velocity).dot(normal)
+            if approach < 0:  # not yet moving apart
+                impulse = (1 + self.restitution) * approach / (1 / first.mass + 1 / second.mass)
+                first.velocity = first.velocity + normal * (impulse / first.mass)
+                second.velocity = second.velocity - normal * (impulse / second.mass)
+        first.position = first.position + first.velocity * back
+        second.position = second.position + second.velocity * back
+
+
+# ------------------------- trajectory files --------------------------------
+# A trajectory file is append-only:
+#   file header: 8 bytes magic b"SSTRAJ01", uint64 length of the json metadata,
+#                the json metadata (utf-8, padded with spaces to a multiple of 64 bytes
+#                together with the first 16 bytes)
+#   chunks:      4 bytes magic b"CHNK", uint32 number of samples n, uint64 zero,
+#                float64 times[n] (years), float64 states[n][bodies][6]
+#                with x, y, z (AU), vx, vy, vz (AU / year)
+# everything little endian. All offsets are multiples of 8, so every chunk
+# can be memory mapped as numpy arrays. A crash loses at most the last chunk.
+
+TRAJECTORY_MAGIC = b"SSTRAJ01"
+CHUNK_MAGIC = b"CHNK"
+
+
+def state_arrays(backend):
+    """positions and velocities of a backend as (N, 3) numpy arrays"""
+    positions, velocities = backend.get_state()
+    if isinstance(positions, list):
+        positions = np.array([tuple(p) for p in positions], dtype=float).reshape(-1, 3)
+        velocities = np.array([tuple(v) for v in velocities], dtype=float).reshape(-1, 3)
+    return positions, velocities
+
+
+class TrajectoryRecorder:
+    """writes the state of every body (and test particle) of a game into a
+       trajectory file every 'every' simulated years. Samples are collected
+       in memory and appended one chunk of chunk_samples at a time, fewer if
+       a chunk would take more than chunk_bytes (many test particles).
+       Bodies removed while recording (merged in a collision) are recorded as nan.
+       Usage: recorder = TrajectoryRecorder(game, "run.traj", every=1/365.25)
+       ... recorder.close()"""
+
+    def __init__(self, game, filename, every=1/365.25, chunk_samples=256, particles=True, chunk_bytes=32 << 20):
+        require_numpy("recording")
+        self.game = game
+        self.every = every
+        self.particles = particles
+        game.backend.sync()
+        bodies = list(game.objects.values())
+        names = [b.name for b in bodies]
+        masses = [b.mass for b in bodies]
+        if particles:
+            names += game.particles.names
+            masses += [0.0] * len(game.particles)
+        self.n_bodies = len(names)
+        self.chunk_samples = chunk_samples = max(1, min(chunk_samples, chunk_bytes // (8 + 48 * self.n_bodies)))
+        self.numbers = [b.number for b in bodies]  # the recorded bodies, in column order
+        self.n_particles = len(game.particles)
+        self.loaded = None  # backend.numbers the rows belong to
+        meta = {"version": 1, "names": names, "masses": masses, "radii": [b.radius for b in bodies],
+                "time_unit": "year", "length_unit": "AU", "velocity_unit": "AU/year",
+                "start_time": game.time, "every": every, "chunk_samples": chunk_samples}
+        text = json.dumps(meta).encode("utf-8")
+        text += b" " * (-(16 + len(text)) % 64)
+        self.file = open(filename, "wb")
+        self.file.write(TRAJECTORY_MAGIC + struct.pack("<Q", len(text)) + text)
+        self.times = np.zeros(chunk_samples)
+        self.states = np.zeros((chunk_samples, self.n_bodies, 6))
+        self.filled = 0
+        self.samples = 0
+        self.next_time = game.time
+        self.record(game)
+        game.observers.append(self)
+
+    def __call__(self, game):
+        if game.time >= self.next_time - 1e-9 * self.every:
+            self.record(game)
+
+    def map_rows(self, backend):
+        """backend row of every column. Removed bodies get row -1 and are
+           recorded as nan, new bodies do not fit into the file"""
+        row = {number: i for i, number in enumerate(backend.numbers)}
+        if (not row.keys() <= set(self.numbers)
+                or (self.particles and backend.n_particles != self.n_particles)):
+            raise ValueError("bodies were added while recording, start a new recording")
+        rows = [row.get(number, -1) for number in self.numbers]
+        if self.particles:
+            rows += range(len(row), len(row) + self.n_particles)
+        self.rows = np.array(rows, dtype=np.int64)
+        self.gone = self.rows < 0
+        if not self.gone.any() and np.array_equal(self.rows, np.arange(self.n_bodies)):
+            self.rows = slice(0, self.n_bodies)  # nothing removed: no copy by index
+        self.loaded = backend.numbers
+
+    def record(self, game):
+        """store the current state as one sample"""
+        if game.backend.numbers is not self.loaded:  # bodies were (re)loaded
+            self.map_rows(game.backend)
+        positions, velocities = state_arrays(game.backend)
+        self.times[self.filled] = game.time
+        self.states[self.filled, :, :3] = positions[self.rows]
+        self.states[self.filled, :, 3:] = velocities[self.rows]
+        if isinstance(self.rows, np.ndarray):
+            self.states[self.filled, self.gone] = np.nan
+        self.filled += 1
+        self.samples += 1
+        while self.next_time <= game.time + 1e-9 * self.every:
+            self.next_time += self.every  # stay on the grid start_time + k * every
+        if self.filled == self.chunk_samples:
+            self.flush()
+
+    def flush(self):
+        """append the collected samples as one chunk"""
+        if self.filled == 0:
+            return
+        self.file.write(CHUNK_MAGIC + struct.pack("<IQ", self.filled, 0))
+        self.file.write(self.times[:self.filled].astype("<f8").tobytes())
+        self.file.write(self.states[:self.filled].astype("<f8").tobytes())
+        self.file.flush()
+        self.filled = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        if self in self.game.observers:
+            self.game.observers.remove(self)
+
+
+class Trajectory:
+    """read access to a trajectory file through memory mapping, nothing but
+       the chunk headers is read when opening, so files much larger than the
+       RAM can be sliced by body and time range.
+       names, masses and meta come from the header, times holds all sample times"""
+
+    def __init__(self, filename):
+        require_numpy("reading trajectories")
+        self.filename = filename
+        with open(filename, "rb") as f:
+            head = f.read(16)
+            if len(head) < 16 or head[:8] != TRAJECTORY_MAGIC:
+                raise ValueError("{} is not a trajectory file".format(filename))
+            length = struct.unpack("<Q", head[8:])[0]
+            self.meta = json.loads(f.read(length).decode("utf-8"))
+            size = os.fstat(f.fileno()).st_size
+        self.names = self.meta["names"]
+        self.masses = np.array(self.meta["masses"], dtype=float)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        n_bodies = len(self.names)
+        # ---- scan the chunk headers ----
+        self.chunks = []  # (offset of the states, number of samples) per chunk
+        times = []
+        offset = 16 + length
+        with open(filename, "rb") as f:
+            while offset + 16 <= size:
+                f.seek(offset)
+                head = f.read(16)
+                if head[:4] != CHUNK_MAGIC:
+                    raise ValueError("broken chunk at byte {} of {}".format(offset, filename))
+                n = struct.unpack("<I", head[4:8])[0]
+                end = offset + 16 + 8 * n + 8 * n * n_bodies * 6
+                if end > size:
+                    break  # truncated last chunk, e.g. after a crash
+                times.append(np.frombuffer(f.read(8 * n), dtype="<f8"))
+                self.chunks.append((offset + 16 + 8 * n, n))
+                offset = end
+            # one map of the whole file (one file descriptor), the chunks are views into it
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.chunks else None
+        self.n_bodies = n_bodies
+        self.chunk_offsets = np.cumsum([0] + [n for offset, n in self.chunks])
+        self.times = np.concatenate(times) if times else np.zeros(0)
+
+    def chunk(self, c):
+        """states of chunk number c, an array view into the file"""
+        offset, n = self.chunks[c]
+        return np.ndarray((n, self.n_bodies, 6), dtype="<f8", buffer=self.map, offset=offset)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def body_indices(self, bodies=None):
+        """list of column indices for bodies given by name or index (None: all)"""
+        if bodies is None:
+            return list(range(len(self.names)))
+        return [self.index[b] if isinstance(b, str) else b for b in bodies]
+
+    def slice(self, bodies=None, start=None, stop=None):
+        """returns (times, states) for the samples with start <= time <= stop.
+           states has the shape (samples, len(bodies), 6). Only the chunks in
+           the time range are touched"""
+        columns = self.body_indices(bodies)
+        first = 0 if start is None else int(np.searchsorted(self.times, start, side="left"))
+        last = len(self.times) if stop is None else int(np.searchsorted(self.times, stop, side="right"))
+        return self.samples(first, last, columns)
 
+    def samples(self, first, last, columns=None):
+        """states of the samples first .. last-1 (sample numbers, not times)"""
+        if columns is None:
+            columns = self.body_indices()
+        parts = []
+        c = max(int(np.searchsorted(self.chunk_offsets, first, side="right")) - 1, 0)  # chunk of the first sample
+        while c < len(self.chunks) and self.chunk_offsets[c] < last:
+            lo = max(first - self.chunk_offsets[c], 0)
+            hi = min(last - self.chunk_offsets[c], self.chunks[c][1])
+            if lo < hi:
+                parts.append(self.chunk(c)[lo:hi][:, columns])
+            c += 1
+        states = np.concatenate(parts) if parts else np.zeros((0, len(columns), 6))
+        return self.times[first:last].copy(), states
+
+
+def hermite(t, t0, t1, state0, state1):
+    """cubic hermite interpolation between two samples (arrays with
+       x, y, z, vx, vy, vz in the last axis) using positions and velocities.
+       returns positions and velocities at time t"""
+    h = t1 - t0
+    if h <= 0:
+        return state0[..., :3].copy(), state0[..., 3:].copy()
+    u = (t - t0) / h
+    p0, v0, p1, v1 = state0[..., :3], state0[..., 3:] * h, state1[..., :3], state1[..., 3:] * h
+    positions = ((2*u**3 - 3*u**2 + 1) * p0 + (u**3 - 2*u**2 + u) * v0
+                 + (-2*u**3 + 3*u**2) * p1 + (u**3 - u**2) * v1)
+    velocities = ((6*u**2 - 6*u) * p0 + (3*u**2 - 4*u + 1) * v0
+                  + (-6*u**2 + 6*u) * p1 + (3*u**2 - 2*u) * v1) / h
+    return positions, velocities
+
+
+class ReplayBody:
+    """a body of a Replay: only what the Viewer needs"""
+
+    __slots__ = ("number", "name", "mass", "radius", "boss", "position", "velocity")
+
+    def __init__(self, name, mass, radius):
+        self.name = name
+        self.mass = mass
         self.radius = radius
+        self.boss = None
+        self.position = pygame.math.Vector3(0, 0, 0)
+        self.velocity = pygame.math.Vector3(0, 0, 0)
+
+
+class Replay:
+    """plays a recorded Trajectory in the Viewer instead of a live Game.
+       Nothing is integrated: the state at any time is interpolated between
+       the two nearest samples, so the speed of playback only depends on
+       rendering. delta_t (set with set_timescale) is the speed in years per
+       second, direction is 1 (forward) or -1 (backward)"""
+
+    integrator = "replay"
+
+    def __init__(self, trajectory):
+        self.trajectory = trajectory
+        if len(trajectory) == 0:
+            raise ValueError("{} holds no samples".format(trajectory.filename))
+        self.objects = BodyStore()
+        self.removed = []  # a replay never removes bodies
+        n_massive = len(trajectory.meta["radii"])
+        for name, mass, radius in zip(trajectory.names, trajectory.masses, trajectory.meta["radii"]):
+            self.objects.add(ReplayBody(name, float(mass), radius))
+        self.particles = TestParticles()
+        self.particles.names = trajectory.names[n_massive:]
+        self.n_massive = n_massive
+        self.i = 3
+        self.delta_t = Game.deltas[self.i][0]
+        self.paused = False
+        self.direction = 1
+        self.start = float(trajectory.times[0])
+        self.end = float(trajectory.times[-1])
+        self.loaded = None  # (first sample number, times, states) of the loaded pair
+        self.numbers = list(self.objects.keys())  # body of every row of positions
+        self.seek(self.start)
+
+    set_timescale = Game.set_timescale
+
+    def set_integrator(self, integrator):
+        pass  # nothing is integrated
+
+    def timestep(self, seconds):
+        if self.paused:
+            return
+        self.seek(self.time + self.direction * self.delta_t * seconds)
+        if self.time in (self.start, self.end):
+            self.paused = True  # stop at both ends
+
+    def seek(self, time):
+        """jump to a simulated time (clamped to the recorded range)"""
+        self.time = minmax(time, self.start, self.end)
+        times = self.trajectory.times
+        first = minmax(int(np.searchsorted(times, self.time, side="right")) - 1, 0, max(len(times) - 2, 0))
+        if self.loaded is None or self.loaded[0] != first:
+            self.loaded = (first,) + self.trajectory.samples(first, first + 2)
+        first, times, states = self.loaded
+        if len(times) == 1:
+            positions, velocities = states[0, :, :3], states[0, :, 3:]
+        else:
+            positions, velocities = hermite(self.time, times[0], times[1], states[0], states[1])
+        for body, pos, vel in zip(self.objects.values(), positions.tolist(), velocities.tolist()):
+            if pos[0] == pos[0]:  # nan after the body was merged away
+                body.position = pygame.math.Vector3(pos)
+                body.velocity = pygame.math.Vector3(vel)
+        self.positions = positions  # bodies and test particles, for the Viewer
+        self.particles.positions = positions[self.n_massive:]
+        self.particles.velocities = velocities[self.n_massive:]
+
+    def seek_fraction(self, fraction):
+        """jump to a fraction (0..1) of the recorded time range"""
+        self.seek(self.start + minmax(fraction, 0, 1) * (self.end - self.start))
+
+    def fraction(self):
+        return (self.time - self.start) / (self.end - self.start) if self.end > self.start else 0.0
+
+
+# ---------------------------- checkpoints ----------------------------------
+# A checkpoint holds everything the next physics step depends on:
+#   8 bytes magic b"SSCHK001", uint64 length of the json metadata, the json
+#   (utf-8, padded with spaces to a multiple of 64 bytes together with the first 16 bytes),
+#   then the arrays listed in meta["arrays"] one after another, little endian:
+#   numbers (int64), masses, radii (nan: None), bosses (int64, -1: none),
+#   positions and velocities (float64, one row per body and test particle) and,
+#   if the integrator had them, the cached accelerations and the state at the
+#   epoch of the kepler integrator (kepler_positions, kepler_velocities)
+
+CHECKPOINT_MAGIC = b"SSCHK001"
+
+
+def checkpoint_state(game, extra=None):
+    """copies the complete state of game: (metadata dict, {name: array}).
+       Positions and velocities come from the backend, which is ahead of the
+       CelestialBody vectors during a frame. extra is stored as meta["extra"]"""
+    backend = game.backend
+    positions, velocities = state_arrays(backend)
+    bodies = [game.objects[number] for number in backend.numbers]
+    arrays = {"numbers": np.array(backend.numbers, dtype=np.int64),
+              "masses": np.array([b.mass for b in bodies], dtype=float),
+              "radii": np.array([np.nan if b.radius is None else b.radius for b in bodies], dtype=float),
+              "bosses": np.array([-1 if b.boss is None else b.boss.number for b in bodies], dtype=np.int64),
+              "positions": np.array(positions, dtype=float), "velocities": np.array(velocities, dtype=float)}
+    if backend.cached_acc is not None:
+        arrays["cached_acc"] = np.array([tuple(a) for a in backend.cached_acc] if isinstance(backend.cached_acc, list)
+                                        else backend.cached_acc, dtype=float).reshape(-1, 3)
+    propagator = current_kepler(backend)
+    if propagator is not None:  # the kepler integrator goes on with the orbits of its epoch
+        arrays["kepler_positions"], arrays["kepler_velocities"] = propagator.epoch_state
+    meta = {"version": 1, "time": game.time, "accumulator": game.accumulator, "i": game.i,
+            "delta_t": game.delta_t, "paused": game.paused, "integrator": game.integrator, "max_step": game.max_step,
+            "backend": backend.name, "backend_options": {name: getattr(backend, name) for name in backend.options},
+            "rk45_substep": getattr(backend, "rk45_substep", None), "next_number": game.objects.next_number,
+            "names": [b.name for b in bodies], "particle_names": list(game.particles.names),
+            "kepler_epoch": None if propagator is None else propagator.epoch,
+            "arrays": [[name, array.dtype.str, list(array.shape)] for name, array in arrays.items()],
+            "extra": extra}
+    return meta, arrays
+
+
+def write_checkpoint(filename, meta, arrays):
+    """writes a checkpoint file. It appears under its name only when it is
+       complete, a crash while writing leaves the older checkpoints intact"""
+    text = json.dumps(meta).encode("utf-8")
+    text += b" " * (-(16 + len(text)) % 64)
+    with open(filename + ".tmp", "wb") as f:
+        f.write(CHECKPOINT_MAGIC + struct.pack("<Q", len(text)) + text)
+        for name, dtype, shape in meta["arrays"]:
+            f.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+    os.replace(filename + ".tmp", filename)
+
+
+def read_checkpoint(filename):
+    """returns (metadata dict, {name: array}) of a checkpoint file"""
+    with open(filename, "rb") as f:
+        data = f.read()
+    if data[:8] != CHECKPOINT_MAGIC:
+        raise ValueError("{} is not a checkpoint file".format(filename))
+    length = struct.unpack("<Q", data[8:16])[0]
+    meta = json.loads(data[16:16 + length].decode("utf-8"))
+    offset = 16 + length
+    arrays = {}
+    for name, dtype, shape in meta["arrays"]:
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += count * np.dtype(dtype).itemsize
+    return meta, arrays
+
+
+class Checkpointer:
+    """takes a checkpoint of a game every 'every' simulated years.
+       The state is copied in the physics thread (a few array copies), the
+       files are written by a background thread, so the physics is not
+       stalled by the disk. Files are named path-<year>.chk, only the newest
+       keep files are kept. With observe=True it checks after every physics
+       step, otherwise call save() yourself (run_headless does so after every
+       output interval, where a continuation is bit-identical).
+       save() never waits for the disk: a checkpoint that is still waiting
+       for the writer when the next one comes is skipped (and counted in skipped).
+       Usage: checkpointer = Checkpointer(game, "run", every=10) ... checkpointer.close()"""
+
+    def __init__(self, game, path="checkpoint", every=1.0, keep=3, observe=True):
+        require_numpy("checkpoints")
+        self.game = game
+        self.path = path
+        self.every = every
+        self.keep = keep
+        self.next_time = game.time + every
+        folder, prefix = os.path.split(path)
+        old = sorted(name for name in os.listdir(folder or ".")
+                     if name.startswith(prefix + "-") and name.endswith(".chk"))
+        self.files = collections.deque(os.path.join(folder, name) for name in old)  # oldest first
+        self.queue = queue.Queue(maxsize=1)  # the checkpoint waiting for the writer
+        self.skipped = 0
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+        if observe:
+            game.observers.append(self)
+
+    def __call__(self, game):
+        if self.due():
+            self.save()
+
+    def due(self):
+        """True if the next checkpoint is due"""
+        return self.game.time >= self.next_time - 1e-9 * self.every
+
+    def save(self, extra=None):
+        """take a checkpoint now"""
+        filename = "{}-{:015.6f}.chk".format(self.path, self.game.time)
+        item = (filename, checkpoint_state(self.game, extra))
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:  # the writer is still busy with the one before: the newer state replaces it
+            try:
+                skipped = self.queue.get_nowait()
+            except queue.Empty:  # taken by the writer just now
+                skipped = None
+            if skipped is not None:
+                self.skipped += 1
+                print("checkpoint {} skipped, the disk is slower than the physics".format(skipped[0]))
+            self.queue.put_nowait(item)
+        self.next_time = self.game.time + self.every
+        return filename
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            filename, (meta, arrays) = item
+            try:
+                write_checkpoint(filename, meta, arrays)
+            except OSError as error:
+                print("checkpoint {} failed: {}".format(filename, error))
+                continue
+            if filename not in self.files:
+                self.files.append(filename)
+            while len(self.files) > self.keep:
+                old = self.files.popleft()
+                if os.path.exists(old):
+                    os.remove(old)
+
+    def close(self):
+        """wait until every checkpoint is written"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self in self.game.observers:
+            self.game.observers.remove(self)
+
+
+# ---------------------------- physics worker ---------------------------------
+# PhysicsWorker runs a Game in its own process, so the physics and the
+# Viewer do not share the GIL. The worker publishes the state (x, y, z, vx, vy, vz
+# of every row) into a shared memory block of float64 with two buffers:
+#   header: publications so far, front (0 or 1: the newest buffer), capacity (rows), 0
+#   buffer 0 and buffer 1: sequence, time, generation (changes with seek or removed bodies),
+#                          rows, capacity * 6 values
+# The worker always writes the buffer that is not the front one and flips front
+# afterwards. The sequence of a buffer is odd while the worker writes it, the Viewer
+# copies the front buffer and tries again unless its sequence was even and the
+# same before and after the copy
+
+WORKER_HEADER = 4
+BUFFER_HEADER = 4
+
+
+def add_observers(game, record=None, record_every=1.0, diagnostics=0, collisions=None, encounter_distance=0.0,
+                  checkpoint=None, checkpoint_every=1.0, checkpoint_keep=3, observe_checkpoints=True):
+    """create the optional observers of main() for game, record_every in days.
+       Returns (recorder, diagnostics, checkpointer), each may be None"""
+    recorder = TrajectoryRecorder(game, record, record_every / 365.25) if record else None
+    diagnostics = Diagnostics(game, diagnostics) if diagnostics > 0 and np is not None else None
+    if collisions:
+        Collisions(game, collisions, encounter_distance)
+    checkpointer = None
+    if checkpoint:
+        checkpointer = Checkpointer(game, checkpoint, checkpoint_every, checkpoint_keep, observe=observe_checkpoints)
+    return recorder, diagnostics, checkpointer
+
+
+def physics_worker(meta, arrays, memory_name, connection, options, publish_interval):
+    """main function of the worker process: rebuilds the game from
+       checkpoint_state, then runs game.timestep in real time and publishes the
+       state at most every publish_interval seconds. Commands from the
+       PhysicsWorker arrive as (name, value) through connection"""
+    game = Game.from_state(meta, arrays)
+    recorder, diagnostics, checkpointer = add_observers(game, **options)
+    memory = shared_memory.SharedMemory(name=memory_name)
+    header = np.ndarray((WORKER_HEADER,), dtype=float, buffer=memory.buf)
+    capacity = int(header[2])
+    buffers = [np.ndarray((BUFFER_HEADER + capacity * 6,), dtype=float, buffer=memory.buf,
+                          offset=8 * (WORKER_HEADER + i * (BUFFER_HEADER + capacity * 6))) for i in (0, 1)]
+    generation = 0
+    numbers = list(game.backend.numbers)
+    measurements = None
+    published = last = time.perf_counter()
+    state = None
+    running = True
+    changed = True  # publish the start state at once
+    try:
+        while running:
+            while connection.poll():
+                command, value = connection.recv()
+                if command == "stop":
+                    running = False
+                elif command == "paused":
+                    game.paused = value
+                elif command == "timescale":
+                    game.set_timescale(value)
+                elif command == "integrator":
+                    game.set_integrator(value)
+                elif command == "seek":
+                    game.seek(value)
+                    generation += 1
+                changed = True
+            now = time.perf_counter()
+            before = game.time
+            game.timestep(min(now - last, 0.05))  # short slices: commands are not kept waiting
+            last = now
+            if game.backend.numbers != numbers:  # bodies were merged
+                numbers = list(game.backend.numbers)
+                generation += 1
+                connection.send(("numbers", (generation, numbers)))
+                changed = True
+            if diagnostics is not None and diagnostics.measurements != measurements:
+                measurements = diagnostics.measurements
+                connection.send(("diagnostics", diagnostics.text()))
+            if changed or (game.time != before and now - published >= publish_interval):
+                positions, velocities = state_arrays(game.backend)
+                rows = len(positions)
+                if rows > capacity:
+                    raise ValueError("the physics worker has room for {} rows, not {}".format(capacity, rows))
+                front = 1 - int(header[1])
+                buffer = buffers[front]
+                buffer[0] += 1  # odd: being written
+                buffer[1], buffer[2], buffer[3] = game.time, generation, rows
+                state = buffer[BUFFER_HEADER:BUFFER_HEADER + rows * 6].reshape(rows, 6)
+                state[:, :3], state[:, 3:] = positions, velocities
+                buffer[0] += 1  # even: complete
+                header[1] = front
+                header[0] += 1
+                published = now
+                changed = False
+            elif game.time == before:
+                time.sleep(0.001)  # paused or less than one step due
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if checkpointer is not None:
+            checkpointer.save()
+            checkpointer.close()
+        header = buffers = state = None  # no views of the shared memory may remain
+        memory.close()
+
+
+class RemoteDiagnostics:
+    """the log line of the Diagnostics that runs in the physics worker"""
+
+    def __init__(self):
+        self.measurements = 0
+        self.line = "waiting for the physics worker..."
+
+    def text(self):
+        return self.line
+
+
+class PhysicsWorker:
+    """stands in for a Game in the Viewer while the game itself runs in a
+       worker process (see physics_worker). The Viewer renders the newest
+       snapshot from shared memory, interpolated (Hermite, with the
+       velocities) between the last two snapshots, so the frame rate does not
+       depend on the physics rate. options are the keyword arguments of
+       add_observers, the observers are created in the worker.
+       Usage: worker = PhysicsWorker(game) ... Viewer(worker) ... worker.close()"""
+
+    publish_interval = 1 / 120  # seconds between two snapshots at most
+
+    def __init__(self, game, **options):
+        require_numpy("the physics worker")
+        if shared_memory is None:
+            raise ImportError("the physics worker needs python 3.8 or newer (multiprocessing.shared_memory)")
+        game.backend.sync()
+        meta, arrays = checkpoint_state(game)
+        self.integrator = game.integrator
+        self.i, self.delta_t = game.i, game.delta_t
+        self.time = game.time
+        self._paused = game.paused
+        self.objects = BodyStore()
+        for body in game.objects.values():
+            replay_body = ReplayBody(body.name, body.mass, body.radius)
+            replay_body.position, replay_body.velocity = pygame.math.Vector3(body.position), pygame.math.Vector3(body.velocity)
+            self.objects.next_number = body.number
+            self.objects.add(replay_body)
+        self.numbers = list(game.backend.numbers)
+        self.removed = []
+        self.particles = TestParticles()
+        self.particles.names = list(game.particles.names)
+        self.observers = []
+        self.timer = None
+        self.diagnostics = RemoteDiagnostics() if options.get("diagnostics", 0) > 0 else None
+        positions, velocities = state_arrays(game.backend)
+        self.positions = positions.copy()
+        self.particles.positions = self.positions[len(self.numbers):]
+        capacity = len(positions)
+        size = BUFFER_HEADER + capacity * 6
+        self.memory = shared_memory.SharedMemory(create=True, size=8 * (WORKER_HEADER + 2 * size))
+        self.header = np.ndarray((WORKER_HEADER,), dtype=float, buffer=self.memory.buf)
+        self.header[:] = (0, 0, capacity, 0)
+        self.buffers = [np.ndarray((size,), dtype=float, buffer=self.memory.buf,
+                                   offset=8 * (WORKER_HEADER + i * size)) for i in (0, 1)]
+        for buffer in self.buffers:
+            buffer[:BUFFER_HEADER] = 0
+        self.sequence = 0  # publications read
+        self.generation = 0
+        self.pending = {}  # {generation: body numbers from then on}
+        self.snapshots = collections.deque(maxlen=2)  # (arrival time, time, generation, state)
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=physics_worker, daemon=True,
+                                               args=(meta, arrays, self.memory.name, child, options,
+                                                     self.publish_interval))
+        self.process.start()
+
+    @property
+    def paused(self):
+        return self._paused
+
+    @paused.setter
+    def paused(self, value):
+        self._paused = value
+        self.connection.send(("paused", value))
+
+    def set_timescale(self, i):
+        Game.set_timescale(self, i)
+        self.connection.send(("timescale", self.i))
+
+    def set_integrator(self, integrator):
+        if integrator not in Game.integrators:
+            raise ValueError("unknown integrator {!r}, choose one of {}".format(integrator, list(Game.integrators)))
+        self.integrator = integrator
+        self.connection.send(("integrator", integrator))
+
+    def seek(self, year):
+        """jump to year on the two-body orbits, see Game.seek"""
+        self.connection.send(("seek", year))
+
+    def receive(self):
+        """messages of the worker: removed bodies and diagnostics"""
+        while self.connection.poll():
+            message, value = self.connection.recv()
+            if message == "numbers":
+                generation, numbers = value
+                self.pending[generation] = numbers  # used with the first snapshot of that generation
+            elif message == "diagnostics":
+                self.diagnostics.line = value
+                self.diagnostics.measurements += 1
+
+    def snapshot(self):
+        """copy the newest snapshot out of shared memory, if there is one"""
+        while True:
+            sequence = self.header[0]
+            if sequence == self.sequence:
+                return
+            buffer = self.buffers[int(self.header[1])]
+            begin = buffer[0]
+            if begin % 2:
+                continue  # the worker is writing it right now
+            simulated, generation, rows = buffer[1], buffer[2], int(buffer[3])
+            state = buffer[BUFFER_HEADER:BUFFER_HEADER + rows * 6].reshape(rows, 6).copy()
+            if buffer[0] == begin:  # the worker did not touch this buffer meanwhile
+                break
+        self.sequence = sequence
+        if generation != self.generation:
+            self.generation = generation
+            self.snapshots.clear()  # after a jump or a merge there is nothing to interpolate
+            for old in [g for g in self.pending if g <= generation]:
+                numbers = self.pending.pop(old)
+                kept = set(numbers)
+                for number in self.numbers:
+                    if number not in kept:
+                        self.objects.remove(number)
+                        self.removed.append(number)
+                self.numbers = numbers
+        self.snapshots.append((time.perf_counter(), simulated, generation, state))
+
+    def timestep(self, seconds):
+        """show the state one snapshot interval in the past: between the last two
+           snapshots, at the fraction of the interval the newest one is old"""
+        if not self.process.is_alive():
+            raise RuntimeError("the physics worker stopped (exit code {})".format(self.process.exitcode))
+        self.receive()
+        self.snapshot()
+        if not self.snapshots:
+            return
+        arrived, simulated, generation, state = self.snapshots[-1]
+        if len(self.snapshots) == 2:
+            arrived0, simulated0, generation0, state0 = self.snapshots[0]
+            fraction = minmax((time.perf_counter() - arrived) / max(arrived - arrived0, 1e-6), 0.0, 1.0)
+            self.time = simulated0 + fraction * (simulated - simulated0)
+            # positions of the cubic hermite interpolation, the velocities are not needed
+            h, u = simulated - simulated0, fraction
+            positions = (2*u**3 - 3*u**2 + 1) * state0[:, :3]
+            positions += ((u**3 - 2*u**2 + u) * h) * state0[:, 3:]
+            positions += (-2*u**3 + 3*u**2) * state[:, :3]
+            positions += ((u**3 - u**2) * h) * state[:, 3:]
+        else:
+            self.time = simulated
+            positions = state[:, :3]
+        self.positions = positions
+        self.particles.positions = positions[len(self.numbers):]
+
+    def close(self):
+        """stop the worker (it closes its recorder and saves a last checkpoint)
+           and free the shared memory"""
+        if self.process.is_alive():
+            self.connection.send(("stop", None))
+            self.process.join(30)
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+        del self.header, self.buffers
+        self.memory.close()
+        self.memory.unlink()
+
+
+# ---------------------------- state streaming --------------------------------
+# A StateServer runs one Game and streams its state to any number of local
+# clients over TCP (127.0.0.1) or a Unix socket. Every frame is a uint32 length
+# followed by the payload, little endian. The first byte of the payload is the type:
+#   b"M" json metadata: format, names and numbers of the subscribed rows, columns (3: x, y, z,
+#        6: also vx, vy, vz), sent after every (re)subscription and when bodies are removed
+#   b"K" key frame: time (float64), rows (uint32), rows * columns float64 values
+#   b"D" delta frame: time (float64), changed rows (uint32), their indices (uint32), then
+#        their values minus the key frame as float32. Rows that did not change are left out
+# Clients send json lines: {"bodies": ["earth", "mars"] or null for all rows (bodies and
+# test particles), "rate": frames per second, "delta": true, "velocities": false}, nothing is
+# sent before the first request ("{}" takes the defaults)
+
+STREAM_FORMAT = "SSSTREAM1"
+FRAME_HEADER = struct.Struct("<I")
+STATE_HEADER = struct.Struct("<dI")
+
+
+def parse_address(address):
+    """"7000" or "localhost:7000" is a tcp port: (host, port, None),
+       anything else the path of a unix socket: (None, None, path)"""
+    address = str(address)
+    if address.isdigit():
+        return "127.0.0.1", int(address), None
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit() and os.sep not in address:
+        return host or "127.0.0.1", int(port), None
+    return None, None, address
+
+
+def check_local(host):
+    """the state server is for processes on this machine only"""
+    if host == "localhost":
+        return
+    try:
+        loopback = ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback:
+        raise ValueError("the state server only listens on localhost, not on {!r}".format(host))
+
+
+class Subscriber:
+    """one client of a StateServer: what it wants and what it got so far"""
 
-        # automatically assign a number
-        self.number = CelestialBody.number
-        CelestialBody.number += 1
-        # automatically insert into Game.objects
-        Game.objects[self.number] = self
-        if self.name is None:
-            self.name = "planet_{}".format(self.number)
+    key_every = 30  # frames between two key frames, the float32 deltas stay small
 
+    def __init__(self, writer):
+        self.writer = writer
+        self.bodies = None  # names or numbers, None: every row
+        self.rate = 30.0
+        self.delta = True
+        self.columns = 3
+        self.next_time = float("inf")  # nothing is sent before the first request
+        self.numbers = None  # backend.numbers the rows belong to
+        self.rows = None
+        self.key = None  # values of the last key frame
+        self.offsets = None  # float32 values minus key the client has
+        self.since_key = 0
+        self.dropped = 0  # frames skipped because the client reads too slowly
 
-class VectorSprite(pygame.sprite.Sprite):
-    """base class for sprites. this class inherits from pygames sprite class"""
+    def configure(self, request, max_rate):
+        """apply a request, a bad one raises ValueError and changes nothing"""
+        if not isinstance(request, dict):
+            raise ValueError("a request must be a json object")
+        unknown = set(request) - {"bodies", "rate", "delta", "velocities"}
+        if unknown:
+            raise ValueError("unknown request keys {}".format(sorted(unknown)))
+        bodies = request.get("bodies", self.bodies)
+        if bodies is not None and (not isinstance(bodies, list) or not all(
+                isinstance(b, str) or (isinstance(b, int) and not isinstance(b, bool)) for b in bodies)):
+            raise ValueError("bodies must be a list of names or numbers, or null")
+        rate = minmax(float(request["rate"]), 0.1, max_rate) if "rate" in request else self.rate
+        self.bodies, self.rate = bodies, rate
+        if "delta" in request:
+            self.delta = bool(request["delta"])
+        if "velocities" in request:
+            self.columns = 6 if request["velocities"] else 3
+        self.numbers = None  # resolve the rows again and start with a key frame
+        self.next_time = 0.0
+
+    def resolve(self, game, numbers):
+        """rows of the subscribed bodies in the backend arrays and the metadata frame"""
+        particles = {name: len(numbers) + i for i, name in enumerate(game.particles.names)}
+        if self.bodies is None:
+            rows = list(range(len(numbers) + len(game.particles)))
+        else:
+            index = {number: i for i, number in enumerate(numbers)}
+            rows = []
+            for body in self.bodies:
+                if body in game.objects and game.objects[body].number in index:
+                    rows.append(index[game.objects[body].number])
+                elif body in particles:
+                    rows.append(particles[body])
+            # unknown or removed bodies are left out, the metadata lists what is sent
+        self.rows = np.array(rows, dtype=int)
+        self.numbers = numbers
+        self.key = None
+        names = [game.objects[numbers[r]].name if r < len(numbers) else game.particles.names[r - len(numbers)]
+                 for r in rows]
+        meta = {"format": STREAM_FORMAT, "names": names, "columns": self.columns,
+                "numbers": [numbers[r] if r < len(numbers) else None for r in rows]}
+        return frame(b"M" + json.dumps(meta).encode("utf-8"))
+
+    def encode(self, time, values):
+        """a key frame or a delta frame against the last key frame"""
+        if self.key is None or not self.delta or self.since_key >= self.key_every:
+            self.key = values.copy()
+            self.offsets = np.zeros(values.shape, dtype=np.float32)
+            self.since_key = 0
+            return frame(b"K" + STATE_HEADER.pack(time, len(values)) + values.astype("<f8").tobytes())
+        offsets = (values - self.key).astype(np.float32)
+        changed = np.flatnonzero((offsets != self.offsets).any(axis=1))
+        self.offsets[changed] = offsets[changed]
+        self.since_key += 1
+        return frame(b"D" + STATE_HEADER.pack(time, len(changed)) + changed.astype("<u4").tobytes()
+                     + offsets[changed].astype("<f4").tobytes())
+
+
+def frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class StateServer:
+    """runs game in real time (like the Viewer, delta_t years per second) and
+       streams its state to the clients of a local tcp port or unix socket,
+       each with its own subscription, rate and encoding (see above).
+       A client that reads too slowly loses frames instead of slowing down
+       the simulation, it gets a key frame as soon as it caught up.
+       Usage: StateServer(game, "7000").run(), then e.g. stream_states("7000")"""
+
+    max_rate = 120.0  # frames per second and client at most
+    buffer_limit = 1 << 20  # bytes waiting for a client before frames are dropped
+
+    def __init__(self, game, address="7000"):
+        require_numpy("the state server")
+        self.game = game
+        self.host, self.port, self.path = parse_address(address)
+        if self.host is not None:
+            check_local(self.host)
+        self.clients = set()
+        self.server = None
+        self.running = False
+        self.frames = 0  # sent frames, all clients together
+
+    async def handle(self, reader, writer):
+        client = Subscriber(writer)
+        self.clients.add(client)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    client.configure(json.loads(line), self.max_rate)
+                except (ValueError, TypeError) as error:  # also bad json
+                    writer.write(frame(b"M" + json.dumps({"error": str(error)}).encode("utf-8")))
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(client)
+            writer.close()
+
+    def broadcast(self, now):
+        """send a frame to every client that is due"""
+        backend = self.game.backend
+        state = None
+        for client in list(self.clients):
+            if now < client.next_time or client.writer.is_closing():
+                continue
+            client.next_time = now + 1 / client.rate
+            if client.writer.transport.get_write_buffer_size() > self.buffer_limit:
+                client.dropped += 1
+                client.key = None  # the deltas would refer to frames the client never got
+                continue
+            try:
+                if client.numbers is not backend.numbers:
+                    client.writer.write(client.resolve(self.game, backend.numbers))
+                if state is None:
+                    state = np.hstack(state_arrays(backend))
+                client.writer.write(client.encode(self.game.time, state[client.rows, :client.columns]))
+            except Exception as error:  # one broken client must not stop the server
+                print("state server: client dropped: {!r}".format(error))
+                self.clients.discard(client)
+                client.writer.close()
+                continue
+            self.frames += 1
+
+    async def serve(self, years=None):
+        """run the simulation and the server until stop() or, with years, until
+           years of simulated time have passed"""
+        if self.path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        else:
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+            self.port = self.server.sockets[0].getsockname()[1]  # port 0 picks a free one
+        end = None if years is None else self.game.time + years
+        self.running = True
+        last = time.perf_counter()
+        try:
+            while self.running and (end is None or self.game.time < end):
+                now = time.perf_counter()
+                before = self.game.time
+                self.game.timestep(min(now - last, 0.05))  # short slices keep the clients served
+                last = now
+                self.broadcast(now)
+                await asyncio.sleep(0 if self.game.time != before else 0.001)
+        finally:
+            self.running = False
+            self.server.close()
+            for client in list(self.clients):
+                client.writer.close()
+            await self.server.wait_closed()
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def run(self, years=None):
+        """blocking: serve until Ctrl-C (or years)"""
+        try:
+            asyncio.run(self.serve(years))
+        except KeyboardInterrupt:
+            pass
+
+    def stop(self):
+        self.running = False
+
+
+class StateDecoder:
+    """client side of the stream: turns payloads back into states.
+       decode() returns ("meta", dict) or ("state", time, values) with
+       values of shape (rows, columns) in the order of meta["names"]"""
+
+    def __init__(self):
+        self.meta = None
+        self.key = None
+        self.values = None
+
+    def decode(self, payload):
+        kind, body = payload[:1], payload[1:]
+        if kind == b"M":
+            self.meta = json.loads(body.decode("utf-8"))
+            if "error" in self.meta:
+                raise ValueError("state server: {}".format(self.meta["error"]))
+            self.key = None
+            return "meta", self.meta
+        time, count = STATE_HEADER.unpack_from(body)
+        data = memoryview(body)[STATE_HEADER.size:]
+        columns = self.meta["columns"]
+        if kind == b"K":
+            self.key = np.frombuffer(data, dtype="<f8", count=count * columns).reshape(count, columns).copy()
+            self.values = self.key.copy()
+        elif kind == b"D":
+            if self.key is None:
+                raise ValueError("delta frame without key frame")
+            rows = np.frombuffer(data, dtype="<u4", count=count)
+            offsets = np.frombuffer(data, dtype="<f4", count=count * columns, offset=4 * count).reshape(count, columns)
+            self.values[rows] = self.key[rows] + offsets
+        else:
+            raise ValueError("unknown frame type {!r}".format(kind))
+        return "state", time, self.values
+
+
+async def stream_states(address="7000", bodies=None, rate=30.0, delta=True, velocities=False):
+    """async generator of (time, names, values) from a StateServer.
+       Usage: async for time, names, values in stream_states("7000", ["earth"]): ..."""
+    host, port, path = parse_address(address)
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    request = {"bodies": bodies, "rate": rate, "delta": delta, "velocities": velocities}
+    writer.write(json.dumps(request).encode("utf-8") + b"\n")
+    decoder = StateDecoder()
+    try:
+        while True:
+            try:
+                length, = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                payload = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                return  # the server stopped
+            result = decoder.decode(payload)
+            if result[0] == "state":
+                yield result[1], decoder.meta["names"], result[2]
+    finally:
+        writer.close()
+
+
+class VectorSprite(pygame.sprite.DirtySprite):
+    """base class for sprites. this class inherits from pygames dirty sprite class,
+       all sprites move and are redrawn every frame (dirty = 2)"""
     number = 0
     numbers = {}  # { number, Sprite }
 
     def __init__(self, **kwargs):
+        self.dirty = 2  # must exist before visible is set
         self._default_parameters(**kwargs)
         self._overwrite_parameters()
-        pygame.sprite.Sprite.__init__(self, self.groups)  # call parent class. NEVER FORGET !
+        visible = self.visible
+        pygame.sprite.DirtySprite.__init__(self, self.groups)  # call parent class. NEVER FORGET !
+        self.dirty = 2
+        self.visible = visible
         self.number = VectorSprite.number  # unique number for each sprite
         VectorSprite.number += 1
         VectorSprite.numbers[self.number] = self
@@ -348,7 +3161,6 @@ class VectorSprite(pygame.sprite.Sprite):
         # ----- kill because... ------
         # if self.hitpoints <= 0:
         #    self.kill()
-        # TODO: pygame.DirtySprite verwenden, mit dirty und visible flag
         if self.age < 0:
             self.visible = False
         else:
@@ -416,13 +3228,98 @@ class VectorSprite(pygame.sprite.Sprite):
             elif self.warp_on_edge:
                 self.pos.y = 0
 
+def merge_rects(rects):
+    """unions overlapping rects until no two of them overlap any more,
+       so no screen area is updated twice"""
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        if rect.width <= 0 or rect.height <= 0:
+            continue
+        overlapping = rect.collidelistall(merged)
+        while overlapping:
+            for i in reversed(overlapping):
+                rect.union_ip(merged.pop(i))
+            overlapping = rect.collidelistall(merged)
+        merged.append(rect)
+    return merged
+
+
+def points_rect(points, width=1):
+    """bounding rect of a list of (x, y) pixel points, grown by width"""
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    left, top = int(math.floor(min(xs))) - width, int(math.floor(min(ys))) - width
+    return pygame.Rect(left, top, int(math.ceil(max(xs))) + width + 1 - left, int(math.ceil(max(ys))) + width + 1 - top)
+
+
+class Tracer:
+    """fixed capacity ring buffer of world positions (x, y in AU) for the
+       tracer line of a planet. Appending is O(1) and, because the points are
+       not pixels, the tracer survives zooming and panning"""
+
+    capacity = 10000  # upper limit of PlanetSprite.history
+
+    def __init__(self):
+        self.appended = 0  # how many points were appended ever
+        if np is not None:
+            self.points = np.zeros((Tracer.capacity, 2))
+            self.start = 0  # index of the oldest point
+            self.size = 0
+        else:
+            self.points = collections.deque(maxlen=Tracer.capacity)
+
+    def __len__(self):
+        return self.size if np is not None else len(self.points)
+
+    def clear(self):
+        if np is not None:
+            self.size = 0
+        else:
+            self.points.clear()
+
+    def append(self, x, y):
+        if np is None:
+            if not self.points or self.points[-1] != (x, y):
+                self.points.append((x, y))
+                self.appended += 1
+            return
+        end = (self.start + self.size) % Tracer.capacity
+        if self.size and self.points[end - 1, 0] == x and self.points[end - 1, 1] == y:
+            return  # not moved, e.g. paused
+        self.points[end] = x, y
+        self.appended += 1
+        if self.size < Tracer.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % Tracer.capacity
+
+    def pixels(self, n):
+        """the newest n points projected to screen pixels in one go,
+           as a list of (x, y) for pygame.draw.lines"""
+        n = min(n, len(self))
+        if np is None:
+            points = list(self.points)[len(self.points) - n:]
+            return [(Viewer.zero[0] + Viewer.grid_size[0] * x, Viewer.zero[1] + Viewer.grid_size[1] * y)
+                    for x, y in points]
+        first = (self.start + self.size - n) % Tracer.capacity
+        if first + n <= Tracer.capacity:
+            points = self.points[first:first + n]
+        else:
+            points = np.concatenate((self.points[first:], self.points[:first + n - Tracer.capacity]))
+        return (points * Viewer.grid_size + Viewer.zero).tolist()
+
+
 class PlanetSprite(VectorSprite):
 
-    history = 300 # how many positions are saved to draw tracer lines
+    history = 300 # how many positions are drawn as tracer line
 
     def _overwrite_parameters(self):
         super()._overwrite_parameters()
-        self.oldposlist = [self.pos, self.pos]
+        self.visible = True
+        self.tracer = Tracer()
+        self.drawn = []  # pixel points of the tracer line drawn last frame
+        self.drawn_appended = 0  # tracer.appended when it was drawn
 
     def create_image(self):
         self.image = pygame.Surface((2*self.radius,2*self.radius))
@@ -433,10 +3330,32 @@ class PlanetSprite(VectorSprite):
         self.rect = self.image.get_rect()
 
     def update(self, seconds):
-        super().update(seconds)
-        self.oldposlist.append(self.pos)
-        if len(self.oldposlist)> self.history:
-            self.oldposlist.pop(0)
+        """nothing to do: planets neither age nor bounce, rect and tracer are
+           set for all planets at once by Viewer.project_sprites"""
+        pass
+
+    def tracer_changes(self):
+        """projects the tracer for this frame and returns the rects of the
+           segments that appeared or disappeared since the last frame"""
+        old = self.drawn
+        self.points = self.tracer.pixels(self.history)
+        new = self.points
+        added = self.tracer.appended - self.drawn_appended  # new points at the end
+        removed = len(old) + added - len(new)  # points gone at the start
+        self.drawn, self.drawn_appended = new, self.tracer.appended
+        rects = []
+        if added > 0 and len(new) > 1:
+            rects.append(points_rect(new[-(added + 1):]))
+        if removed > 0 and len(old) > 1:
+            rects.append(points_rect(old[:removed + 1]))
+        elif removed < 0 and len(new) > 1:  # tracer got longer at the start
+            rects.append(points_rect(new[:-removed + 1]))
+        return rects
+
+    def draw_tracer(self, surface):
+        """draws the tracer line of tracer_changes with one call"""
+        if len(self.points) >= 2:
+            pygame.draw.lines(surface, self.color, False, self.points)
 
 
 class Flytext(VectorSprite):
@@ -461,20 +3380,108 @@ class Flytext(VectorSprite):
         VectorSprite.update(self, seconds)
 
 
+class FrameTimer:
+    """lap timer for the phases of a frame: mark(phase) books the time since
+       the previous mark on phase, end_frame() closes the frame. The last
+       window frames are kept for rolling averages and percentiles, with
+       output every frame is streamed as one row (milliseconds) to a csv file"""
+
+    def __init__(self, phases, window=120, output=None):
+        self.phases = list(phases)
+        self.history = {phase: collections.deque(maxlen=window) for phase in self.phases}
+        self.totals = collections.deque(maxlen=window)
+        self.current = dict.fromkeys(self.phases, 0.0)
+        self.frames = 0
+        self.frame_start = self.last = time.perf_counter()
+        self.file = open(output, "w", newline="") if output is not None else None
+        self.writer = csv.writer(self.file) if self.file is not None else None
+        if self.writer is not None:
+            self.writer.writerow(["frame", "total"] + self.phases)
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.current[phase] += now - self.last
+        self.last = now
+
+    def end_frame(self):
+        now = time.perf_counter()
+        total = now - self.frame_start
+        self.totals.append(total)
+        for phase in self.phases:
+            self.history[phase].append(self.current[phase])
+            self.current[phase] = 0.0
+        if self.writer is not None:
+            self.writer.writerow([self.frames, "{:.3f}".format(total * 1000)] +
+                                 ["{:.3f}".format(self.history[phase][-1] * 1000) for phase in self.phases])
+        self.frames += 1
+        self.frame_start = self.last = now
+
+    @staticmethod
+    def statistics(values):
+        """mean, median, 95th percentile and maximum in milliseconds"""
+        if not values:
+            return 0.0, 0.0, 0.0, 0.0
+        ordered = sorted(values)
+        n = len(ordered)
+        return (1000 * sum(ordered) / n, 1000 * ordered[n // 2],
+                1000 * ordered[min(n - 1, int(0.95 * n))], 1000 * ordered[-1])
+
+    def report(self):
+        """one text line per phase and one for the whole frame"""
+        lines = ["{:<10}{:>7}{:>7}{:>7}{:>7}".format("ms", "mean", "p50", "p95", "max")]
+        for phase in self.phases + ["frame"]:
+            values = self.totals if phase == "frame" else self.history[phase]
+            lines.append("{:<10}{:7.2f}{:7.2f}{:7.2f}{:7.2f}".format(phase, *self.statistics(values)))
+        return lines
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = self.writer = None
+
+
 class Viewer():
     width = 0  # screen x resolution in pixel
     height = 0  # screen y resolution in pixel
     log_height = 0 # log/gui area below screen
     images = {}
     grid_size = (0,0) # how many pixel lenght has a grid cell x,y
+    zoom = 0 # grid_size is 200 * 1.1 ** zoom, whole zoom steps find their cached grid again
     intervals = (0, 0) # how many cells on screen (x, y)
     zero = [0,0] # origin of coordinate system in pixel x, y
+    particle_color = (200, 200, 200)
+    # level of detail: only the max_sprites heaviest bodies get a PlanetSprite (with tracer),
+    # all other bodies and the test particles are culled and rasterized in bulk
+    max_sprites = 64
+    raster_modes = ("auto", "points", "density") # [d] key, auto: density above density_threshold
+    density_threshold = 20000 # visible small bodies
+    density_cell = 4 # pixel size of a cell of the density map
+    grid_cache_size = 8 # zoom levels with a cached grid surface
+    # phases of a frame in the order of run(), sync, integrate and store are booked by Game.timestep
+    phases = ("wait", "sync", "integrate", "store", "physics", "events", "sprites",
+              "tracers", "particles", "draw", "text", "flip")
 
 
-    def __init__(self, game, width=640, height=400, fps=60, ):
+    def __init__(self, game, width=640, height=400, fps=60, profile=None, diagnostics=100):
         """Initialize pygame, window, background, font,...
-           default arguments """
+           default arguments. game can be a Game or a Replay of a trajectory file.
+           profile is a csv file that gets the phase timings of every frame.
+           diagnostics: physics steps between two measurements of the conserved
+           quantities, unless the game has a Diagnostics already (0: none)"""
         self.game = game
+        self.timer = FrameTimer(Viewer.phases, output=profile)
+        self.show_timings = False # profiling overlay, toggled with [F3]
+        self.game.timer = self.timer
+        self.replay = isinstance(game, Replay)
+        self.scrubbing = False # dragging the timeline of a replay
+        self.diagnostics = None # conserved quantities, shown in the log area
+        if isinstance(game, PhysicsWorker):
+            self.diagnostics = game.diagnostics
+        elif not self.replay and np is not None:
+            self.diagnostics = next((o for o in game.observers if isinstance(o, Diagnostics)), None)
+            if self.diagnostics is None and diagnostics > 0:
+                self.diagnostics = Diagnostics(game, diagnostics)
+        Viewer.log_height = 20 if self.diagnostics is not None else 0
         self.fps = fps
         Viewer.width = width
         Viewer.height = height
@@ -486,7 +3493,8 @@ class Viewer():
         # player center in pixel
 
         self.screen = pygame.display.set_mode((self.width, self.height), pygame.DOUBLEBUF)
-        Viewer.logscreen = pygame.Surface( (Viewer.width, Viewer.height - Viewer.log_height))
+        Viewer.logscreen = pygame.Surface((Viewer.width, max(1, Viewer.log_height)))
+        self.log_measurement = None # diagnostics measurement shown in the log area
         self.clock = pygame.time.Clock()
         self.help = [" -*-*- Welcome to Solar System Simulation -*-*-   ",
                      "press [h] to see this help text again",
@@ -496,10 +3504,19 @@ class Viewer():
                      "zoom out with Keypad [-] key or mousewheel",
                      "return to standard zoom with Keypad [ENTER] key",
                      "toggle pause of simulation with [SPACE] key",
-                     "toggle drawing mode with [BACKSPACE] key",
+                     "toggle drawing mode (dirty rects / full screen) with [BACKSPACE] key",
                      "change simulation speed with [PageUp] / [PageDown] keys",
                      "change tracer length with [Ins] / [Del] keys",
+                     "change integrator with [i] key",
+                     "jump 100 years ahead on the two-body orbits with [j] key",
+                     "show frame timings with [F3] key",
+                     "draw small bodies as points or density map with [d] key",
                      ]
+        if self.replay:
+            self.help += ["replay: seek with [Left] / [Right], [Home] / [End] keys",
+                          "replay: reverse playback with [r] key",
+                          "replay: scrub by dragging the timeline with the left mouse button",
+                          ]
         #"edit planets by editing class Game in the source code",
         # "playing instructions:",
 
@@ -522,12 +3539,18 @@ class Viewer():
         #self.legend = {}
         # self.load_images()
 
+        self.grid_cache = collections.OrderedDict()  # {Viewer.zoom: (surface, zero)}
         self.prepare_spritegroups()
         #self.cursor = CursorSprite(pos=pygame.math.Vector2(x=Viewer.pcx, y=Viewer.pcy))
         self.prepare_sprites()
-        self.resize_grid(200)
+        self.set_zoom(0)
         self.run()
 
+    def set_zoom(self, zoom):
+        """zoom in (positive) or out (negative) in steps of 10 percent"""
+        Viewer.zoom = zoom
+        self.resize_grid(200 * 1.1 ** zoom)
+
     def resize_grid(self, lenght):
 
         Viewer.grid_size = (lenght, lenght)
@@ -539,22 +3562,41 @@ class Viewer():
 
 
     def prepare_sprites(self):
-        for i, planet in enumerate(Game.objects.values()):
+        """sprites for the first body (the sun) and the heaviest bodies, at most
+           max_sprites. The others are drawn by draw_particles"""
+        self.sprites = {} # {body number: PlanetSprite}
+        bodies = list(self.game.objects.values())
+        if len(bodies) > self.max_sprites:
+            heaviest = set(map(id, heapq.nlargest(self.max_sprites - 1, bodies[1:], key=lambda b: b.mass)))
+            bodies = [b for i, b in enumerate(bodies) if i == 0 or id(b) in heaviest]
+        for i, planet in enumerate(bodies):
             if i == 0:
                 c, r =(255,255,0), 30
             else:
                 c, r = (random.randint(50,200), random.randint(50,200), random.randint(50,200)), 15
-            PlanetSprite(pos=gridpos_to_pixelvector(planet.position),
-                         move=pygame.math.Vector2(0,0), color=c, planet=planet, radius=max(2, planet.radius * Viewer.grid_size[0]))
+            self.sprites[planet.number] = PlanetSprite(pos=gridpos_to_pixelvector(planet.position),
+                                                       move=pygame.math.Vector2(0,0), color=c, planet=planet, radius=max(2, planet.radius * Viewer.grid_size[0]))
+
+    def remove_sprites(self):
+        """kill the sprites of bodies the game removed (e.g. merged in a
+           collision) and return the rects of their tracers for repainting"""
+        rects = []
+        while self.game.removed:
+            sprite = self.sprites.pop(self.game.removed.pop(), None)
+            if sprite is not None:
+                if len(sprite.drawn) > 1:
+                    rects.append(points_rect(sprite.drawn))
+                sprite.kill()
+        return rects
 
     def prepare_spritegroups(self):
-        self.allgroup = pygame.sprite.LayeredUpdates()  # for drawing
+        self.allgroup = pygame.sprite.LayeredDirty()  # for drawing, only changed screen areas
         #self.whole_screen_group = pygame.sprite.Group()
-        self.flytextgroup = pygame.sprite.LayeredUpdates()
+        self.flytextgroup = pygame.sprite.Group()
         #self.cursorgroup = pygame.sprite.Group()
         self.planetgroup = pygame.sprite.Group()
         VectorSprite.groups = self.allgroup
-        Flytext.groups =  self.flytextgroup # NOT in allgroup!
+        Flytext.groups = self.allgroup, self.flytextgroup
         PlanetSprite.groups = self.allgroup, self.planetgroup
         #CursorSprite.groups = self.allgroup
 
@@ -583,18 +3625,21 @@ class Viewer():
 
 
     def draw_log(self):
-        # fill logscreen with color
+        """blit the log area below the screen, the text is rendered again
+           only after a new measurement of the diagnostics"""
         if self.log_height > 0:
-            self.logscreen.fill((150, 150, 150))
-            textsf = make_text("sandwich solar system")[0]
-
-            self.logscreen.blit(textsf, (5, 5))
+            if self.log_measurement != self.diagnostics.measurements:
+                self.log_measurement = self.diagnostics.measurements
+                # fill logscreen with color
+                self.logscreen.fill((40, 40, 40))
+                textsf = make_text(self.diagnostics.text(), font_color=(255, 255, 255), font_size=12, cache=False)[0]
+                self.logscreen.blit(textsf, (5, (self.log_height - textsf.get_height()) // 2))
             # ---- blit logscreen ------
             self.screen.blit(self.logscreen, (0, Viewer.height - self.log_height))
+            return pygame.Rect(0, Viewer.height - self.log_height, Viewer.width, self.log_height)
 
-    def draw_grid(self):
-        self.background.fill((0, 0, 0))
-        c = (0,128,0) # dark green color of grid
+    def grid_step(self):
+        """pixel distance between grid lines, precision and format of the labels"""
         step = self.grid_size[0]
         precision = 0
         axis_string = "{:.0f}"
@@ -604,29 +3649,71 @@ class Viewer():
             axis_string = "{:.3f}"
         elif self.grid_size[0] < 60:
             step = 60
-        # right
+        return step, precision, axis_string
+
+    def grid_lines(self):
+        """pixel positions of the vertical (x) and horizontal (y) grid lines"""
+        step = self.grid_step()[0]
+        xs = [int(round(fx, 0)) for fx in float_range(Viewer.zero[0], Viewer.width+1, step)]  # right
+        xs += [int(round(fx, 0)) for fx in float_range(Viewer.zero[0], -1, -step)]  # left
+        ys = [int(round(fy, 0)) for fy in float_range(Viewer.zero[1], Viewer.height+1, step)]  # lower
+        ys += [int(round(fy, 0)) for fy in float_range(Viewer.zero[1], -1, -step)]  # upper
+        return xs, ys
+
+    def draw_grid_lines(self, surface, area):
+        """clear area of surface and draw the grid lines inside of it"""
+        c = (0,128,0) # dark green color of grid
+        surface.set_clip(area)
+        surface.fill((0, 0, 0))
+        xs, ys = self.grid_lines()
+        for x in xs:
+            if area.left <= x < area.right:
+                pygame.draw.line(surface, c, (x,0), (x, Viewer.height-Viewer.log_height),1)
+        for y in ys:
+            if area.top <= y < area.bottom:
+                pygame.draw.line(surface, c, (0,y), (Viewer.width, y),1)
+        surface.set_clip(None)
+
+    def grid_surface(self):
+        """the grid lines for the current zoom and pan.
+           One surface per zoom level is cached. After panning, the cached
+           surface is scrolled and only the newly exposed strips are drawn"""
+        key = Viewer.zoom
+        zero = (int(round(Viewer.zero[0])), int(round(Viewer.zero[1])))
+        full = pygame.Rect(0, 0, Viewer.width, Viewer.height - Viewer.log_height)
+        if key in self.grid_cache:
+            surface, old_zero = self.grid_cache.pop(key)
+            dx, dy = zero[0] - old_zero[0], zero[1] - old_zero[1]
+            if abs(dx) >= full.width or abs(dy) >= full.height:
+                self.draw_grid_lines(surface, full)
+            elif dx or dy:
+                surface.scroll(dx, dy)
+                if dx > 0:
+                    self.draw_grid_lines(surface, pygame.Rect(0, 0, dx, full.height))
+                elif dx < 0:
+                    self.draw_grid_lines(surface, pygame.Rect(full.width + dx, 0, -dx, full.height))
+                if dy > 0:
+                    self.draw_grid_lines(surface, pygame.Rect(0, 0, full.width, dy))
+                elif dy < 0:
+                    self.draw_grid_lines(surface, pygame.Rect(0, full.height + dy, full.width, -dy))
+        else:
+            surface = pygame.Surface(full.size).convert()
+            self.draw_grid_lines(surface, full)
+            while len(self.grid_cache) >= self.grid_cache_size:
+                self.grid_cache.popitem(last=False)  # forget the least recently used zoom
+        self.grid_cache[key] = (surface, zero)
+        return surface
+
+    def draw_grid(self):
+        self.background.blit(self.grid_surface(), (0, 0))
+        precision, axis_string = self.grid_step()[1:]
+        xs, ys = self.grid_lines()
+        # labels come from the text cache, blitting them is cheap
         c2 = (255,255,255)
-        for fx in float_range(Viewer.zero[0], Viewer.width+1, step):
-            x = int(round(fx,0))
-            pygame.draw.line(self.background, c, (x,0), (x, Viewer.height-Viewer.log_height),1)
+        for x in xs:
             write(self.background, axis_string.format(round(pixel_to_gridvector((x,0))[0],precision)),
                   color=c2, font_size=10, x= x-15, y=5, origin="topright")
-        # left
-        for fx in float_range(Viewer.zero[0], -1, -step):
-            x = int(round(fx, 0))
-            pygame.draw.line(self.background, c, (x, 0), (x, Viewer.height - Viewer.log_height), 1)
-            write(self.background, axis_string.format(round(pixel_to_gridvector((x, 0))[0],precision)),
-                  color=c2, font_size=10, x=x - 15, y= 5, origin="topright")
-        # lower
-        for fy in float_range(Viewer.zero[1], Viewer.height+1, step):
-            y = int(round(fy,0))
-            pygame.draw.line(self.background, c, (0,y), (Viewer.width, y),1)
-            write(self.background, axis_string.format(round(pixel_to_gridvector((0,y))[1],precision)),
-                  color=c2, font_size=10, x= 5, y=y+2, origin="topleft")
-        # upper
-        for fy in float_range(Viewer.zero[1], -1, -step):
-            y = int(round(fy,0))
-            pygame.draw.line(self.background, c, (0,y), (Viewer.width, y),1)
+        for y in ys:
             write(self.background, axis_string.format(round(pixel_to_gridvector((0,y))[1],precision)),
                   color=c2, font_size=10, x= 5, y=y+2, origin="topleft")
         # --axis--
@@ -637,40 +3724,213 @@ class Viewer():
         # --legend on x-axis
         write(self.background, "{} pixel = {:.8f} AU".format(Viewer.width, Viewer.width / Viewer.grid_size[0]),
                        color=c2, font_size=10,x=Viewer.width, y=Viewer.height , origin="bottomright")
-        # blit new background on screen, deleting everything
-        self.screen.blit(self.background, (0, 0))  # overwrite everything
-        self.dirtyrects = [self.background.get_rect()]
-        if not self.draw_lazy:
+        # the whole screen must be repainted with the new background
+        self.allgroup.repaint_rect(self.screen.get_rect())
+
+    def clear_tracers(self):
+        for p in self.planetgroup:
+            p.tracer.clear()
+
+    def world_positions(self):
+        """(body numbers, positions) of every row: the bodies in the order of
+           numbers, followed by the test particles. positions is an (N, 3)
+           array, or a list of vectors for the python backend"""
+        if not isinstance(self.game, Game):  # Replay and PhysicsWorker keep the newest array
+            return self.game.numbers, self.game.positions
+        if np is None:
+            return [], None
+        backend = self.game.backend
+        return backend.numbers, backend.get_state()[0]
+
+    def split_rows(self, numbers, n):
+        """(rows of the bodies with sprite, their sprites, rows of the bodies
+           without sprite and of the test particles, radius of every small body
+           (test particles have none)). Computed again only after the bodies
+           or sprites change"""
+        key = (id(numbers), len(numbers), n, len(self.sprites))
+        if self.split is None or self.split[0] != key:
+            sprites = [i for i, number in enumerate(numbers) if number in self.sprites]
+            bodies = [i for i, number in enumerate(numbers) if number not in self.sprites]
+            radii = np.array([self.game.objects[numbers[i]].radius or 0.0 for i in bodies], dtype=float)
+            rows = np.concatenate((np.array(bodies, dtype=int), np.arange(len(numbers), n)))
+            self.split = (key, np.array(sprites, dtype=int), [self.sprites[numbers[i]] for i in sprites],
+                          rows, np.concatenate((radii, np.zeros(n - len(numbers)))))
+        return self.split[1:]
+
+    def project_sprites(self):
+        """moves the rect of every planet sprite to its body and extends its
+           tracer: all positions are projected with the current zoom and pan
+           in one numpy operation, instead of one Vector2 per sprite"""
+        numbers, positions = self.world_positions()
+        if positions is None:
             for p in self.planetgroup:
-                p.oldposlist = [] # kill old tracers
+                pixel = gridpos_to_pixelvector(p.planet.position)
+                p.rect.center = (round(pixel.x, 0), round(pixel.y, 0))
+                p.tracer.append(p.planet.position[0], p.planet.position[1])
+            return
+        if isinstance(positions, list):
+            positions = np.array([tuple(p) for p in positions], dtype=float).reshape(-1, 3)
+        rows, sprites = self.split_rows(numbers, len(positions))[:2]
+        if not sprites:
+            return
+        world = positions[rows, :2]
+        if np.isnan(world).any():  # a replay has nan for bodies merged away
+            gone = np.isnan(world[:, 0])
+            pixels = np.round(np.nan_to_num(world) * Viewer.grid_size + Viewer.zero).astype(int)
+            pixels[gone] = -10000  # off screen
+            for sprite, center, (x, y), hidden in zip(sprites, pixels.tolist(), world.tolist(), gone.tolist()):
+                sprite.rect.center = center
+                if not hidden:
+                    sprite.tracer.append(x, y)
+            return
+        pixels = np.round(world * Viewer.grid_size + Viewer.zero).astype(int).tolist()
+        for sprite, center, (x, y) in zip(sprites, pixels, world.tolist()):
+            sprite.rect.center = center
+            sprite.tracer.append(x, y)
+
+    def project_particles(self):
+        """pixel positions of the visible small bodies and test particles for
+           draw_particles, returns their bounding rect (or None).
+           Everything off screen is culled in one numpy operation, bodies that
+           are bigger than a pixel at this zoom become discs"""
+        self.particle_pixels = None
+        self.particle_discs = []
+        numbers, positions = self.world_positions()
+        if positions is None or len(positions) == len(self.sprites):
+            return None
+        if isinstance(positions, list):
+            positions = np.array([tuple(p) for p in positions], dtype=float).reshape(-1, 3)
+        rows, radii = self.split_rows(numbers, len(positions))[2:]
+        if len(rows) == 0:
+            return None
+        x = Viewer.zero[0] + Viewer.grid_size[0] * positions[rows, 0]
+        y = Viewer.zero[1] + Viewer.grid_size[1] * positions[rows, 1]
+        r = radii * Viewer.grid_size[0]
+        visible = ((x >= -r) & (x < Viewer.width + r) & (y >= -r) & (y < Viewer.height - Viewer.log_height + r))
+        x, y, r = x[visible], y[visible], r[visible]
+        if len(x) == 0:
+            return None
+        big = r >= 1
+        if big.any():
+            self.particle_discs = list(zip(x[big].tolist(), y[big].tolist(), r[big].tolist()))
+            x, y = x[~big], y[~big]
+        x, y = np.round(x).astype(int), np.round(y).astype(int)
+        inside = (x >= 0) & (x < Viewer.width) & (y >= 0) & (y < Viewer.height - Viewer.log_height)
+        x, y = x[inside], y[inside]
+        rects = [pygame.Rect(int(cx - cr) - 1, int(cy - cr) - 1, int(2 * cr) + 3, int(2 * cr) + 3)
+                 for cx, cy, cr in self.particle_discs]
+        if len(x):
+            self.particle_pixels = x, y
+            cell = self.density_cell if self.density_mode(len(x)) else 1
+            rects.append(pygame.Rect(x.min() // cell * cell, y.min() // cell * cell,
+                                     (x.max() // cell - x.min() // cell + 1) * cell,
+                                     (y.max() // cell - y.min() // cell + 1) * cell))
+        return rects[0].unionall(rects[1:]) if rects else None
+
+    def density_mode(self, visible):
+        mode = self.raster_mode
+        return mode == "density" or (mode == "auto" and visible > self.density_threshold)
+
+    def draw_particles(self):
+        """small bodies and test particles are drawn straight into the pixels of
+           the screen, one sprite each would be far too slow for thousands of them:
+           as single pixels or, when there are very many, as a density map
+           (brightness grows with the logarithm of the bodies per cell)"""
+        for x, y, r in self.particle_discs:
+            pygame.draw.circle(self.screen, self.particle_color, (round(x), round(y)), round(r))
+        if self.particle_pixels is None:
+            return
+        x, y = self.particle_pixels
+        pixels = pygame.surfarray.pixels2d(self.screen)
+        if not self.density_mode(len(x)):
+            pixels[x, y] = self.screen.map_rgb(self.particle_color)
+        else:
+            cell = self.density_cell
+            width, height = -(-pixels.shape[0] // cell), -(-pixels.shape[1] // cell)
+            counts = np.bincount((x // cell) * height + y // cell, minlength=width * height)
+            occupied = np.flatnonzero(counts)
+            level = np.log1p(counts[occupied]) / np.log1p(counts[occupied].max())
+            colors = self.heat_colors()[np.minimum((level * 255).astype(int), 255)]
+            cx, cy = occupied // height, occupied % height
+            for dx in range(cell):
+                for dy in range(cell):
+                    px, py = cx * cell + dx, cy * cell + dy
+                    inside = (px < pixels.shape[0]) & (py < pixels.shape[1] - Viewer.log_height)
+                    pixels[px[inside], py[inside]] = colors[inside]
+        del pixels  # unlocks the screen
+
+    def heat_colors(self):
+        """256 mapped colors from dark blue over red and yellow to white"""
+        if self.heat is None:
+            stops = [(0, (20, 20, 120)), (96, (200, 30, 30)), (192, (255, 220, 0)), (255, (255, 255, 255))]
+            colors = []
+            for i in range(256):
+                (a, ca), (b, cb) = next((s, t) for s, t in zip(stops, stops[1:]) if i <= t[0])
+                f = (i - a) / (b - a)
+                colors.append(self.screen.map_rgb(tuple(int(u + (v - u) * f) for u, v in zip(ca, cb))))
+            self.heat = np.array(colors)
+        return self.heat
+
+    def draw_timeline(self, y):
+        """progress bar of a replay, drag it with the left mouse button to scrub"""
+        self.timeline = pygame.Rect(5, y, Viewer.width - 10, 6)
+        pygame.draw.rect(self.screen, (60, 60, 60), self.timeline)
+        done = self.timeline.copy()
+        done.width = int(self.timeline.width * self.game.fraction())
+        pygame.draw.rect(self.screen, (255, 255, 255), done)
+        self.text_rects.append(self.timeline)
 
     def display_help(self):
         for i, line in enumerate(self.help):
             Flytext(text=line, pos=pygame.math.Vector2(600, 200 + i * 50), move=pygame.math.Vector2(0, -40),
                     kill_on_edge = True, acceleration_factor=1.00, color=(minmax(255-i*10,10,255),minmax(255-i*10,10,255), 255))
 
+    def draw_timings(self):
+        """profiling overlay in the top right corner: rolling mean, median,
+           95th percentile and maximum of every phase over the last frames,
+           and the size of the text cache"""
+        stats = text_cache.stats()
+        lines = self.timer.report() + ["text {} surfaces {:.0f} kB".format(stats["surfaces"], stats["bytes"] / 1024),
+                                       "fonts {font_hits}/{font_misses} hits/misses".format(**stats)]
+        surfaces = [make_text(line, font_color=(255, 255, 0), font_size=12, bold=True, cache=False)[0]
+                    for line in lines]
+        width = max(s.get_width() for s in surfaces)
+        height = sum(s.get_height() for s in surfaces)
+        rect = pygame.Rect(Viewer.width - width - 10, 5, width + 5, height + 4)
+        pygame.draw.rect(self.screen, (0, 0, 0), rect)
+        y = rect.top + 2
+        for surface in surfaces:
+            self.screen.blit(surface, (rect.left + 2, y))
+            y += surface.get_height()
+        self.text_rects.append(rect)  # repainted by the background next frame
+
     def run(self):
         """The mainloop"""
         running = True
         pygame.mouse.set_visible(True)
         #oldleft, oldmiddle, oldright = False, False, False
-        self.draw_lazy = False
-        self.dirtyrects = []
+        self.dirty_rendering = True # False: repaint the whole screen every frame
+        self.text_rects = [] # status line and timeline of the last frame
+        self.particle_rect = None # bounding rect of the test particles of the last frame
+        self.raster_mode = self.raster_modes[0] # how small bodies are drawn, [d] key
+        self.split = None # cache of split_rows
+        self.heat = None # mapped colors of the density map
+        self.particle_discs = []
         self.draw_grid()
         self.drag = False # dragging with mouse to pan the starmap
+        self.timeline = pygame.Rect(5, Viewer.height - 25, Viewer.width - 10, 6)
         self.display_help()
         while running:
 
 
             milliseconds = self.clock.tick(self.fps)  #
             seconds = milliseconds / 1000
+            self.timer.mark("wait")
 
             self.playtime += seconds
             # -----update planet positions-----
             self.game.timestep(seconds)
-            # iterate planet sprites
-            for p in self.planetgroup:
-                p.pos = gridpos_to_pixelvector(p.planet.position)
+            self.timer.mark("physics")
 
         # ------ mouse handler ------
             #left, middle, right = pygame.mouse.get_pressed()
@@ -696,14 +3956,23 @@ class Viewer():
                 # ---- mouse events ----
                 if event.type == pygame.MOUSEBUTTONUP and event.button == 3:
                     self.drag = False
+                if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+                    self.scrubbing = False
+                if event.type == pygame.MOUSEMOTION and self.scrubbing:
+                    self.game.seek_fraction((event.pos[0] - self.timeline.left) / self.timeline.width)
+                    self.clear_tracers()
                 if event.type == pygame.MOUSEBUTTONDOWN:
+                    if event.button == 1 and self.replay and self.timeline.inflate(0, 10).collidepoint(event.pos):
+                        self.scrubbing = True
+                        self.game.seek_fraction((event.pos[0] - self.timeline.left) / self.timeline.width)
+                        self.clear_tracers()
                     if event.button == 3:
                         self.drag = True
                     if event.button == 4: # mouse wheel scroll up
-                        self.resize_grid(Viewer.grid_size[0] * 1.1) # zoom in
+                        self.set_zoom(Viewer.zoom + 1) # zoom in
                         self.draw_grid()
                     elif event.button == 5: # mouse wheel scroll down
-                        self.resize_grid(Viewer.grid_size[0] * 0.9)  # zoom out
+                        self.set_zoom(Viewer.zoom - 1)  # zoom out
                         self.draw_grid()
                 #if event.type == pygame.MOUSEMOTION and self.drag:
                 #    # move the map
@@ -719,39 +3988,60 @@ class Viewer():
                         self.game.paused = not self.game.paused
                     if event.key == pygame.K_h:
                         if len(self.flytextgroup) > 0:
-                            self.flytextgroup.empty()
+                            for f in self.flytextgroup:
+                                f.kill()
                         else:
                             self.display_help()
                     if event.key == pygame.K_PAGEUP:
-                        Game.i += 1
-                        Game.i = minmax(Game.i, 0, len(Game.deltas)-1)
-                        Game.delta_t = Game.deltas[Game.i][0]
+                        self.game.set_timescale(self.game.i + 1)
                     if event.key == pygame.K_PAGEDOWN:
-                        Game.i -= 1
-                        Game.i = minmax(Game.i, 0, len(Game.deltas) - 1)
-                        Game.delta_t = Game.deltas[Game.i][0]
+                        self.game.set_timescale(self.game.i - 1)
+                    if self.replay:
+                        step = (self.game.end - self.game.start) / 100
+                        if event.key in (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_HOME, pygame.K_END):
+                            self.clear_tracers()
+                        if event.key == pygame.K_LEFT:
+                            self.game.seek(self.game.time - step)
+                        if event.key == pygame.K_RIGHT:
+                            self.game.seek(self.game.time + step)
+                        if event.key == pygame.K_HOME:
+                            self.game.seek(self.game.start)
+                        if event.key == pygame.K_END:
+                            self.game.seek(self.game.end)
+                        if event.key == pygame.K_r:
+                            self.game.direction *= -1
+                            self.game.paused = False
+                    if event.key == pygame.K_i and not self.replay:
+                        names = list(Game.integrators)
+                        self.game.set_integrator(names[(names.index(self.game.integrator) + 1) % len(names)])
+                    if event.key == pygame.K_j and not self.replay and np is not None:
+                        self.clear_tracers()
+                        self.game.seek(self.game.time + 100)
                     if event.key == pygame.K_BACKSPACE:
-                        self.draw_lazy = not self.draw_lazy
+                        self.dirty_rendering = not self.dirty_rendering
+                    if event.key == pygame.K_F3:
+                        self.show_timings = not self.show_timings
+                    if event.key == pygame.K_d:
+                        modes = self.raster_modes
+                        self.raster_mode = modes[(modes.index(self.raster_mode) + 1) % len(modes)]
                     if event.key == pygame.K_INSERT:
                         PlanetSprite.history += 100
-                        PlanetSprite.history = minmax(PlanetSprite.history, 0, 10000)
+                        PlanetSprite.history = minmax(PlanetSprite.history, 0, Tracer.capacity)
                     if event.key == pygame.K_DELETE:
                         PlanetSprite.history -= 100
-                        PlanetSprite.history = minmax(PlanetSprite.history, 0, 10000)
-                        for p in self.planetgroup:
-                            p.oldposlist = p.oldposlist[len(p.oldposlist)-PlanetSprite.history:]
+                        PlanetSprite.history = minmax(PlanetSprite.history, 0, Tracer.capacity)
 
                     # ----------- magic with ctrl key and dynamic key -----
                     # if pressed_keys[pygame.K_RCTRL] or pressed_keys[pygame.K_LCTRL]:
                     #if event.mod & pygame.KMOD_CTRL:  # any or both ctrl keys are pressed
                     if event.key == pygame.K_KP_PLUS:
-                        self.resize_grid(Viewer.grid_size[0]*1.1)
+                        self.set_zoom(Viewer.zoom + 1)
                         self.draw_grid()
                     if event.key == pygame.K_KP_MINUS:
-                        self.resize_grid(Viewer.grid_size[0]*0.9)
+                        self.set_zoom(Viewer.zoom - 1)
                         self.draw_grid()
                     if event.key == pygame.K_KP_ENTER:
-                        self.resize_grid(200)
+                        self.set_zoom(0)
                         self.draw_grid()
                     if event.key == pygame.K_KP5:
                         Viewer.zero = [Viewer.width//2, Viewer.height // 2]
@@ -771,49 +4061,268 @@ class Viewer():
 
 
             # ============== draw screen =================
-            if self.draw_lazy:
-               self.allgroup.clear(self.screen, bgd=self.background)
-               self.flytextgroup.clear(self.screen, bgd=self.background)
-            else:
-               self.screen.blit(self.background, (0,0) ) # overwrite everything
-            #self.draw_grid()
-            self.allgroup.update(seconds)
-            self.flytextgroup.update(seconds)
-            self.dirtyrects.extend(self.allgroup.draw(self.screen))
-            self.dirtyrects.extend(self.flytextgroup.draw(self.screen))
-
+            # only areas that changed are repainted: the sprites (old and new
+            # position, done by LayeredDirty), tracer segments that appeared or
+            # vanished, the test particles and the text of the last frame
+            self.timer.mark("events")
+            self.flytextgroup.update(seconds) # planet sprites don't move by themselves
+            self.project_sprites()
+            if not self.dirty_rendering:
+                self.allgroup.repaint_rect(self.screen.get_rect())
+            self.timer.mark("sprites")
+            for rect in self.remove_sprites():
+                self.allgroup.repaint_rect(rect)
             for planet in self.planetgroup:
-                for i, pos in enumerate(planet.oldposlist):
-                    if i < 3:
-                        continue
-                    x,y = pos
-                    x2, y2 = planet.oldposlist[i-1]
-
-                    pygame.draw.line(self.screen, planet.color, (x,y),(x2,y2))
+                for rect in planet.tracer_changes():
+                    self.allgroup.repaint_rect(rect)
+            self.timer.mark("tracers")
+            particle_rect = self.project_particles()
+            for rect in [self.particle_rect, particle_rect] + self.text_rects:
+                if rect is not None:
+                    self.allgroup.repaint_rect(rect)
+            self.particle_rect = particle_rect
+            self.timer.mark("particles")
+            dirtyrects = self.allgroup.draw(self.screen, self.background)
+            self.timer.mark("draw")
+            # tracers are drawn whole: outside the repainted areas
+            # they just cover themselves
+            self.draw_particles()
+            self.timer.mark("particles")
+            for planet in self.planetgroup:
+                planet.draw_tracer(self.screen)
+            self.timer.mark("tracers")
 
             # write text below sprites
 
             status = "[h]: help "
-            status += "[PgUp/PgDown]: timescale: 1 second = {} ".format(Game.deltas[Game.i][1])
-            status += "[BACKSPACE]: {} drawing ".format("lazy" if self.draw_lazy else "clean")
+            status += "[PgUp/PgDown]: timescale: 1 second = {} ".format(Game.deltas[self.game.i][1])
+            status += "[BACKSPACE]: {} drawing ".format("dirty rects" if self.dirty_rendering else "full screen")
             status += "[INS/DEL]: tracer length: {} ".format(PlanetSprite.history)
+            if self.replay:
+                status += "[r]: replay {} ".format("forward" if self.game.direction > 0 else "backward")
+            else:
+                status += "[i]: {} ".format(self.game.integrator)
+            status += "[d]: small bodies {} ".format(self.raster_mode)
             status += "[SPACE]: Simulation {} ".format("paused" if self.game.paused else "running")
-            status += "FPS: {:5.3} ".format(self.clock.get_fps())
+            # the numbers change every frame: render them apart from the (cached) keys
+            numbers = "year: {:.3f} ".format(self.game.time)
+            numbers += "FPS: {:5.3} ".format(self.clock.get_fps())
+            numbers += "text cache hits/misses: {}/{} ".format(text_cache.hits, text_cache.misses)
             textsurface, pos = make_text(status, font_color=(255,255,255),font_size=12, bold=True)
-            pygame.draw.rect(self.screen, (0, 0, 0), (5, Viewer.height- pos[1], pos[0], pos[1]))
-            self.screen.blit(textsurface, (5, Viewer.height - pos[1]))
+            numbersurface, numberpos = make_text(numbers, font_color=(255,255,255),font_size=12, bold=True, cache=False)
+            pos = (pos[0] + numberpos[0], max(pos[1], numberpos[1]))
+            bottom = Viewer.height - Viewer.log_height # status line sits on the log area
+            pygame.draw.rect(self.screen, (0, 0, 0), (5, bottom - pos[1], pos[0], pos[1]))
+            self.screen.blit(textsurface, (5, bottom - pos[1]))
+            self.screen.blit(numbersurface, (5 + textsurface.get_width(), bottom - pos[1]))
 
-            self.dirtyrects.append(  pygame.Rect(5, Viewer.height-pos[1], pos[0], pos[1]))
-            if self.draw_lazy:
-                pygame.display.update(self.dirtyrects)
-                self.dirtyrects = []
+            self.text_rects = [pygame.Rect(5, bottom - pos[1], pos[0], pos[1])]
+            if self.replay:
+                self.draw_timeline(bottom - pos[1] - 10)
+            if self.show_timings:
+                self.draw_timings()
+            log_rect = self.draw_log()
+            self.timer.mark("text")
+            if self.dirty_rendering:
+                pygame.display.update(merge_rects(dirtyrects + self.text_rects + ([log_rect] if log_rect else [])))
             else:
                 pygame.display.flip()
+            self.timer.mark("flip")
+            self.timer.end_frame()
         # -----------------------------------------------------
+        self.timer.close()
+        text_cache.clear()
         pygame.mouse.set_visible(True)
         pygame.quit()
 
 
+def write_state(writer, game):
+    """write one csv row per body and test particle:
+       time (years), name, position (AU), velocity (AU / year)"""
+    for body in game.objects.values():
+        writer.writerow([repr(game.time), body.name] + [repr(c) for c in body.position] + [repr(c) for c in body.velocity])
+    particles = game.particles
+    for name, pos, vel in zip(particles.names, particles.positions.tolist() if len(particles) else [],
+                              particles.velocities.tolist() if len(particles) else []):
+        writer.writerow([repr(game.time), name] + [repr(c) for c in pos] + [repr(c) for c in vel])
+
+
+def run_headless(game, years, step=None, every=1.0, output=None, diagnostics=None, checkpointer=None):
+    """batch mode: advance game by years without window, sprites or frame cap.
+       Every 'every' simulated years the state is written to the csv file
+       output (if given) and the speed is reported, with a Diagnostics
+       also the energy, momentum and angular momentum drift.
+       A Checkpointer (with observe=False) saves after the outputs when it is
+       due, together with end, every and step, so --resume continues with
+       exactly the same steps.
+       Returns (steps, wall time in seconds)"""
+    out = open(output, "w", newline="") if output is not None else None
+    writer = csv.writer(out) if out is not None else None
+    if writer is not None:
+        writer.writerow(["time", "name", "x", "y", "z", "vx", "vy", "vz"])
+        write_state(writer, game)
+    start = time.perf_counter()
+    end = game.time + years
+    steps = 0
+    try:
+        while game.time < end - 1e-12:
+            chunk_start = time.perf_counter()
+            chunk_steps = game.advance(min(every, end - game.time), step)
+            steps += chunk_steps
+            now = time.perf_counter()
+            if writer is not None:
+                write_state(writer, game)
+            print("year {:.3f}: {} steps, {:.0f} steps/s".format(game.time, steps, chunk_steps / max(now - chunk_start, 1e-9)))
+            if diagnostics is not None:
+                diagnostics.update()
+                print(diagnostics.text())
+            if checkpointer is not None and (checkpointer.due() or game.time >= end - 1e-12):
+                checkpointer.save({"end": end, "every": every, "step": step})
+    finally:
+        if out is not None:
+            out.close()
+    wall = time.perf_counter() - start
+    print("done: {:.3f} years in {} steps, {:.2f} s, {:.0f} steps/s".format(years, steps, wall, steps / max(wall, 1e-9)))
+    return steps, wall
+
+
+async def print_states(address, bodies=None, rate=10, output=None):
+    """a simple client of StateServer: one csv row per body and state,
+       time (years), name, x, y, z (AU)"""
+    out = open(output, "w", newline="") if output is not None else sys.stdout
+    writer = csv.writer(out)
+    writer.writerow(["time", "name", "x", "y", "z"])
+    try:
+        async for year, names, values in stream_states(address, bodies, rate):
+            for name, row in zip(names, values.tolist()):
+                writer.writerow([repr(year), name] + [repr(c) for c in row])
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="solar system simulation")
+    parser.add_argument("--backend", choices=list(Game.backends), default=None,
+                        help="gravity backend (default: numpy if installed)")
+    parser.add_argument("--integrator", choices=list(Game.integrators), default="leapfrog")
+    parser.add_argument("--catalog", action="append", default=[],
+                        help="add the bodies of a csv, json, npz or npy catalog file (can be repeated)")
+    parser.add_argument("--no-planets", action="store_true", help="start without the built-in solar system")
+    parser.add_argument("--seek", type=float, default=None, metavar="YEAR",
+                        help="start at YEAR, reached on the two-body orbits without integrating (needs numpy)")
+    parser.add_argument("--headless", action="store_true", help="no window, integrate as fast as possible")
+    parser.add_argument("--years", type=float, default=None,
+                        help="headless: simulated years to run (default: 100, or up to the end of a resumed run)")
+    parser.add_argument("--step", type=float, default=None, help="headless: fixed step in days (default: 1)")
+    parser.add_argument("--max-step", type=float, default=None,
+                        help="viewer: largest physics step in days (default: 1), larger for yoshida4, rk45 or block")
+    parser.add_argument("--every", type=float, default=None, help="headless: years between state outputs (default: 1)")
+    parser.add_argument("--output", default=None, help="headless: csv file for the states")
+    parser.add_argument("--record", default=None, help="write a trajectory file (needs numpy)")
+    parser.add_argument("--record-every", type=float, default=1, help="days between trajectory samples")
+    parser.add_argument("--replay", default=None, help="show a recorded trajectory file instead of simulating")
+    parser.add_argument("--diagnostics", type=int, default=100,
+                        help="physics steps between measurements of energy and momentum (0: off)")
+    parser.add_argument("--collisions", choices=Collisions.modes, default=None,
+                        help="what a collision of two bodies does (default: nothing, they pass through)")
+    parser.add_argument("--encounter-distance", type=float, default=0.0,
+                        help="AU between the surfaces that count as close encounter")
+    parser.add_argument("--checkpoint", default=None, metavar="PREFIX",
+                        help="save the complete state to PREFIX-<year>.chk files (needs numpy)")
+    parser.add_argument("--checkpoint-every", type=float, default=1, help="simulated years between checkpoints")
+    parser.add_argument("--checkpoint-keep", type=int, default=3, help="number of checkpoint files to keep")
+    parser.add_argument("--resume", default=None, help="continue from a checkpoint file")
+    parser.add_argument("--serve", default=None, metavar="ADDRESS",
+                        help="no window: run the simulation and stream its state to local clients "
+                             "(port number, localhost:port or unix socket path)")
+    parser.add_argument("--connect", default=None, metavar="ADDRESS",
+                        help="print the states streamed by a --serve process as csv (or into --output)")
+    parser.add_argument("--bodies", nargs="+", default=None, help="connect: names of the bodies (default: all)")
+    parser.add_argument("--rate", type=float, default=10, help="connect: states per second")
+    parser.add_argument("--worker", action="store_true",
+                        help="run the physics in a separate process, the viewer interpolates its snapshots")
+    parser.add_argument("--profile", default=None, help="csv file for the timings of every frame")
+    parser.add_argument("--width", type=int, default=1200)
+    parser.add_argument("--height", type=int, default=800)
+    args = parser.parse_args(argv)
+    if args.replay:
+        Viewer(Replay(Trajectory(args.replay)), width=args.width, height=args.height, profile=args.profile)
+        return
+    if args.connect:
+        try:
+            asyncio.run(print_states(args.connect, args.bodies, args.rate, args.output))
+        except KeyboardInterrupt:
+            pass
+        return
+    extra = {}
+    if args.resume:
+        g = Game.from_checkpoint(args.resume)
+        extra = g.checkpoint_extra or {}
+        if args.backend is not None and args.backend != g.backend.name:
+            g.set_backend(args.backend)
+        if args.integrator != parser.get_default("integrator"):
+            g.set_integrator(args.integrator)
+        print("resumed {} at year {:.6f}: {} bodies, {} test particles".format(
+            args.resume, g.time, len(g.objects), len(g.particles)))
+    else:
+        g = Game(backend=args.backend, integrator=args.integrator, solar_system=not args.no_planets,
+                 max_step=None if args.max_step is None else args.max_step / 365.25)
+    step = args.step / 365.25 if args.step is not None else extra.get("step", 1 / 365.25)
+    every = args.every if args.every is not None else extra.get("every", 1.0)
+    if args.years is not None:
+        years = args.years
+    elif "end" in extra:
+        years = extra["end"] - g.time
+    else:
+        years = 100.0
+    for catalog in args.catalog:
+        start = time.perf_counter()
+        bodies, particles = g.load_catalog(catalog)
+        print("{}: {} bodies, {} test particles in {:.2f} s".format(catalog, bodies, particles,
+                                                                    time.perf_counter() - start))
+    if args.seek is not None:
+        g.seek(args.seek)
+    options = dict(record=args.record, record_every=args.record_every, diagnostics=args.diagnostics,
+                   collisions=args.collisions, encounter_distance=args.encounter_distance,
+                   checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every,
+                   checkpoint_keep=args.checkpoint_keep, observe_checkpoints=not args.headless)
+    if args.serve:
+        recorder, diagnostics, checkpointer = add_observers(g, **options)
+        server = StateServer(g, args.serve)
+        print("streaming the state on {}, stop with Ctrl-C".format(args.serve))
+        try:
+            server.run(args.years)
+        finally:
+            if recorder is not None:
+                recorder.close()
+            if checkpointer is not None:
+                checkpointer.save()
+                checkpointer.close()
+        return
+    if args.worker and not args.headless:
+        worker = PhysicsWorker(g, **options)  # the observers live in the worker
+        try:
+            Viewer(worker, width=args.width, height=args.height, profile=args.profile)
+        finally:
+            worker.close()
+        return
+    recorder, diagnostics, checkpointer = add_observers(g, **options)
+    try:
+        if args.headless:
+            run_headless(g, years, step, every, args.output, diagnostics, checkpointer)
+        else:
+            Viewer(g, width=args.width, height=args.height, profile=args.profile,
+                   diagnostics=args.diagnostics)  # , (35,35))
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if checkpointer is not None:
+            if not args.headless:
+                checkpointer.save()  # the state at the end, also after a crash
+            checkpointer.close()
+
+
 if __name__ == '__main__':
-    g = Game()
-    Viewer(g, width=1200, height=800, )  # , (35,35))
+    main()
@@ -0,0 +1,889 @@
+"""
+tests for the physics of solarsystem.py, run with: python3 -m pytest
+needs numpy and pytest
+"""
+
+import asyncio
+import csv
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import benchmark
+import ensemble
+import solarsystem
+
+
+def test_games_are_independent():
+    first = solarsystem.Game()
+    second = solarsystem.Game(solar_system=False)
+    second.add_body(name="star", position=(0, 0, 0), velocity=(0, 0, 0), mass=300000, radius=0.005)
+    second.add_body(name="earth", position=(2, 0, 0), velocity=(0, -6, 0), mass=2, radius=5e-5)
+    objects = [(number, body.name, tuple(body.position), tuple(body.velocity))
+               for number, body in second.objects.items()]
+    arrays = [np.array(a, copy=True) for a in solarsystem.state_arrays(second.backend)]
+    first.advance(1, 0.01)
+    first.backend.store()
+    assert first.time == 1 and second.time == 0
+    assert [(number, body.name, tuple(body.position), tuple(body.velocity))
+            for number, body in second.objects.items()] == objects
+    for before, after in zip(arrays, solarsystem.state_arrays(second.backend)):
+        assert np.array_equal(before, after)
+    assert first.objects[0].name == "sun" and second.objects[0].name == "star"
+    assert first.objects["earth"].mass == 1 and second.objects["earth"].mass == 2
+    assert first.objects["earth"] is first.objects[3] and second.objects["earth"] is second.objects[1]
+    assert first.objects["earth"].position != (1, 0, 0) and second.objects["earth"].position == (2, 0, 0)
+
+
+@pytest.mark.parametrize("candidate", ["numpy", "barneshut"])
+@pytest.mark.parametrize("integrator", ["trapezoid", "leapfrog"])
+def test_backends_agree(candidate, integrator):
+    game = solarsystem.Game()
+    assert solarsystem.compare_backends(game, "python", candidate, years=10, integrator=integrator) < 1e-10
+
+
+def cluster(n, seed=0):
+    """positions and masses of n bodies in a gaussian blob, the hard case for Barnes-Hut"""
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, 1, (n, 3)), rng.uniform(0.5, 2, n)
+
+
+def relative_error(acc, reference):
+    return np.linalg.norm(acc - reference, axis=1) / np.linalg.norm(reference, axis=1)
+
+
+def test_octree_theta_zero_is_direct_sum():
+    positions, masses = cluster(500)
+    acc = solarsystem.Octree(positions, masses).accelerations(0.0)
+    reference = solarsystem.direct_accelerations(positions, masses)
+    assert relative_error(acc, reference).max() < 1e-12
+
+
+@pytest.mark.parametrize("theta, median, worst", [(0.3, 5e-4, 1e-2), (0.5, 2e-3, 5e-2), (1.0, 1e-2, 2e-1)])
+def test_octree_error_against_direct_sum(theta, median, worst):
+    positions, masses = cluster(2000)
+    acc = solarsystem.Octree(positions, masses, leaf_size=4).accelerations(theta)
+    error = relative_error(acc, solarsystem.direct_accelerations(positions, masses))
+    assert np.median(error) < median
+    assert error.max() < worst
+
+
+def test_octree_targets_and_points():
+    positions, masses = cluster(1000)
+    tree = solarsystem.Octree(positions, masses)
+    targets = np.array([999, 3, 500, 3])
+    assert np.allclose(tree.accelerations(0.0, targets=targets),
+                       solarsystem.direct_accelerations(positions, masses, targets=targets), rtol=1e-12, atol=0)
+    points = cluster(300, seed=1)[0] * 1.5  # some of them outside of the root cube
+    error = relative_error(tree.accelerations(0.5, points=points),
+                           solarsystem.direct_accelerations(positions, masses, points=points))
+    assert np.median(error) < 1e-3
+
+
+def test_diagnostics_leapfrog_drift():
+    game = solarsystem.Game()
+    diagnostics = solarsystem.Diagnostics(game, every=10)
+    steps = game.advance(20, 1 / 365.25)
+    values = diagnostics.values()
+    assert diagnostics.measurements == 1 + steps // 10 and values["time"] > 19.9
+    assert values["energy_drift"] < 1e-6
+    assert values["momentum_drift"] < 1e-12 and values["angular_momentum_drift"] < 1e-12
+    off = solarsystem.Diagnostics(game, every=0)
+    assert off not in game.observers
+    game.advance(1, 1 / 365.25)
+    assert off.measurements == 1 and off.time == 20
+    off.update()
+    assert off.measurements == 2 and off.time == 21 and off.energy_drift < 1e-6
+
+
+def without_wall_time(rows):
+    return [{key: value for key, value in row.items() if key != "wall_time"} for row in rows]
+
+
+def test_ensemble_does_not_depend_on_the_processes(tmp_path):
+    output = str(tmp_path / "ensemble.csv")
+    one = ensemble.run_ensemble(3, processes=1, years=1, seed=7)
+    two = ensemble.run_ensemble(3, processes=2, output=output, years=1, seed=7)
+    assert [row["member"] for row in one] == [0, 1, 2]
+    assert without_wall_time(one) == without_wall_time(two)
+    assert one[0]["min_separation"] != one[1]["min_separation"]  # every member is perturbed differently
+    assert without_wall_time([ensemble.run_member(1, seed=7, years=1)]) == without_wall_time(one[1:2])
+    with open(output, newline="") as f:
+        assert [int(row["member"]) for row in csv.DictReader(f)] == [0, 1, 2]
+
+
+def test_benchmark_make_game_adds_a_belt():
+    game = benchmark.make_game(50, "numpy")
+    assert len(game.objects) == 50 and len(game.backend.numbers) == 50
+    asteroid = list(game.objects.values())[-1]
+    assert asteroid.mass == 1e-10 and asteroid.radius == 1e-6
+    circular = np.sqrt(solarsystem.GRAVCONST * game.objects[0].mass / asteroid.position.xy.length())
+    assert asteroid.velocity.length() == pytest.approx(circular)
+
+
+@pytest.mark.parametrize("arguments, keys", [
+    (["barneshut", "--bodies", "200", "--thetas", "0.5", "1", "--samples", "20"],
+     {"theta", "median_error", "p99_error", "max_error", "step_time"}),
+    (["scaling", "--counts", "5", "20", "--min-time", "0.01"],
+     {"backend", "integrator", "bodies", "steps_per_second", "peak_memory"}),
+    (["accuracy", "--years", "0.02", "--steps", "1", "--integrators", "leapfrog", "block"],
+     {"backend", "integrator", "step_days", "years", "wall_time", "energy_drift", "angular_momentum_drift",
+      "peak_memory"})])
+def test_benchmark_modes_write_their_results(tmp_path, capsys, arguments, keys):
+    output = str(tmp_path / "result.json")
+    benchmark.main(arguments + ["--output", output])
+    with open(output) as f:
+        result = json.load(f)
+    assert set(result) == {"command", "options", "machine", "results"} and result["command"] == arguments[0]
+    assert set(result["machine"]) == {"commit", "time", "python", "numpy", "platform", "processor"}
+    assert result["results"] and all(set(row) == keys for row in result["results"])
+    capsys.readouterr()
+    benchmark.main(["compare", output, output])
+    assert len(capsys.readouterr().out.splitlines()) == 1 + len(result["results"])
+
+
+def test_particles_need_a_sun():
+    game = solarsystem.Game(solar_system=False)
+    with pytest.raises(ValueError):
+        game.add_particles(np.array([[1.0, 0, 0]]))
+    game.add_particles(np.array([[1.0, 0, 0]]), np.array([[0, 6.2, 0]]))
+    assert len(game.particles) == 1
+
+
+@pytest.mark.parametrize("backend, integrator", [("numpy", "leapfrog"), ("numpy", "block"),
+                                                 ("barneshut", "leapfrog")])
+def test_particles_do_not_change_the_massive_bodies(backend, integrator):
+    games = [solarsystem.Game(backend=backend, integrator=integrator) for _ in range(2)]
+    rng = np.random.default_rng(4)
+    r, angle = rng.uniform(0.5, 40, 10000), rng.uniform(0, 2 * np.pi, 10000)
+    games[1].add_particles(np.column_stack((r * np.cos(angle), r * np.sin(angle), np.zeros(10000))))
+    for game in games:
+        game.advance(0.5, 1 / 365.25)
+    alone, crowded = (solarsystem.state_arrays(game.backend) for game in games)
+    n = len(games[0].objects)
+    assert all(np.array_equal(a, c[:n]) for a, c in zip(alone, crowded))  # bit for bit
+
+
+@pytest.mark.parametrize("backend", ["python", "numpy"])
+def test_particle_stays_on_its_circular_orbit(backend):
+    game = solarsystem.Game(backend=backend, solar_system=False)
+    game.add_body(name="sun", position=(0, 0, 0), velocity=(0, 0, 0), mass=332937, radius=0.00465)
+    game.add_particles(np.array([[0, 2.0, 0]]))  # circular speed around the sun
+    game.advance(2 ** 1.5 * 3, 1 / 365.25)  # three orbits
+    positions, velocities = (a[1] for a in solarsystem.state_arrays(game.backend))
+    assert np.linalg.norm(positions) == pytest.approx(2.0, rel=1e-5)
+    assert np.linalg.norm(velocities) == pytest.approx(solarsystem.initialspeed(2.0, 332937), rel=1e-5)
+    assert abs(positions[2]) < 1e-12 and abs(np.dot(positions, velocities)) < 1e-4
+
+
+def test_trajectory_round_trip(tmp_path):
+    game = solarsystem.Game()
+    game.add_particles(np.array([[2.5, 0, 0], [0, -2.9, 0.1]]))
+    filename = str(tmp_path / "run.traj")
+    recorder = solarsystem.TrajectoryRecorder(game, filename, every=0.01, chunk_samples=7)
+    seen = {game.time: np.hstack(solarsystem.state_arrays(game.backend))}
+    game.observers.append(lambda g: seen.setdefault(g.time, np.hstack(solarsystem.state_arrays(g.backend))))
+    game.advance(1, 0.002)
+    recorder.close()
+    trajectory = solarsystem.Trajectory(filename)
+    assert len(trajectory.chunks) > 10 and len(trajectory) == recorder.samples
+    assert trajectory.names[3] == "earth" and trajectory.names[-1] == "particle_1"
+    times, states = trajectory.slice()
+    for t, state in zip(times, states):
+        assert np.array_equal(state, seen[t])
+    times, earth = trajectory.slice(["earth", 0], start=0.333, stop=0.555)
+    assert times[0] >= 0.333 and times[-1] <= 0.555 and len(times) == 22
+    for t, state in zip(times, earth):
+        assert np.array_equal(state, seen[t][[3, 0]])
+
+
+def test_trajectory_opens_more_chunks_than_file_descriptors(tmp_path):
+    resource = pytest.importorskip("resource")
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    game = solarsystem.Game()
+    filename = str(tmp_path / "run.traj")
+    recorder = solarsystem.TrajectoryRecorder(game, filename, every=0.001, chunk_samples=1)
+    game.advance(0.5, 0.001)
+    recorder.close()
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(256, soft), hard))
+    try:
+        trajectory = solarsystem.Trajectory(filename)
+        assert len(trajectory.chunks) == recorder.samples > 256
+        times, earth = trajectory.slice(["earth"])
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    assert len(times) == recorder.samples and np.isfinite(earth).all()
+    trajectory.close()
+
+
+def replay_positions(replay):
+    return np.array([tuple(body.position) for body in replay.objects.values()])
+
+
+def test_replay_interpolates_between_samples(tmp_path):
+    game = solarsystem.Game()
+    filename = str(tmp_path / "run.traj")
+    recorder = solarsystem.TrajectoryRecorder(game, filename, every=0.02, chunk_samples=16)
+    seen = {}
+    game.observers.append(lambda g: seen.setdefault(round(g.time, 6), solarsystem.state_arrays(g.backend)[0]))
+    game.advance(1, 0.001)
+    recorder.close()
+    replay = solarsystem.Replay(solarsystem.Trajectory(filename))
+    assert replay.start == 0 and replay.end == pytest.approx(1)
+    replay.seek(replay.trajectory.times[20])  # on a sample
+    assert np.array_equal(replay_positions(replay), seen[0.4])
+    for t in (0.313, 0.5, 0.871):  # between samples
+        replay.seek(t)
+        assert np.abs(replay_positions(replay) - seen[t]).max() < 1e-4  # mercury moves 0.05 AU between samples
+    replay.seek(-5)
+    assert replay.time == replay.start and np.array_equal(replay_positions(replay), replay.trajectory.samples(0, 1)[1][0, :, :3])
+
+
+def read_states(filename):
+    with open(filename, newline="") as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["time", "name", "x", "y", "z", "vx", "vy", "vz"]
+    return rows[1:]
+
+
+def test_run_headless_steps_and_output(tmp_path, capsys):
+    output = str(tmp_path / "states.csv")
+    game = solarsystem.Game()
+    steps, wall = solarsystem.run_headless(game, 1, step=0.01, every=0.25, output=output)
+    assert steps == 100 and game.time == 1 and wall > 0
+    assert "done: 1.000 years in 100 steps" in capsys.readouterr().out
+    rows = read_states(output)
+    assert [row[1] for row in rows] == ["sun", "mercury", "venus", "earth", "mars"] * 5
+    assert [float(row[0]) for row in rows[::5]] == [0, 0.25, 0.5, 0.75, 1]
+    reference = solarsystem.Game()
+    reference.advance(1, 0.01)
+    earth = reference.objects["earth"]
+    assert [float(c) for c in rows[-2][2:]] == list(earth.position) + list(earth.velocity)
+
+
+def test_main_headless(tmp_path):
+    output = str(tmp_path / "states.csv")
+    solarsystem.main(["--headless", "--years", "1", "--step", "3.6525", "--every", "0.5", "--output", output])
+    rows = read_states(output)
+    assert len(rows) == 3 * 5 and [float(row[0]) for row in rows[::5]] == [0, 0.5, 1]
+    reference = solarsystem.Game()
+    reference.advance(1, 0.01)
+    assert [float(c) for c in rows[-1][2:5]] == list(reference.objects["mars"].position)
+
+
+def two_bodies(mode, backend=None, integrator="leapfrog"):
+    """two bodies 0.02 AU apart on a collision course, without a sun"""
+    game = solarsystem.Game(backend=backend, integrator=integrator, solar_system=False)
+    game.add_body(name="a", mass=1.0, position=(-0.01, 0, 0), velocity=(1.0, 0, 0), radius=0.001)
+    game.add_body(name="b", mass=2.0, position=(0.01, 0.0005, 0), velocity=(-2.0, 0.03, 0), radius=0.001)
+    collisions = solarsystem.Collisions(game, mode=mode)
+    return game, collisions
+
+
+def momentum(game):
+    game.backend.sync()
+    return sum((body.velocity * body.mass for body in game.objects.values()), solarsystem.pygame.math.Vector3())
+
+
+def test_merge_keeps_mass_and_momentum():
+    game, collisions = two_bodies("merge")
+    before = momentum(game)
+    game.advance(0.01, 0.0001)
+    assert [event[1:4] for event in collisions.events] == [("collision", "a", "b")]
+    assert list(game.objects.names) == ["b"]
+    survivor = game.objects["b"]
+    assert survivor.mass == 3.0 and survivor.radius == pytest.approx(0.001 * 2 ** (1 / 3))
+    assert (momentum(game) - before).length() < 1e-9
+    assert len(solarsystem.state_arrays(game.backend)[0]) == 1
+
+
+@pytest.mark.parametrize("backend", ["python", "numpy"])
+def test_merge_hands_the_moons_to_the_survivor(backend):
+    game, collisions = two_bodies("merge", backend)
+    a = game.objects["a"]
+    game.add_body(name="moon", mass=0.01, position=(-0.01, 0.005, 0), velocity=(1.0, 0, 0), boss=a, radius=1e-5)
+    game.backend.load()
+    game.advance(0.01, 0.0001)
+    assert [event[1:4] for event in collisions.events] == [("collision", "a", "b")]
+    b, moon = game.objects["b"], game.objects["moon"]
+    assert moon.boss is b and game.objects.at(0) is b
+    assert game.backend.numbers == list(game.objects.keys()) == [b.number, moon.number]
+    assert list(game.backend.masses) == [3.0, 0.01]
+    solarsystem.block_rungs(game.backend, 0.0001)
+    assert list(game.backend.boss_rows) == [0, 0]
+    assert list(solarsystem.KeplerPropagator(game.backend, game.time).boss) == [-1, 0]
+    game.backend.store()
+    assert (moon.position - b.position).length() < 0.01
+
+
+def test_bounce_reverses_the_approach():
+    game, collisions = two_bodies("bounce")
+    before = momentum(game)
+    game.advance(0.01, 0.0001)
+    assert [event[1:4] for event in collisions.events] == [("collision", "a", "b")]
+    a, b = game.objects["a"], game.objects["b"]
+    assert len(game.objects) == 2 and (b.position - a.position).length() > 0.002
+    assert b.position.x > a.position.x and b.velocity.x > a.velocity.x  # they did not pass through each other
+    assert (momentum(game) - before).length() < 1e-9
+
+
+@pytest.mark.parametrize("backend", ["python", "numpy"])
+def test_kepler_integrator_sees_bounces_and_partial_loads(backend):
+    game, collisions = two_bodies("bounce", backend, "kepler")
+    game.advance(0.01, 0.0001)
+    assert [event[1:4] for event in collisions.events] == [("collision", "a", "b")]
+    a, b = game.objects["a"], game.objects["b"]
+    assert b.position.x > a.position.x and b.velocity.x > a.velocity.x  # they did not pass through each other
+    game = sun_and_earth("kepler")
+    game.advance(0.1, 0.01)
+    earth = game.objects["earth"]
+    start = solarsystem.pygame.math.Vector3(earth.position)
+    earth.velocity = -earth.velocity
+    game.backend.load_bodies([earth.number])
+    assert solarsystem.current_kepler(game.backend) is None
+    game.advance(0.01, 0.01)
+    assert (earth.position - start).dot(earth.velocity) > 0  # backwards along the orbit
+
+
+def earth_and_moon(integrator):
+    game = solarsystem.Game(integrator=integrator)
+    earth = game.objects["earth"]
+    game.add_body(name="moon", mass=0.0123, position=earth.position + (0.00257, 0, 0), boss=earth, radius=1e-5)
+    game.backend.load()
+    return game
+
+
+def moon_from_earth(game, years, step):
+    game.advance(years, step)
+    game.backend.store()
+    return np.array(game.objects["moon"].position - game.objects["earth"].position)
+
+
+def test_block_steps_follow_the_moon():
+    day = 1 / 365.25
+    game = earth_and_moon("block")
+    rungs = solarsystem.block_rungs(game.backend, day)
+    assert rungs[3] == rungs[5] > 0  # the earth substeps with its moon
+    reference = moon_from_earth(earth_and_moon("leapfrog"), 0.5, day / 64)
+    block = np.linalg.norm(moon_from_earth(game, 0.5, day) - reference)
+    leapfrog = np.linalg.norm(moon_from_earth(earth_and_moon("leapfrog"), 0.5, day) - reference)
+    fine = np.linalg.norm(moon_from_earth(earth_and_moon("leapfrog"), 0.5, day / 2 ** rungs[5]) - reference)
+    assert block < leapfrog / 20 and block < 1.01 * fine
+
+
+CATALOG = [  # elements, a moon of mars given by elements, a state vector without mass
+    {"name": "ceres", "mass": 0.00016, "a": 2.77, "e": 0.0785, "i": 10.6, "node": 80.3, "periapsis": 73.6,
+     "anomaly": 96.0, "comment": "dwarf planet"},
+    {"name": "phobos", "boss": "mars", "mass": 1.8e-9, "a": 6.3e-5, "e": 0.0, "anomaly": 30.0, "comment": ""},
+    {"name": "probe", "x": 1.5, "y": 0.0, "z": 0.1, "vx": 0.0, "vy": -5.1, "vz": 0.0, "comment": "no mass, no radius"},
+]
+
+
+def write_catalog(filename):
+    keys = list(dict.fromkeys(key for row in CATALOG for key in row))
+    if filename.endswith(".csv"):
+        with open(filename, "w", newline="") as f:
+            writer = csv.DictWriter(f, keys)
+            writer.writeheader()
+            writer.writerows(CATALOG)
+    elif filename.endswith(".json"):
+        with open(filename, "w") as f:
+            json.dump(CATALOG, f)
+    else:
+        np.savez(filename, **{key: np.array([row.get(key, "" if key in ("name", "boss", "comment") else np.nan)
+                                              for row in CATALOG]) for key in keys})
+
+
+@pytest.mark.parametrize("extension", ["csv", "json", "npz"])
+def test_catalog_formats(tmp_path, extension):
+    filename = str(tmp_path / ("asteroids." + extension))
+    write_catalog(filename)
+    game = solarsystem.Game()
+    assert game.load_catalog(filename) == (2, 1)
+    sun, mars, ceres, phobos = (game.objects[name] for name in ("sun", "mars", "ceres", "phobos"))
+    assert ceres.radius == 0 and ceres.boss is sun and phobos.boss is mars
+    expected = solarsystem.kepler_to_state([2.77], [0.0785], [10.6], [80.3], [73.6], [96.0],
+                                           solarsystem.GRAVCONST * (sun.mass + 0.00016))
+    assert np.allclose(ceres.position - sun.position, expected[0][0], rtol=0, atol=1e-12)
+    assert np.allclose(ceres.velocity - sun.velocity, expected[1][0], rtol=0, atol=1e-12)
+    assert (phobos.position - mars.position).length() == pytest.approx(6.3e-5)
+    assert game.particles.names == ["probe"]
+    assert np.array_equal(game.particles.positions, [[1.5, 0, 0.1]])
+    assert np.array_equal(game.particles.velocities, [[0, -5.1, 0]])
+
+
+def test_catalog_csv_with_a_short_row(tmp_path):
+    filename = tmp_path / "ragged.csv"
+    filename.write_text("name,mass,a,e\nceres,0.00016,2.77,0.0785\n\nvesta,4.3e-5,2.36\npallas,3.4e-5,2.77,0.23\n")
+    with pytest.raises(ValueError, match="line 4 "):
+        solarsystem.read_catalog(str(filename))
+
+
+@pytest.mark.parametrize("rows, bad", [("bad,1e-10,,0.1,3,,,,,,", "row 2 (bad)"),
+                                       ("probe,0,,,,1.5,0,0.1,,,", "row 2 (probe)"),
+                                       (",0,-2.5,0.1,,,,,,,", "row 2 ")])
+def test_catalog_rows_with_incomplete_orbits(tmp_path, rows, bad):
+    filename = tmp_path / "incomplete.csv"
+    filename.write_text("name,mass,a,e,anomaly,x,y,z,vx,vy,vz\nceres,0.00016,2.77,0.0785,96,,,,,,\n" + rows + "\n")
+    game = solarsystem.Game()
+    with pytest.raises(ValueError, match=re.escape(bad)):
+        game.load_catalog(str(filename))
+    assert len(game.objects) == 5 and len(game.particles) == 0  # nothing was added
+
+
+def solar_system(backend="numpy", integrator="leapfrog"):
+    """the planets of Game, a moon around the earth and a few test particles"""
+    game = solarsystem.Game(backend=backend, integrator=integrator)
+    earth = game.objects["earth"]
+    game.add_body(name="moon", mass=0.0123, position=earth.position + (0.00257, 0, 0), boss=earth, radius=1e-5)
+    game.add_particles(np.array([[2.5, 0, 0], [0, -2.9, 0.1], [-3.1, 0.2, 0]]))
+    game.backend.load()
+    return game
+
+
+@pytest.mark.parametrize("backend", list(solarsystem.Game.backends))
+@pytest.mark.parametrize("integrator", list(solarsystem.Game.integrators))
+def test_checkpoint_resume_is_bit_identical(tmp_path, backend, integrator):
+    step = 1 / 100
+    reference = solar_system(backend, integrator)
+    reference.advance(1, step)
+    reference.advance(1, step)
+    interrupted = solar_system(backend, integrator)
+    interrupted.advance(1, step)
+    filename = str(tmp_path / "run.chk")
+    solarsystem.write_checkpoint(filename, *solarsystem.checkpoint_state(interrupted))
+    resumed = solarsystem.Game.from_checkpoint(filename)
+    assert resumed.backend.name == backend and resumed.integrator == integrator
+    resumed.advance(1, step)
+    assert resumed.time == reference.time
+    for expected, actual in zip(solarsystem.state_arrays(reference.backend), solarsystem.state_arrays(resumed.backend)):
+        assert np.array_equal(expected, actual)
+
+
+def test_checkpointer_skips_instead_of_waiting(tmp_path, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    write_checkpoint = solarsystem.write_checkpoint
+
+    def slow_disk(filename, meta, arrays):
+        started.set()
+        release.wait(10)
+        write_checkpoint(filename, meta, arrays)
+
+    monkeypatch.setattr(solarsystem, "write_checkpoint", slow_disk)
+    game = solarsystem.Game()
+    checkpointer = solarsystem.Checkpointer(game, str(tmp_path / "run"), observe=False)
+    first = checkpointer.save()
+    assert started.wait(10)  # the writer hangs in the first one
+    for _ in range(3):
+        game.advance(1, 0.01)
+        last = checkpointer.save()  # does not wait
+    assert checkpointer.skipped == 2
+    release.set()
+    checkpointer.close()
+    assert sorted(os.listdir(str(tmp_path))) == [os.path.basename(first), os.path.basename(last)]
+    assert solarsystem.Game.from_checkpoint(last).time == game.time
+
+
+def test_seek_without_bodies():
+    game = solarsystem.Game(solar_system=False)
+    game.seek(100)
+    assert game.time == 100
+
+
+@pytest.mark.parametrize("speed", [0.0, 0.5, -0.5, 20.0])
+def test_kepler_radial_orbits(speed):
+    """straight fall towards the centre (and away from it): no orbital plane"""
+    mu = solarsystem.GRAVCONST * 332937
+    orbits = solarsystem.KeplerOrbits([[1.0, 0, 0]], [[speed, 0, 0]], mu)
+    positions, velocities = orbits.state(0.0)
+    assert np.allclose(positions, [[1, 0, 0]], atol=1e-9) and np.allclose(velocities, [[speed, 0, 0]], atol=1e-5)
+    positions, velocities = orbits.state(0.01)
+    r = np.linalg.norm(positions[0])
+    assert abs(positions[0, 1]) + abs(positions[0, 2]) < 1e-5
+    assert (r > 1) == (speed > 0)
+    energy = velocities[0] @ velocities[0] / 2 - mu / r
+    assert energy == pytest.approx(speed ** 2 / 2 - mu, rel=1e-6)
+
+
+def sun_and_earth(integrator="leapfrog"):
+    """an eccentric, inclined earth added with a velocity and without boss"""
+    game = solarsystem.Game(solar_system=False, integrator=integrator)
+    game.add_body(name="sun", position=(0, 0, 0), velocity=(0, 0, 0), mass=332937, radius=0.00465)
+    game.add_body(name="earth", position=(1, 0, 0), velocity=(0, -5.5, 0.3), mass=1, radius=4.3e-5)
+    return game
+
+
+def test_seek_follows_elliptic_orbits_of_bodies_without_boss():
+    reference = sun_and_earth("rk45")
+    reference.advance(3.7, 1 / 3650)
+    game = sun_and_earth()
+    game.seek(3.7)
+    assert game.time == 3.7
+    for name in ("sun", "earth"):
+        assert (game.objects[name].position - reference.objects[name].position).length() < 1e-4
+    game = sun_and_earth("kepler")
+    game.advance(3.7, 0.1)
+    game.backend.store()
+    assert (game.objects["earth"].position - reference.objects["earth"].position).length() < 1e-4
+
+
+def orbit_error(integrator, h, years=3):
+    """distance from the exact two-body orbit of the earth relative to the sun, energy drift"""
+    game = sun_and_earth(integrator)
+    game.backend.sync()
+    exact = solarsystem.KeplerPropagator(game.backend, 0.0).state(years)[0]
+    diagnostics = solarsystem.Diagnostics(game, every=1)
+    game.advance(years, h)
+    positions = solarsystem.state_arrays(game.backend)[0]
+    return np.linalg.norm((positions[1] - positions[0]) - (exact[1] - exact[0])), diagnostics.energy_drift
+
+
+@pytest.mark.parametrize("integrator, order", [("leapfrog", 2), ("yoshida4", 4)])
+def test_integrator_error_order(integrator, order):
+    errors = [orbit_error(integrator, h)[0] for h in (1 / 100, 1 / 200, 1 / 400)]
+    for coarse, fine in zip(errors, errors[1:]):
+        assert 0.8 * 2 ** order < coarse / fine < 1.2 * 2 ** order
+
+
+def test_higher_order_integrators_drift_less_than_leapfrog():
+    leapfrog = orbit_error("leapfrog", 1 / 100)
+    yoshida4 = orbit_error("yoshida4", 1 / 100)
+    rk45 = orbit_error("rk45", 1 / 100)  # adaptive: substeps below the tolerance
+    assert yoshida4[0] < leapfrog[0] / 20 and yoshida4[1] < leapfrog[1] / 20
+    assert rk45[0] < 1e-7 and rk45[1] < 1e-8
+
+
+def count_steps(game):
+    steps = []
+    game.observers.append(lambda g: steps.append(g.time))
+    return steps
+
+
+def test_timestep_accumulates_fixed_steps():
+    game = solarsystem.Game()
+    game.set_timescale(3)  # 1 day per second
+    steps = count_steps(game)
+    h = game.step_size()
+    assert h == 1 / 365.25 / game.physics_rate
+    game.timestep(0.004)  # less than one step: waits in the accumulator
+    assert steps == [] and game.accumulator == pytest.approx(0.004 / 365.25)
+    game.timestep(0.5)
+    assert len(steps) == 60 and game.time == pytest.approx(60 * h)
+    assert game.accumulator == pytest.approx(0.004 / 365.25 + 0.5 / 365.25 - 60 * h)
+    game.paused = True
+    game.timestep(1)
+    assert len(steps) == 60
+    game.paused = False
+    game.physics_rate = 10
+    game.timestep(1)
+    assert len(steps) == 70 and game.step_size() == pytest.approx(1 / 3652.5)
+
+
+def test_timestep_caps_the_step_and_drops_the_backlog():
+    coarse = solarsystem.Game(max_step=0.1)
+    for game in (coarse, solarsystem.Game()):
+        game.set_timescale(len(solarsystem.Game.deltas) - 1)  # 1 year per second
+    assert coarse.step_size() == pytest.approx(1 / coarse.physics_rate)
+    assert game.step_size() == solarsystem.Game.max_step == 1 / 365.25
+    steps = count_steps(game)
+    game.max_steps_per_frame = 5
+    game.timestep(0.5)
+    assert len(steps) == 5 and game.accumulator == 0  # not spiralling: the rest is dropped
+    game.max_steps_per_frame = 2000
+    game.max_frame_time = 0.0  # the deadline passes after the first step
+    game.timestep(0.5)
+    assert len(steps) == 6 and game.accumulator == 0
+    assert game.time == pytest.approx(6 / 365.25)
+
+
+def wait_for(worker, condition, seconds=20):
+    """let the Viewer side of a PhysicsWorker run until condition() is true"""
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        worker.timestep(1 / 60)
+        if condition():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def test_physics_worker_start_seek_close():
+    game = solarsystem.Game()
+    game.paused = True
+    worker = solarsystem.PhysicsWorker(game)
+    name = worker.memory.name
+    try:
+        assert wait_for(worker, lambda: worker.sequence > 0)
+        assert worker.time == 0 and np.array_equal(worker.positions, solarsystem.state_arrays(game.backend)[0])
+        worker.seek(100)
+        assert wait_for(worker, lambda: worker.time == 100)
+        game.seek(100)
+        assert np.allclose(worker.positions, solarsystem.state_arrays(game.backend)[0], rtol=0, atol=1e-12)
+        worker.paused = False
+        assert wait_for(worker, lambda: worker.time > 100)
+    finally:
+        worker.close()
+    assert not worker.process.is_alive()
+    with pytest.raises(FileNotFoundError):
+        solarsystem.shared_memory.SharedMemory(name=name)
+
+
+async def request_error(path, request):
+    """send one request line to a StateServer, return the error of its reply"""
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write(request + b"\n")
+    length, = solarsystem.FRAME_HEADER.unpack(await reader.readexactly(solarsystem.FRAME_HEADER.size))
+    payload = await reader.readexactly(length)
+    writer.close()
+    return json.loads(payload[1:].decode("utf-8"))["error"]
+
+
+def test_state_server_round_trip(tmp_path):
+    game = solarsystem.Game()
+    seen = {game.time: np.hstack(solarsystem.state_arrays(game.backend))}
+    game.observers.append(lambda g: seen.setdefault(g.time, np.hstack(solarsystem.state_arrays(g.backend))))
+    path = str(tmp_path / "solar.sock")
+    server = solarsystem.StateServer(game, path)
+
+    async def clients():
+        task = asyncio.ensure_future(server.serve())
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        assert "bodies" in await request_error(path, b'{"bodies": [["earth"]]}')
+        assert "bodies" in await request_error(path, b'{"bodies": "earth"}')
+        assert "json" in await request_error(path, b'[1, 2]')
+        states = []
+        async for year, names, values in solarsystem.stream_states(path, ["earth", 4, "pluto"], rate=100):
+            states.append((year, names, values.copy()))
+            if len(states) == 40:
+                break
+        server.stop()
+        await task
+        return states
+
+    states = asyncio.run(clients())
+    assert server.running is False and not os.path.exists(path)
+    years = [year for year, names, values in states]
+    assert years == sorted(years) and years[-1] > years[0]
+    for year, names, values in states:
+        assert names == ["earth", "mars"]  # pluto is unknown
+        assert np.allclose(values, seen[year][[3, 4], :3], rtol=0, atol=1e-6)
+
+
+def test_tracer_ring_buffer(monkeypatch):
+    monkeypatch.setattr(solarsystem.Tracer, "capacity", 5)
+    monkeypatch.setattr(solarsystem.Viewer, "zero", [100, 50])
+    monkeypatch.setattr(solarsystem.Viewer, "grid_size", (10.0, 10.0))
+    tracer = solarsystem.Tracer()
+    for x in range(7):
+        tracer.append(x, -x)
+        tracer.append(x, -x)  # not moved: not appended
+    assert len(tracer) == 5 and tracer.appended == 7
+    assert tracer.pixels(3) == [[140, 10], [150, 0], [160, -10]]
+    assert tracer.pixels(100) == [[100 + 10 * x, 50 - 10 * x] for x in range(2, 7)]
+    tracer.clear()
+    assert len(tracer) == 0 and tracer.pixels(3) == []
+
+
+def test_text_cache_reuses_fonts_and_surfaces():
+    solarsystem.pygame.font.init()
+    cache = solarsystem.TextCache(max_bytes=1)
+    first = cache.render("year", (255, 255, 255), 12, "mono", True)
+    assert cache.render("year", (255, 255, 255), 12, "mono", True) is first
+    assert (cache.hits, cache.misses, cache.font_misses) == (1, 1, 1)
+    other = cache.render("fps", (255, 255, 255), 12, "mono", True)
+    assert other is not first and cache.font_hits == 1
+    assert list(cache.surfaces) == [("fps", (255, 255, 255), "mono", 12, True)]  # the oldest one is evicted
+    assert cache.bytes == other.get_width() * other.get_height() * other.get_bytesize()
+    uncached = cache.render("year", (255, 255, 255), 12, "mono", True, cache=False)
+    assert uncached is not first and cache.stats()["surfaces"] == 1 and cache.misses == 2
+
+
+def show(monkeypatch, game, frames, **options):
+    """runs a Viewer for game on the dummy video driver. frames lists the keys
+       pressed in every frame, after the last one the window is closed.
+       Returns the viewer and (raster mode, screen copy, updated rects or None)
+       of every frame. observe(viewer) is called before every frame is shown"""
+    pygame = solarsystem.pygame
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    monkeypatch.setattr(solarsystem.Viewer, "display_help", lambda self: None)  # no flying text
+    viewers, shown = [], []
+    run = solarsystem.Viewer.run
+    monkeypatch.setattr(solarsystem.Viewer, "run", lambda self: viewers.append(self) or run(self))
+    script = iter(frames)
+    observe = options.pop("observe", lambda viewer: None)
+
+    def events():
+        keys = next(script, None)
+        if keys is None:
+            return [pygame.event.Event(pygame.QUIT)]
+        return [pygame.event.Event(pygame.KEYDOWN, key=key) for key in keys]
+
+    def update(rects=None):
+        observe(viewers[0])
+        shown.append((viewers[0].raster_mode, viewers[0].screen.copy(), rects))
+
+    monkeypatch.setattr(pygame.event, "get", events)
+    monkeypatch.setattr(pygame.display, "update", update)
+    monkeypatch.setattr(pygame.display, "flip", update)
+    solarsystem.Viewer(game, **options)
+    return viewers[0], shown
+
+
+def count_color(surface, color):
+    pixels = solarsystem.pygame.surfarray.array3d(surface)
+    return int(np.all(pixels == color, axis=2).sum())
+
+
+@pytest.mark.parametrize("zoom", ["K_KP_ENTER", "K_KP_PLUS", "K_KP_MINUS"])
+def test_scrolled_grid_matches_a_fresh_one(monkeypatch, zoom):
+    pygame = solarsystem.pygame
+    pixels = pygame.surfarray.array3d
+    cached = []
+
+    def observe(viewer):
+        surface, zero = viewer.grid_cache[solarsystem.Viewer.zoom]
+        assert zero == tuple(solarsystem.Viewer.zero)
+        fresh = pygame.Surface(surface.get_size()).convert()
+        viewer.draw_grid_lines(fresh, fresh.get_rect())
+        assert np.array_equal(pixels(surface), pixels(fresh))
+        cached.append(surface)
+
+    pans = [[pygame.K_KP4], [pygame.K_KP6], [pygame.K_KP6], [pygame.K_KP4], [pygame.K_KP8], [pygame.K_KP2],
+            [pygame.K_KP2], [pygame.K_KP4, pygame.K_KP8]]  # ±100 pixel each
+    show(monkeypatch, solarsystem.Game(), [[getattr(pygame, zoom)]] + pans, observe=observe)
+    assert len(cached) > len(pans)
+    panned = cached[-1 - len(pans):]  # from the frame after the zoom on
+    assert all(surface is panned[0] for surface in panned)  # scrolled, never drawn again as a whole
+
+
+def test_frame_timer_books_known_durations(monkeypatch, tmp_path):
+    clock = [100.0]
+    monkeypatch.setattr(solarsystem.time, "perf_counter", lambda: clock[0])
+    output = str(tmp_path / "timings.csv")
+    timer = solarsystem.FrameTimer(["physics", "draw"], window=3, output=output)
+    for physics, draw in [(0.010, 0.005), (0.020, 0.001), (0.030, 0.002), (0.040, 0.003)]:
+        clock[0] += physics
+        timer.mark("physics")
+        clock[0] += draw / 2
+        timer.mark("draw")
+        clock[0] += draw / 2
+        timer.mark("draw")  # booked twice in one frame
+        clock[0] += 0.001  # not booked on any phase
+        timer.end_frame()
+    timer.close()
+    assert timer.frames == 4 and len(timer.totals) == 3  # the first frame left the window
+    assert timer.statistics(timer.history["physics"]) == pytest.approx((30, 30, 40, 40))
+    assert timer.statistics(timer.history["draw"]) == pytest.approx((2, 2, 3, 3))
+    assert timer.statistics(timer.totals) == pytest.approx((33, 33, 44, 44))
+    assert timer.statistics([]) == (0, 0, 0, 0)
+    assert timer.report() == ["ms           mean    p50    p95    max",
+                              "physics     30.00  30.00  40.00  40.00",
+                              "draw         2.00   2.00   3.00   3.00",
+                              "frame       33.00  33.00  44.00  44.00"]
+    with open(output, newline="") as f:
+        rows = list(csv.reader(f))
+    assert rows == [["frame", "total", "physics", "draw"], ["0", "16.000", "10.000", "5.000"],
+                    ["1", "22.000", "20.000", "1.000"], ["2", "33.000", "30.000", "2.000"],
+                    ["3", "44.000", "40.000", "3.000"]]
+
+
+def test_timings_overlay_shows_every_phase(monkeypatch):
+    pygame = solarsystem.pygame
+    reports = []
+    viewer, shown = show(monkeypatch, solarsystem.Game(), [[], [pygame.K_F3], [], [pygame.K_F3], []],
+                         observe=lambda viewer: reports.append(viewer.show_timings and viewer.timer.report()))
+    corner = [count_color(screen.subsurface((solarsystem.Viewer.width - 100, 5, 100, 60)), (255, 255, 0))
+              for mode, screen, rects in shown]
+    for report, yellow in zip(reports, corner):
+        assert bool(report) == (yellow > 0)  # the overlay is drawn while F3 is on
+        if report:
+            assert [line.split()[0] for line in report] == ["ms", *viewer.phases, "frame"]
+    assert any(reports) and not reports[-1]
+
+
+def test_merge_rects_covers_without_overlap():
+    Rect = solarsystem.pygame.Rect
+    rng = np.random.default_rng(3)
+    rects = [Rect(*xy, *size) for xy, size in zip(rng.integers(0, 600, (60, 2)).tolist(),
+                                                  rng.integers(0, 80, (60, 2)).tolist())]
+    merged = solarsystem.merge_rects(rects + [(5, 5, 0, 10)])
+    assert len(merged) < len(rects)
+    for i, rect in enumerate(merged):
+        assert rect.collidelist(merged[i + 1:]) == -1
+    for rect in rects:
+        assert rect.width == 0 or rect.height == 0 or any(m.contains(rect) for m in merged)
+
+
+def test_viewer_updates_only_dirty_rects(monkeypatch):
+    game = solarsystem.Game()
+    game.paused = True
+    K = solarsystem.pygame
+    shown = show(monkeypatch, game, [[]] * 4 + [[K.K_BACKSPACE]] + [[]] * 2)[1]
+    screen = shown[0][1].get_rect()
+    for mode, surface, rects in shown[:4]:
+        assert rects
+        for i, rect in enumerate(rects):
+            assert rect.collidelist(rects[i + 1:]) == -1
+    area = sum(rect.width * rect.height for rect in shown[3][2])
+    assert 0 < area < screen.width * screen.height / 4  # paused: the sprites, the status line and the log
+    assert all(rects is None for mode, surface, rects in shown[4:])  # [BACKSPACE]: full screen
+    assert count_color(shown[-1][1], (255, 255, 0)) > 5  # the sun, a disc of radius 2
+
+
+def test_viewer_draws_small_bodies_in_every_mode(monkeypatch):
+    rng = np.random.default_rng(4)
+    game = solarsystem.Game()
+    game.paused = True
+    angle = rng.uniform(0, 2 * np.pi, 80)
+    game.add_bodies(np.column_stack((1.2 * np.cos(angle), 0.8 * np.sin(angle), np.zeros(80))),
+                    np.zeros((80, 3)), np.full(80, 1e-6), radii=[0.02] * 80)  # 4 pixel discs
+    angle, r = rng.uniform(0, 2 * np.pi, 30000), rng.uniform(0.3, 0.9, 30000)
+    game.add_particles(np.column_stack((r * np.cos(angle), r * np.sin(angle), np.zeros(30000))),
+                       np.zeros((30000, 3)))
+    monkeypatch.setattr(solarsystem.Viewer, "particle_color", (1, 254, 3))
+    K = solarsystem.pygame
+    viewer, shown = show(monkeypatch, game, [[], [K.K_d], [], [K.K_d], [], [K.K_d]])
+    assert len(viewer.sprites) == solarsystem.Viewer.max_sprites and 0 in viewer.sprites
+    assert [mode for mode, surface, rects in shown] == ["auto", "points", "points", "density", "density", "auto",
+                                                         "auto"]
+    white = (255, 255, 255)  # the fullest cells of the density map
+    for mode, surface, rects in shown:
+        colored = count_color(surface, viewer.particle_color)
+        field = surface.subsurface((0, 0, surface.get_width(), surface.get_height() - 30))  # not the status line
+        if mode == "points":
+            assert colored > 15000  # single pixels of the test particles
+        else:  # more than density_threshold visible: density map in auto mode too
+            assert 21 * 15 < colored < 21 * 80  # only the discs of the 21 bodies without sprite
+            assert count_color(field, white) >= viewer.density_cell ** 2
+
+
+def test_viewer_can_open_twice(monkeypatch):
+    """the text cache must not keep fonts over pygame.quit()"""
+    for _ in range(2):
+        show(monkeypatch, solarsystem.Game(), [[]])
+    assert not solarsystem.text_cache.fonts
+
+
+@pytest.mark.parametrize("backend", ["python", "numpy"])
+def test_viewer_projects_sprites_in_one_batch(monkeypatch, backend):
+    game = solarsystem.Game(backend=backend)
+    game.paused = True
+    pygame = solarsystem.pygame
+    checked = []
+
+    def observe(viewer):
+        for number, sprite in viewer.sprites.items():
+            body = game.objects[number]
+            pixel = solarsystem.gridpos_to_pixelvector(body.position)
+            assert sprite.rect.center == (round(pixel.x), round(pixel.y))
+            assert sprite.tracer.pixels(1) == [[pixel.x, pixel.y]]
+        checked.append(len(viewer.sprites))
+
+    show(monkeypatch, game, [[], [pygame.K_KP4], [pygame.K_KP_PLUS], [pygame.K_KP2], []], observe=observe)
+    assert checked == [5] * 6